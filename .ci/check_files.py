@@ -2,9 +2,11 @@ import argparse
 import yaml
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from bioblend.toolshed import ToolShedInstance
-from bioblend.toolshed.repositories import ToolShedRepositoryClient
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tool_yaml  # noqa: E402
+from utils import get_toolshed_instance  # noqa: E402
 
 default_tool_shed = 'toolshed.g2.bx.psu.edu'
 
@@ -92,6 +94,7 @@ def main():
     parser.add_argument('-g', '--production_url', help='Galaxy production server URL')
     parser.add_argument('-s', '--staging_dir', help='Staging server tool file directory')
     parser.add_argument('-p', '--production_dir', help='Production server tool file directory')
+    parser.add_argument('-w', '--workers', help='Number of concurrent tool shed queries', type=int, default=8)
 
     args = parser.parse_args()
     files = args.files
@@ -103,8 +106,9 @@ def main():
     loaded_files = yaml_check(files)   # load yaml and raise ParserError if yaml is incorrect
     key_check(loaded_files)
     tool_list = join_lists([x['yaml']['tools'] for x in loaded_files])
-    installable_warnings, installable_errors = check_installable(tool_list)
-    installed_warnings_production, installed_errors_production = check_against_installed_tools(tool_list, production_dir, production_url)
+    installed_index = get_installed_index(production_dir)
+    installable_warnings, installable_errors = check_installable(tool_list, installed_index, workers=args.workers)
+    installed_warnings_production, installed_errors_production = check_against_installed_tools(tool_list, installed_index, production_url)
 
     all_warnings = (
         installed_warnings_production + installable_warnings
@@ -131,7 +135,7 @@ def yaml_check(files):
         with open(file) as file_in:
             # As a first pass, check that yaml loads
             try:
-                loaded_yml = yaml.safe_load(file_in.read())  # might throw exception here
+                loaded_yml = tool_yaml.safe_load(file_in.read())  # might throw exception here
             except yaml.parser.ParserError as e:
                 raise e
             loaded_files.append({
@@ -168,68 +172,84 @@ def key_check(loaded_files):
         sys.stderr.write('OK\n')
 
 
-def check_installable(tools):
+def get_installed_index(tool_dir):
+    """
+    Return a dict of (name, owner): {'revisions': set of revisions, 'labels': list of section labels,
+    'tool_shed_urls': set of tool sheds} for the tools in a tool directory
+    """
+    index = {}
+    for path, tool in tool_yaml.iter_tools(tool_dir):
+        entry = index.setdefault((tool['name'], tool['owner']), {'revisions': set(), 'labels': [], 'tool_shed_urls': set()})
+        entry['revisions'].update(tool.get('revisions') or [])
+        entry['tool_shed_urls'].add(tool.get('tool_shed_url', default_tool_shed))
+        if tool['tool_panel_section_label'] not in entry['labels']:
+            entry['labels'].append(tool['tool_panel_section_label'])
+    return index
+
+
+def check_installable(tools, installed_index, workers=8):
     # Go through all tool_shed_url values in request files and run get_ordered_installable_revisions
-    # to ascertain whether the specified revision is installable
+    # to ascertain whether the specified revision is installable.  Requested revisions that are already
+    # recorded as installed in the tool directory are known to be installable and are not looked up.
     errors = []
     warnings = []
-    tools_by_shed = {}
+    lookups = []
     for tool in tools:
         if 'tool_shed_url' not in tool.keys():
             tool.update({'tool_shed_url': default_tool_shed})
-        if tool['tool_shed_url'] in tools_by_shed.keys():
-            tools_by_shed[tool['tool_shed_url']].append(tool)
-        else:
-            tools_by_shed[tool['tool_shed_url']] = [tool]
+        installed = installed_index.get((tool['name'], tool['owner']))
+        if installed and tool['tool_shed_url'] in installed['tool_shed_urls'] and tool.get('revisions') \
+                and set(tool['revisions']) <= installed['revisions']:
+            continue
+        lookups.append(tool)
 
-    for shed in tools_by_shed.keys():
-        url = 'https://%s' % shed
-        toolshed = ToolShedInstance(url=url)
-        repo_client = ToolShedRepositoryClient(toolshed)
+    toolsheds = {}
+    for shed in sorted(set(tool['tool_shed_url'] for tool in lookups)):
+        toolsheds[shed] = get_toolshed_instance(shed, pool_size=workers)
 
-        for counter, tool in enumerate(tools_by_shed[shed]):
-            try:
-                installable_revisions = repo_client.get_ordered_installable_revisions(tool['name'], tool['owner'])
-                if counter == 0:
-                    sys.stderr.write('Connected to toolshed %s\n' % url)
-                installable_revisions = [str(r) for r in installable_revisions][::-1]  # un-unicode and list most recent first
-                if not installable_revisions:
-                    errors.append('Tool with name: %s, owner: %s and tool_shed_url: %s has no installable revisions' % (tool['name'], tool['owner'], shed))
-                    continue
-            except Exception as e:
-                raise Exception(e)
-
-            if 'revisions' in tool.keys():  # Check that requested revisions are installable
-                # 18/07/24: Downgrade this to a warning. Galaxy will either install the next installable revision or skip because it's already there
-                for revision in tool['revisions']:
-                    if revision not in installable_revisions:
-                        warnings.append('%s revision %s is not installable' % (tool['name'], revision))
-            else:
-                tool.update({'revisions': [installable_revisions[0]]})
+    def get_installable_revisions(tool):
+        # Errors are reported for the tool so that one unreachable repository or tool shed does not stop the lint
+        try:
+            installable_revisions = toolsheds[tool['tool_shed_url']].repositories.get_ordered_installable_revisions(tool['name'], tool['owner'])
+        except Exception as e:
+            return e
+        return [str(r) for r in installable_revisions][::-1]  # un-unicode and list most recent first
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = list(executor.map(get_installable_revisions, lookups))
+    for shed in toolsheds:
+        sys.stderr.write('Connected to toolshed %s\n' % toolsheds[shed].base_url)
+
+    for tool, installable_revisions in zip(lookups, results):
+        if isinstance(installable_revisions, Exception):
+            errors.append('Could not query installable revisions of %s from %s: %s' % (tool['name'], tool['tool_shed_url'], installable_revisions))
+            continue
+        if not installable_revisions:
+            errors.append('Tool with name: %s, owner: %s and tool_shed_url: %s has no installable revisions' % (tool['name'], tool['owner'], tool['tool_shed_url']))
+            continue
+        if 'revisions' in tool.keys():  # Check that requested revisions are installable
+            # 18/07/24: Downgrade this to a warning. Galaxy will either install the next installable revision or skip because it's already there
+            for revision in tool['revisions']:
+                if revision not in installable_revisions:
+                    warnings.append('%s revision %s is not installable' % (tool['name'], revision))
+        else:
+            tool.update({'revisions': [installable_revisions[0]]})
     return warnings, errors
 
 
-def check_against_installed_tools(tool_list, tool_dir, url):
+def check_against_installed_tools(tool_list, installed_index, url):
     errors = []
     warnings = []
-    installed_tools = []
-    for file in os.listdir(tool_dir):
-        with open(tool_dir + '/' + file) as tool_yml:
-            installed_tools += yaml.safe_load(tool_yml.read())['tools']
     for tool in tool_list:
-        label_mismatch = False
-        mismatched_labels = []
         name, owner = tool['name'], tool['owner']
-        matching_installed_tools = [t for t in installed_tools if t['name'] == name and t['owner'] == owner]
-        for installed_tool in matching_installed_tools:
-            label_mismatch = installed_tool['tool_panel_section_label'] != tool['tool_panel_section_label']
-            if label_mismatch:
-                mismatched_labels.append(installed_tool["tool_panel_section_label"])
-            matching_revisions = [rev for rev in tool['revisions'] if rev in installed_tool['revisions']]
-            for revision in matching_revisions:
-                warning = 'Tool %s revision %s is already installed on %s' % (name, revision, url)
-                warnings.append(warning)
-        if label_mismatch:
+        installed = installed_index.get((name, owner))
+        if not installed:
+            continue
+        for revision in tool.get('revisions', []):
+            if revision in installed['revisions']:
+                warnings.append('Tool %s revision %s is already installed on %s' % (name, revision, url))
+        mismatched_labels = [label for label in installed['labels'] if label != tool['tool_panel_section_label']]
+        if mismatched_labels:
             error = "Tool %s is already installed  in a different section: '%s'" % (
                 name, ", ".join(mismatched_labels)
             )
@@ -0,0 +1,193 @@
+import os
+import sys
+import csv
+import json
+import random
+import shutil
+import hashlib
+import argparse
+import importlib.util
+from datetime import datetime
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(repo_dir, 'scripts'))
+import tool_yaml  # noqa: E402
+
+"""
+Generate a synthetic copy of the tool inventory at a multiple of its real size for benchmarks.
+
+The tool directories (usegalaxy.org.au, staging.gvl.org.au, galaxy-aust-dev) and the installation log of
+the repository are copied SCALE times into the output directory.  The first copy keeps the real names and
+revisions, and copy k of a repository is named <name>_x<k> with revisions derived from the real ones, so
+section files, labels, owners and revision counts keep their real distribution.  Every tool shed URL is
+replaced with --tool_shed_url, i.e. the mock server started by run_benchmarks.py.
+
+The output directory also contains
+tool_list.yml       all production tools in one file, as written by get-tool-list, for split_tool_yml.py
+requests/*.yml      request files for .ci/check_files.py, with new repositories and new revisions of installed ones
+trusted_owners.yml  copied from the repository
+inventory.json      installed repositories on each server and installable revisions on the tool shed, for mock_server.py
+manifest.json       the scale, counts and the builds and dates in the installation log
+
+python benchmarks/generate_inventory.py -s 10 -o /tmp/benchmarks/scale_10 --tool_shed_url http://127.0.0.1:8790/toolshed
+"""
+
+tool_dirs = {'production': 'usegalaxy.org.au', 'staging': 'staging.gvl.org.au', 'dev': 'galaxy-aust-dev'}
+log_file = 'automated_tool_installation_log.tsv'
+update_fraction = 0.1  # proportion of repositories with a newer installable revision than any installed one
+request_files = 10
+tools_per_request = 10
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic tool inventory for benchmarks')
+    parser.add_argument('-s', '--scale', help='Multiple of the real inventory size', type=int, default=1)
+    parser.add_argument('-o', '--outdir', help='Output directory', required=True)
+    parser.add_argument('--tool_shed_url', help='Tool shed URL for all tools', default='http://127.0.0.1:8790/toolshed')
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    args = parser.parse_args()
+    manifest = generate(args.outdir, args.scale, args.tool_shed_url, seed=args.seed)
+    print(json.dumps(manifest, indent=2))
+
+
+def copy_name(name, k):
+    return name if k == 0 else '%s_x%d' % (name, k)
+
+
+def copy_revision(revision, k):
+    return revision if k == 0 else hashlib.sha1(('%s:%d' % (revision, k)).encode()).hexdigest()[:12]
+
+
+def new_revision(name, owner, label):
+    return hashlib.sha1(('%s/%s:%s' % (owner, name, label)).encode()).hexdigest()[:12]
+
+
+def get_valid_section_labels():
+    spec = importlib.util.spec_from_file_location('check_files', os.path.join(repo_dir, '.ci', 'check_files.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return set(module.valid_section_labels)
+
+
+def generate(outdir, scale, tool_shed_url, seed=1):
+    rng = random.Random(seed)
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    shed_host = tool_shed_url.split('://')[-1]
+    installed = {server: [] for server in tool_dirs}  # server: list of repository dicts as returned by Galaxy
+    installable = {}  # owner/name: ordered installable revisions
+    production_tools = []
+
+    for server, tool_dir in tool_dirs.items():
+        os.makedirs(os.path.join(outdir, tool_dir))
+        for path in sorted(os.listdir(os.path.join(repo_dir, tool_dir))):
+            if not path.endswith('.yml'):
+                continue
+            tools = tool_yaml.load_file(os.path.join(repo_dir, tool_dir, path), cache_dir=None)['tools']
+            copies = []
+            for k in range(scale):
+                for tool in tools:
+                    copy = dict(tool, name=copy_name(tool['name'], k), tool_shed_url=tool_shed_url)
+                    copy['revisions'] = [copy_revision(revision, k) for revision in tool.get('revisions') or []]
+                    copies.append(copy)
+                    key = '%s/%s' % (copy['owner'], copy['name'])
+                    revisions = installable.setdefault(key, [])
+                    for ctx_rev, revision in enumerate(copy['revisions']):
+                        if revision not in revisions:
+                            revisions.append(revision)
+                        installed[server].append({
+                            'name': copy['name'], 'owner': copy['owner'], 'changeset_revision': revision,
+                            'ctx_rev': str(ctx_rev), 'status': 'Installed', 'deleted': False, 'tool_shed': shed_host,
+                        })
+            with open(os.path.join(outdir, tool_dir, path), 'w') as handle:
+                tool_yaml.dump({'tools': copies}, handle)
+            if server == 'production':
+                production_tools.extend(copies)
+
+    for key in sorted(installable):
+        if rng.random() < update_fraction:
+            installable[key].append(new_revision(*key.split('/'), 'update'))
+
+    with open(os.path.join(outdir, 'tool_list.yml'), 'w') as handle:
+        tool_yaml.dump({'install_tool_dependencies': True, 'tools': production_tools}, handle)
+
+    # Requests are a mix of new repositories and new revisions of installed repositories in valid sections
+    valid_labels = get_valid_section_labels()
+    candidates = [tool for tool in production_tools if tool['tool_panel_section_label'] in valid_labels]
+    os.makedirs(os.path.join(outdir, 'requests'))
+    for i in range(request_files):
+        tools = []
+        for j in range(tools_per_request):
+            tool = rng.choice(candidates)
+            if j % 2 == 0:  # new repository
+                name, revision = 'new_%s_%d_%d' % (tool['name'], i, j), None
+                installable['%s/%s' % (tool['owner'], name)] = [new_revision(name, tool['owner'], 'new')]
+            else:
+                name, revision = tool['name'], new_revision(tool['name'], tool['owner'], 'request')
+                if revision not in installable['%s/%s' % (tool['owner'], name)]:
+                    installable['%s/%s' % (tool['owner'], name)].append(revision)
+            request = {'name': name, 'owner': tool['owner'], 'tool_panel_section_label': tool['tool_panel_section_label'], 'tool_shed_url': tool_shed_url}
+            if revision:
+                request['revisions'] = [revision]
+            tools.append(request)
+        with open(os.path.join(outdir, 'requests', 'request_%02d.yml' % i), 'w') as handle:
+            tool_yaml.dump({'tools': tools}, handle)
+
+    log_rows, builds, dates = write_log(os.path.join(repo_dir, log_file), os.path.join(outdir, log_file), scale)
+    shutil.copy(os.path.join(repo_dir, 'trusted_owners.yml'), os.path.join(outdir, 'trusted_owners.yml'))
+
+    with open(os.path.join(outdir, 'inventory.json'), 'w') as handle:
+        json.dump({'tool_shed': shed_host, 'installed': installed, 'installable': installable}, handle)
+    manifest = {
+        'scale': scale,
+        'seed': seed,
+        'tool_shed_url': tool_shed_url,
+        'tools': len(production_tools),
+        'revisions': sum(len(tool['revisions']) for tool in production_tools),
+        'installable_repositories': len(installable),
+        'log_rows': log_rows,
+        'last_update_build': builds.get('Update'),
+        'first_date': min(dates).strftime('%Y-%m-%d') if dates else None,
+        'last_date': max(dates).strftime('%Y-%m-%d') if dates else None,
+    }
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as handle:
+        json.dump(manifest, handle, indent=2)
+    return manifest
+
+
+def write_log(source, destination, scale):
+    """
+    Write each row of the installation log scale times, renamed as in the tool directories.  Returns the
+    number of rows written, the last build number of each category and the dates of the rows
+    """
+    builds = {}
+    dates = []
+    rows = 0
+    with open(source, newline='') as infile, open(destination, 'w', newline='') as outfile:
+        reader = csv.reader(infile, delimiter='\t')
+        writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+        header = next(reader)
+        writer.writerow(header)
+        columns = {column: i for i, column in enumerate(header)}
+        for row in reader:
+            if len(row) < len(header):
+                continue
+            builds[row[columns['Category']]] = row[columns['Build Num.']]
+            try:
+                dates.append(datetime.strptime(row[columns['Date (AEST)']], '%d/%m/%y %H:%M:%S'))
+            except ValueError:
+                pass
+            for k in range(scale):
+                copy = list(row)
+                copy[columns['Name']] = copy_name(row[columns['Name']], k)
+                for column in ['Installed Revision', 'Requested Revision']:
+                    if row[columns[column]] not in ['', 'latest']:
+                        copy[columns[column]] = copy_revision(row[columns[column]], k)
+                writer.writerow(copy)
+                rows += 1
+    return rows, builds, dates
+
+
+if __name__ == "__main__":
+    main()
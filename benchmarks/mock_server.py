@@ -0,0 +1,144 @@
+import sys
+import json
+import hashlib
+import time
+import random
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
+
+"""
+A local HTTP server standing in for the Galaxy servers and the tool shed in benchmarks, serving the
+inventory.json written by generate_inventory.py.  Galaxy servers are served under /<server>, i.e.
+http://127.0.0.1:8790/production and http://127.0.0.1:8790/staging, and the tool shed under /toolshed.
+
+GET /<server>/api/tool_shed_repositories
+GET /<server>/api/version
+GET /toolshed/api/repositories?owner=&page=&page_size=
+GET /toolshed/api/repositories/get_ordered_installable_revisions?name=&owner=
+GET /toolshed/api/repositories/get_repository_revision_install_info?name=&owner=&changeset_revision=
+
+Every response is delayed by --latency seconds plus up to --jitter seconds to imitate a remote server.
+Request counts are written to stderr when the server stops, and are available from GET /stats.
+
+python benchmarks/mock_server.py -i /tmp/benchmarks/scale_10/inventory.json -p 8790 --latency 0.01
+"""
+
+
+class Inventory:
+    def __init__(self, path):
+        with open(path) as handle:
+            data = json.load(handle)
+        self.tool_shed = data['tool_shed']
+        self.installed = data['installed']
+        self.installable = data['installable']
+        self.owners = {}
+        for key in self.installable:
+            owner, name = key.split('/')
+            self.owners.setdefault(owner, []).append(name)
+
+    def get_install_info(self, name, owner, revision):
+        """ Install info for the installable revision at or after revision, as returned by the tool shed """
+        revisions = self.installable.get('%s/%s' % (owner, name)) or []
+        if not revisions:
+            return {}
+        installable_revision = revisions[revisions.index(revision)] if revision in revisions else revisions[-1]
+        ctx_rev = str(revisions.index(installable_revision))
+        clone_url = 'http://%s/repos/%s/%s' % (self.tool_shed, owner, name)
+        return [
+            {'name': name, 'owner': owner, 'id': '%s_%s' % (owner, name)},
+            {
+                'changeset_revision': installable_revision,
+                'valid_tools': [{'guid': '%s/repos/%s/%s/%s/1.0' % (self.tool_shed, owner, name, name), 'id': name, 'version': '1.0'}],
+            },
+            {name: ['', clone_url, installable_revision, ctx_rev, owner, {}, {}]},
+        ]
+
+    def get_repositories(self, owner):
+        return [
+            {
+                'name': name, 'owner': owner, 'id': '%s_%s' % (owner, name), 'deleted': False, 'deprecated': False,
+                'update_time': self.get_update_time(name, owner),
+            }
+            for name in self.owners.get(owner, [])
+        ]
+
+    def get_update_time(self, name, owner):
+        """ A time that changes whenever the installable revisions of the repository change """
+        revisions = self.installable.get('%s/%s' % (owner, name)) or ['']
+        seconds = int(hashlib.sha1(':'.join(revisions).encode()).hexdigest()[:7], 16)
+        return (datetime(2020, 1, 1) + timedelta(seconds=seconds)).isoformat()
+
+
+def make_handler(inventory, latency, jitter, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, as the real servers
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            parts = url.path.strip('/').split('/')
+            time.sleep(latency + random.random() * jitter)
+            route = '/'.join(parts[1:])
+            stats[url.path] = stats.get(url.path, 0) + 1
+            status, body = 200, None
+            if url.path == '/stats':
+                body = stats
+            elif parts[0] == 'toolshed':
+                if route == 'api/repositories':
+                    body = inventory.get_repositories(query.get('owner'))
+                    if 'page' in query:  # paginated as the current tool shed
+                        page, page_size = int(query['page']), int(query.get('page_size', 25))
+                        hits = body[(page - 1) * page_size:page * page_size]
+                        body = {'total_results': len(body), 'page': page, 'page_size': page_size, 'hits': hits}
+                elif route == 'api/repositories/get_ordered_installable_revisions':
+                    body = inventory.installable.get('%s/%s' % (query.get('owner'), query.get('name'))) or []
+                elif route == 'api/repositories/get_repository_revision_install_info':
+                    body = inventory.get_install_info(query.get('name'), query.get('owner'), query.get('changeset_revision'))
+            elif parts[0] in inventory.installed:
+                if route == 'api/tool_shed_repositories':
+                    body = inventory.installed[parts[0]]
+                elif route == 'api/version':
+                    body = {'version_major': '24.1', 'version_minor': '1'}
+            if body is None:
+                status, body = 404, {'err_msg': 'Not found: %s' % url.path}
+            self.send_json(status, body)
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Galaxy and tool shed server for benchmarks')
+    parser.add_argument('-i', '--inventory', help='inventory.json written by generate_inventory.py', required=True)
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8790)
+    parser.add_argument('--latency', help='Seconds to delay each response', type=float, default=0.0)
+    parser.add_argument('--jitter', help='Most extra seconds to delay each response by, at random', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stats = {}
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(Inventory(args.inventory), args.latency, args.jitter, stats))
+    server.daemon_threads = True
+    sys.stderr.write('Serving %s on http://127.0.0.1:%d\n' % (args.inventory, args.port))
+    sys.stderr.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stderr.write(json.dumps(stats, indent=2) + '\n')
+
+
+if __name__ == "__main__":
+    main()
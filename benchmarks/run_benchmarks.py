@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import sqlite3
+import platform
+import argparse
+import statistics
+import subprocess
+import urllib.request
+from datetime import datetime
+
+"""
+Benchmark the scripts end to end on synthetic inventories against a local mock Galaxy and tool shed.
+
+For each scale an inventory is generated with generate_inventory.py, mock_server.py is started on it and
+every benchmark command is run --repeat times with the workspace as the working directory and HOME, so
+that caches are kept between repeats but not between runs.  A result line is appended to --output for
+each benchmark and scale with the wall time of each repeat, the median and the median CPU time, the peak
+memory and the number of requests sent to the mock server.
+
+python benchmarks/run_benchmarks.py run --scales 1 10 --label my-change
+python benchmarks/run_benchmarks.py compare --base master --head my-change
+
+--repo_dir selects the checkout whose scripts are benchmarked, so a branch can be compared with another
+checkout using the same inventories:
+git worktree add /tmp/master master
+python benchmarks/run_benchmarks.py run --repo_dir /tmp/master --label master
+python benchmarks/run_benchmarks.py run --label branch
+python benchmarks/run_benchmarks.py compare --base master --head branch
+"""
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+default_repo_dir = os.path.abspath(os.path.join(benchmarks_dir, '..'))
+default_output = os.path.join('/tmp', 'results.jsonl')  # results are machine specific and are not committed
+api_key = 'benchmark'
+
+
+def clear(*paths):
+    def setup(workspace):
+        for path in paths:
+            path = os.path.join(workspace, path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+    return setup
+
+
+def make_dirs(*paths):
+    def setup(workspace):
+        clear(*paths)(workspace)
+        for path in paths:
+            os.makedirs(os.path.join(workspace, path))
+    return setup
+
+
+def age_cache(path, days):
+    """ Make the tool shed cache look as though it was filled days ago, i.e. before the previous weekly update """
+    def setup(workspace):
+        connection = sqlite3.connect(os.path.join(workspace, path), isolation_level=None)
+        connection.execute('UPDATE responses SET created = created - ?, accessed = accessed - ?', (days * 86400, days * 86400))
+        connection.close()
+    return setup
+
+
+def get_benchmarks(repo_dir, workspace, mock_url, manifest):
+    """ Return a list of (name, setup function, command) in the order they are run """
+    python = sys.executable
+    scripts = os.path.join(repo_dir, 'scripts')
+    organise = [
+        python, os.path.join(scripts, 'organise_request_files.py'), '--update_existing', '-s', 'usegalaxy.org.au',
+        '-o', 'updates', '-g', mock_url + '/production', '-a', api_key, '--workers', '16', '--rate_limit', '0',
+        '--cache_path', 'toolshed_cache.sqlite',
+    ]
+    report = [python, os.path.join(scripts, 'write_report_from_log.py')]
+    return [
+        ('split_tool_yml', clear('tool_list'), [python, os.path.join(scripts, 'split_tool_yml.py'), '-i', 'tool_list.yml', '--prune']),
+        ('organise_update_cold', lambda workspace: (make_dirs('updates')(workspace), clear('toolshed_cache.sqlite')(workspace)), organise),
+        ('organise_update_warm', make_dirs('updates'), organise),
+        ('organise_update_week', lambda workspace: (make_dirs('updates')(workspace), age_cache('toolshed_cache.sqlite', 7)(workspace)), organise),
+        ('check_files', None, [
+            python, os.path.join(repo_dir, '.ci', 'check_files.py'), '-f'
+        ] + sorted(os.path.relpath(path, workspace) for path in glob.glob(os.path.join(workspace, 'requests', '*.yml'))) + [
+            '-u', mock_url + '/staging', '-g', mock_url + '/production', '-s', 'staging.gvl.org.au', '-p', 'usegalaxy.org.au',
+        ]),
+        ('report_cold', clear('automated_tool_installation_log.sqlite'), report + ['-j', manifest['last_update_build'], '-o', 'report.md']),
+        ('report_warm', None, report + ['-j', manifest['last_update_build'], '-o', 'report.md']),
+        ('report_weeks', make_dirs('reports'), report + ['-w', manifest['first_date'], manifest['last_date'], '--outdir', 'reports']),
+        ('api_cold', clear('api'), [python, os.path.join(scripts, 'api.py')]),
+        ('api_incremental', None, [python, os.path.join(scripts, 'api.py')]),
+    ]
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get_stats(mock_url):
+    with urllib.request.urlopen(mock_url + '/stats') as response:
+        return json.load(response)
+
+
+def start_mock_server(inventory_path, port, latency, jitter):
+    process = subprocess.Popen([
+        sys.executable, os.path.join(benchmarks_dir, 'mock_server.py'), '-i', inventory_path, '-p', str(port),
+        '--latency', str(latency), '--jitter', str(jitter),
+    ], stderr=subprocess.DEVNULL)
+    mock_url = 'http://127.0.0.1:%d' % port
+    for i in range(600):
+        try:
+            get_stats(mock_url)
+            return process, mock_url
+        except OSError:
+            if process.poll() is not None:
+                raise Exception('Mock server exited with status %s' % process.returncode)
+            time.sleep(0.1)
+    process.kill()
+    raise Exception('Mock server did not start')
+
+
+def run_command(command, workspace, log):
+    """ Run command and return (wall seconds, cpu seconds, peak memory in MB) """
+    env = dict(os.environ, HOME=os.path.join(workspace, 'home'))
+    env.pop('REPOSITORY_SNAPSHOT_DIR', None)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workspace, env=env, stdout=log, stderr=log)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise Exception('%s exited with status %d, see %s' % (' '.join(command), process.returncode, log.name))
+    return wall_seconds, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024
+
+
+def run(args):
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=args.repo_dir, capture_output=True, text=True).stdout.strip()
+    results = []
+    for scale in args.scales:
+        workspace = os.path.join(args.workdir, 'scale_%d' % scale)
+        port = args.port or get_free_port()
+        mock_url = 'http://127.0.0.1:%d' % port
+        print('Generating inventory at scale %d in %s' % (scale, workspace))
+        # generated in another process so that the memory used is not counted in the benchmarks' peak memory
+        subprocess.run([
+            sys.executable, os.path.join(benchmarks_dir, 'generate_inventory.py'), '-s', str(scale), '-o', workspace,
+            '--tool_shed_url', mock_url + '/toolshed',
+        ], check=True, stdout=subprocess.DEVNULL)
+        with open(os.path.join(workspace, 'manifest.json')) as handle:
+            manifest = json.load(handle)
+        os.makedirs(os.path.join(workspace, 'home'))
+        process, mock_url = start_mock_server(os.path.join(workspace, 'inventory.json'), port, args.latency, args.jitter)
+        try:
+            with open(os.path.join(workspace, 'benchmark_log.txt'), 'w') as log:
+                for name, setup, command in get_benchmarks(args.repo_dir, workspace, mock_url, manifest):
+                    if args.only and name not in args.only:
+                        continue
+                    timings = []
+                    requests_before = sum(get_stats(mock_url).values())
+                    for i in range(args.repeat):
+                        if setup:
+                            setup(workspace)
+                        log.write('\n### %s scale %d repeat %d\n' % (name, scale, i + 1))
+                        log.flush()
+                        timings.append(run_command(command, workspace, log))
+                    requests = sum(get_stats(mock_url).values()) - requests_before - 1  # less the second /stats request
+                    result = {
+                        'run_id': run_id,
+                        'label': args.label,
+                        'commit': commit,
+                        'date': datetime.now().isoformat(timespec='seconds'),
+                        'host': platform.node(),
+                        'python': platform.python_version(),
+                        'benchmark': name,
+                        'scale': scale,
+                        'tools': manifest['tools'],
+                        'log_rows': manifest['log_rows'],
+                        'latency': args.latency,
+                        'seconds': [round(wall, 3) for wall, cpu, rss in timings],
+                        'median': round(statistics.median(wall for wall, cpu, rss in timings), 3),
+                        'cpu_seconds': round(statistics.median(cpu for wall, cpu, rss in timings), 3),
+                        'max_rss_mb': round(max(rss for wall, cpu, rss in timings), 1),
+                        'requests_per_run': round(max(requests, 0) / args.repeat),
+                    }
+                    print('%-22s scale %-4d %8.2fs  cpu %7.2fs  %7.1f MB  %d requests' % (
+                        name, scale, result['median'], result['cpu_seconds'], result['max_rss_mb'], result['requests_per_run']
+                    ))
+                    results.append(result)
+                    with open(args.output, 'a') as handle:
+                        handle.write(json.dumps(result) + '\n')
+        finally:
+            process.terminate()
+            process.wait()
+        if not args.keep:
+            shutil.rmtree(workspace)
+    return results
+
+
+def load_results(path):
+    with open(path) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def compare(args):
+    """ Compare the latest result of each benchmark and scale between two labels, or the last two runs """
+    if not os.path.exists(args.output):
+        sys.exit('No results in %s.  Run the benchmarks first' % args.output)
+    results = load_results(args.output)
+    if args.base and args.head:
+        base = [result for result in results if result['label'] == args.base]
+        head = [result for result in results if result['label'] == args.head]
+    else:
+        run_ids = sorted(set(result['run_id'] for result in results))
+        if len(run_ids) < 2:
+            sys.exit('At least two runs are needed to compare')
+        base = [result for result in results if result['run_id'] == run_ids[-2]]
+        head = [result for result in results if result['run_id'] == run_ids[-1]]
+    latest_base = {(result['benchmark'], result['scale']): result for result in base}
+    latest_head = {(result['benchmark'], result['scale']): result for result in head}
+    regressions = []
+    print('%-22s %6s %10s %10s %7s' % ('benchmark', 'scale', 'base', 'head', 'ratio'))
+    for key in sorted(set(latest_base) & set(latest_head)):
+        base_seconds, head_seconds = latest_base[key]['median'], latest_head[key]['median']
+        ratio = head_seconds / base_seconds if base_seconds else float('inf')
+        # small absolute differences are noise
+        regressed = ratio > args.threshold and head_seconds - base_seconds > args.min_seconds
+        print('%-22s %6d %9.2fs %9.2fs %6.2fx%s' % (key[0], key[1], base_seconds, head_seconds, ratio, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(key)
+    if regressions:
+        sys.exit('%d benchmarks are more than %.2f times slower' % (len(regressions), args.threshold))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run script benchmarks on synthetic inventories')
+    parser.add_argument('-o', '--output', help='Results file to append to or compare', default=default_output)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('-s', '--scales', help='Multiples of the real inventory size', type=int, nargs='+', default=[1, 10])
+    run_parser.add_argument('-r', '--repeat', help='Number of times to run each benchmark', type=int, default=3)
+    run_parser.add_argument('--only', help='Names of benchmarks to run', nargs='+')
+    run_parser.add_argument('--latency', help='Seconds the mock server delays each response', type=float, default=0.01)
+    run_parser.add_argument('--jitter', help='Most extra seconds of random delay', type=float, default=0.0)
+    run_parser.add_argument('--port', help='Port for the mock server.  Default is any free port', type=int)
+    run_parser.add_argument('--repo_dir', help='Checkout whose scripts are benchmarked', default=default_repo_dir)
+    run_parser.add_argument('--workdir', help='Directory for the generated inventories', default=os.path.join('/tmp', 'usegalaxy-au-benchmarks'))
+    run_parser.add_argument('--label', help='Label for the results, i.e. a branch name', default='')
+    run_parser.add_argument('--keep', help='Keep the generated inventories', action='store_true')
+    compare_parser = subparsers.add_parser('compare', help='Compare two sets of results')
+    compare_parser.add_argument('--base', help='Label of the results to compare against')
+    compare_parser.add_argument('--head', help='Label of the results to compare')
+    compare_parser.add_argument('-t', '--threshold', help='Ratio of median times counted as a regression', type=float, default=1.25)
+    compare_parser.add_argument('--min_seconds', help='Smallest slowdown in seconds counted as a regression', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        args.repo_dir = os.path.abspath(args.repo_dir)
+        args.output = os.path.abspath(args.output)
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
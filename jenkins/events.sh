@@ -0,0 +1,25 @@
+#! /bin/bash
+
+# Timing events for build steps, one line of JSON per step appended to EVENTS_LOG.  The fields are described in
+# scripts/build_events.py, which summarises them.  Events are written with a single printf so that lines from
+# background installations are not interleaved.
+
+timed() {
+  # Run a command in the current shell and record how long it took if EVENTS_LOG is set.
+  # Positional arguments: $1 = step name, remaining arguments are the command
+  local step="$1" start=$EPOCHREALTIME status
+  shift
+  "$@"
+  status=$?
+  [ "$EVENTS_LOG" ] && log_event "$step" "$start" "$EPOCHREALTIME" $status
+  return $status
+}
+
+log_event() {
+  # Positional arguments: $1 = step name, $2 = start, $3 = end (seconds since the epoch), $4 = exit status
+  local micros=$(( ${3/./} - ${2/./} )) outcome="ok"
+  [ "$4" != 0 ] && outcome="error"
+  printf '{"build": "%s", "mode": "%s", "step": "%s", "tool": "%s", "revision": "%s", "installed_revision": "%s", "server": "%s", "start": %s, "end": %s, "duration": %d.%06d, "outcome": "%s", "exit_code": %d}\n' \
+    "$BUILD_NUMBER" "$MODE" "$1" "$TOOL_NAME" "$REQUESTED_REVISION" "$INSTALLED_REVISION" "$URL" "$2" "$3" \
+    $((micros / 1000000)) $((micros % 1000000)) "$outcome" "$4" >> "$EVENTS_LOG"
+}
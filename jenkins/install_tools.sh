@@ -1,5 +1,6 @@
 #! /bin/bash
 source jenkins/utils.sh
+source jenkins/events.sh
 
 install_tools() {
   echo "Running automated tool installation script"
@@ -43,82 +44,109 @@ install_tools() {
   rm -f $ERROR_LOG ||:
   touch $ERROR_LOG
 
-  TOOL_FILE_PATH="$TMP/$BUILD_NUMBER"
+  # Tool files and the manifest are named for the requests rather than the build so that a rebuild of an
+  # interrupted build resumes it: the request files for install builds, the job and commit for update builds
+  if [ $MODE = "install" ]; then
+    REQUEST_KEY=$( (echo "$REQUEST_FILES"; cat $REQUEST_FILES) | sha1sum | cut -c1-12)
+  else
+    REQUEST_KEY=$(echo "$JOB_NAME $GIT_COMMIT" | sha1sum | cut -c1-12)
+  fi
+  TOOL_FILE_PATH="$TMP/$REQUEST_KEY"
+  # Fields of each tool file, and the tools that have been installed, for scripts/install_queue.py
+  MANIFEST="$TMP/manifest_$REQUEST_KEY.jsonl"
+  PIPELINE_DIR="$TMP/pipeline_$REQUEST_KEY"
+  [ -f $MANIFEST ] || rm -rf $TOOL_FILE_PATH  # files left by a build that stopped before writing its manifest
   mkdir -p $TOOL_FILE_PATH
 
-  if [ "$MODE" = "install" ]; then
+  # Repository lists are fetched from each server once per build and shared between scripts.
+  # Snapshots are removed whenever tools are installed or uninstalled on a server
+  export REPOSITORY_SNAPSHOT_DIR="$TMP/repository_snapshots_$BUILD_NUMBER"
+  rm -rf $REPOSITORY_SNAPSHOT_DIR ||:
+  mkdir -p $REPOSITORY_SNAPSHOT_DIR
+
+  # Revisions already installed on production are logged without running shed-tools, and revisions already
+  # installed on staging are not installed or tested there again.  Repositories are installed in order of
+  # their repository dependencies
+  organise_args="--preflight --dependency_order"
+  [ $STAGING_URL ] && organise_args="$organise_args --staging_url $STAGING_URL --staging_api_key $STAGING_API_KEY"
+  if [ -f $MANIFEST ]; then
+    # The build was interrupted: install the tools that were not completed
+    echo "Resuming an interrupted build of the same requests from $MANIFEST"
+    recover_interrupted_build
+    request_files_command="python scripts/install_queue.py -m $MANIFEST release"
+  elif [ "$MODE" = "install" ]; then
     # split requests into individual yaml files in tmp path
     # one file per unique revision so that installation can be run sequentially and
     # failure of one installation will not affect the others
-    request_files_command="python scripts/organise_request_files.py -f $REQUEST_FILES -o $TOOL_FILE_PATH -g $PRODUCTION_URL -a $PRODUCTION_API_KEY"
+    request_files_command="python scripts/organise_request_files.py -f $REQUEST_FILES -o $TOOL_FILE_PATH -m $MANIFEST -g $PRODUCTION_URL -a $PRODUCTION_API_KEY $organise_args"
   elif [ "$MODE" = "update" ]; then
-    request_files_command="python scripts/organise_request_files.py --update_existing -s $PRODUCTION_TOOL_DIR -o $TOOL_FILE_PATH -g $PRODUCTION_URL -a $PRODUCTION_API_KEY"
+    request_files_command="python scripts/organise_request_files.py --update_existing -s $PRODUCTION_TOOL_DIR -o $TOOL_FILE_PATH -m $MANIFEST -g $PRODUCTION_URL -a $PRODUCTION_API_KEY --workers ${TOOLSHED_QUERY_WORKERS:-1} $organise_args"
   fi
   {
-    $request_files_command
+    timed organise_request_files $request_files_command
   } || {
     echo "Error in organise_request_files.py"
     exit 1
   }
+  # the rows of this build are recovered from here if it is interrupted
+  echo $WORKING_INSTALLATION_LOG > ${MANIFEST%.jsonl}.log_path
 
-  # keep a count of successful installations
-  NUM_TOOLS_TO_INSTALL=$(ls $TOOL_FILE_PATH | wc -l)
+  # keep a count of successful installations, of the tools that were not completed by an interrupted build
+  NUM_TOOLS_TO_INSTALL=$(python scripts/install_queue.py -m $MANIFEST status --pending)
   INSTALLED_TOOL_COUNTER=0
   if [ $NUM_TOOLS_TO_INSTALL = 0 ]; then
     echo "Script error: nothing to install"
     exit 1
   fi
 
-  for TOOL_FILE in $TOOL_FILE_PATH/*; do
-    FILE_NAME=$(basename $TOOL_FILE)
-
-    # Extract details (tool name, owner etc) from TOOL_FILE with some grepping and brute force
-    TOOL_REF=$(echo $FILE_NAME | cut -d'.' -f 1);
-    TOOL_NAME=$(echo $TOOL_REF | cut -d '@' -f 1);
-    REQUESTED_REVISION=$(echo $TOOL_REF | cut -d '@' -f 2);
-    OWNER=$(grep -oE "owner: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-    TOOL_SHED_URL=$(grep -oE "tool_shed_url: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-    [ ! $TOOL_SHED_URL ] && TOOL_SHED_URL="toolshed.g2.bx.psu.edu"; # default value
-    SECTION_LABEL=$(grep -oE "tool_panel_section_label: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-
-    [ "$(grep '\[VERSION_UPDATE\]' $TOOL_FILE)" ] && VERSION_UPDATE=1 || VERSION_UPDATE=0; # VERSION_UPDATE means do not uninstall under any circumstances
-    # If either [FORCE] in the commit message or [VERSION_UPDATE] in the file header, skip tests for this tool
-    if [ $VERSION_UPDATE = 1 ] || [ $FORCE = 1 ]; then
-      SKIP_TESTS=1
-    else
-      SKIP_TESTS=0
-    fi
+  # Install the conda packages of tools with a single requirement on each server, PREWARM_WORKERS at a time,
+  # before the tools
+  if [ "${PREWARM_WORKERS:-0}" -gt 0 ]; then
+    for PREWARM_SERVER in STAGING PRODUCTION; do
+      set_url $PREWARM_SERVER
+      [ $URL ] || continue
+      [ $PREWARM_SERVER = "STAGING" ] && staging_arg="--staging" || staging_arg=""
+      timed prewarm_dependencies python scripts/prewarm_dependencies.py -g $URL -a $API_KEY -m $MANIFEST $staging_arg \
+        --workers $PREWARM_WORKERS --build_number $BUILD_NUMBER ${EVENTS_LOG:+--events_log $EVENTS_LOG} &
+    done
+    wait
+  fi
 
-    # Find out whether tool/owner combination already exists on galaxy.  This makes no difference to the installation process but
-    # is useful for the log
-    TOOL_IS_NEW="False"
-    if [ $MODE == "install" ]; then
-      TOOL_IS_NEW=$(python scripts/is_tool_new.py -g $PRODUCTION_URL -a $PRODUCTION_API_KEY -n $TOOL_NAME -o $OWNER)
+  # With INSTALL_WORKERS > 1 several tools are taken through the install/test steps at once.  Each
+  # tool runs in a background subshell that writes its log rows, errors, console output and count
+  # to PIPELINE_DIR.  These are collected in the original order once all tools have finished.
+  INSTALL_WORKERS=${INSTALL_WORKERS:-1}
+  rm -rf $PIPELINE_DIR ||:
+  mkdir -p $PIPELINE_DIR
+  TOOL_TMP=$TMP
+
+  # Each claim sets TOOL_FILE and the fields of the tool from the manifest.  A tool is not claimed until the
+  # tools it depends on have been completed: claim exits with status 2 while they are being installed
+  TOOL_INDEX=0
+  while true; do
+    while [ $INSTALL_WORKERS -gt 1 ] && [ $(jobs -rp | wc -l) -ge $INSTALL_WORKERS ]; do
+      sleep 5
+    done
+    QUEUE_ENTRY=$(python scripts/install_queue.py -m $MANIFEST claim)
+    CLAIM_STATUS=$?
+    if [ $CLAIM_STATUS = 2 ]; then
+      sleep 5
+      continue
+    fi
+    [ $CLAIM_STATUS = 0 ] || break
+    eval "$QUEUE_ENTRY"
+    TOOL_INDEX=$((TOOL_INDEX+1))
+    if [ $INSTALL_WORKERS -gt 1 ]; then
+      install_tool_file_in_background $TOOL_INDEX &
+    else
+      install_queued_tool_file
     fi
-
-    unset STAGING_TESTS_PASSED PRODUCTION_TESTS_PASSED; # ensure these values do not carry over from previous iterations of the loop
-
-    echo -e "\nInstalling $TOOL_NAME from file $TOOL_FILE"
-    cat $TOOL_FILE
-
-    {
-      if [ $STAGING_URL ]; then
-        echo -e "\nStep (1): Installing $TOOL_NAME on staging server";
-        install_tool "STAGING"
-      fi
-    } && {
-      if [ $STAGING_URL ]; then
-        echo -e "\nStep (2): Testing $TOOL_NAME on staging server";
-        test_tool "STAGING"
-      fi
-    } && {
-      echo -e "\nStep (3): Installing $TOOL_NAME on production server";
-      install_tool "PRODUCTION"
-    } && {
-      echo -e "\nStep (4): Testing $TOOL_NAME on production server";
-      test_tool "PRODUCTION"
-    }
   done
+  if [ $INSTALL_WORKERS -gt 1 ]; then
+    wait
+    collect_pipeline_results
+  fi
+  rm -rf $PIPELINE_DIR
 
   git pull # update repo before changing tracked files
 
@@ -137,12 +165,13 @@ install_tools() {
   COMMIT_FILES=("$AUTOMATED_TOOL_INSTALLATION_LOG")
 
   # Update tool .yml files to reflect current state of galaxy tools
-  update_tool_list "STAGING"
-  update_tool_list "PRODUCTION"
+  timed update_tool_list update_tool_list "STAGING"
+  timed update_tool_list update_tool_list "PRODUCTION"
 
   # Push changes to github
-  # Add all existing .yml files to commit files list
-  for FILE in $STAGING_TOOL_DIR/* $PRODUCTION_TOOL_DIR/*; do
+  # Add new and modified .yml files to commit files list
+  for FILE in $(git ls-files --modified --others --exclude-standard $STAGING_TOOL_DIR $PRODUCTION_TOOL_DIR); do
+    [ -f $FILE ] || continue  # deleted files are added below
     git add $FILE
     COMMIT_FILES+=("$FILE")
   done
@@ -188,31 +217,156 @@ install_tools() {
     git checkout master
   fi
   rm -r $TOOL_FILE_PATH
+  rm -f $MANIFEST ${MANIFEST%.jsonl}.state.jsonl ${MANIFEST%.jsonl}.log_path
+  rm -rf $REPOSITORY_SNAPSHOT_DIR
 
   echo -e "\nDone"
 }
 
+recover_interrupted_build() {
+  # Add the rows that an interrupted build logged for the tools it completed to this build's logs, as
+  # those tools are not installed again
+  PREVIOUS_LOG=$(cat ${MANIFEST%.jsonl}.log_path 2>/dev/null)
+  if [ -f "$PREVIOUS_LOG" ] && [ "$PREVIOUS_LOG" != "$WORKING_INSTALLATION_LOG" ]; then
+    cat $PREVIOUS_LOG >> $WORKING_INSTALLATION_LOG
+  fi
+  # rows of background installations are only in PIPELINE_DIR until all tools have finished
+  COMPLETED_ITEMS=$(python scripts/install_queue.py -m $MANIFEST status --complete)
+  for TOOL_TMP in $PIPELINE_DIR/*/; do
+    [ -f $TOOL_TMP/queue_item ] && echo "$COMPLETED_ITEMS" | grep -qxF "$(cat $TOOL_TMP/queue_item)" || continue
+    [ -f $TOOL_TMP/installation_log.tsv ] && cat $TOOL_TMP/installation_log.tsv >> $WORKING_INSTALLATION_LOG
+    [ -f $TOOL_TMP/error_log.txt ] && cat $TOOL_TMP/error_log.txt >> $ERROR_LOG
+  done
+  TOOL_TMP=$TMP
+}
+
+install_queued_tool_file() {
+  # Install the claimed tool and mark it as complete in the manifest so that a resumed build skips it
+  timed tool install_tool_file
+  python scripts/install_queue.py -m $MANIFEST complete $QUEUE_ITEM --exit_code $?
+}
+
+install_tool_file() {
+  # Install and test the tool in TOOL_FILE on staging and production.  TOOL_NAME, OWNER, REQUESTED_REVISION, RESOLVED_REVISION,
+  # TOOL_SHED_URL, SECTION_LABEL and VERSION_UPDATE are set from the manifest when the tool is claimed.
+  # VERSION_UPDATE means do not uninstall under any circumstances
+  # If either [FORCE] in the commit message or [VERSION_UPDATE] in the file header, skip tests for this tool
+  if [ $VERSION_UPDATE = 1 ] || [ $FORCE = 1 ]; then
+    SKIP_TESTS=1
+  else
+    SKIP_TESTS=0
+  fi
+
+  # Find out whether tool/owner combination already exists on galaxy.  This makes no difference to the installation process but
+  # is useful for the log
+  TOOL_IS_NEW="False"
+  if [ $MODE == "install" ] && [ "$PREFLIGHT" != "already_installed" ]; then
+    TOOL_IS_NEW=$(python scripts/is_tool_new.py -g $PRODUCTION_URL -a $PRODUCTION_API_KEY -n $TOOL_NAME -o $OWNER)
+  fi
+
+  unset STAGING_TESTS_PASSED PRODUCTION_TESTS_PASSED; # ensure these values do not carry over from previous iterations of the loop
+
+  if [ "$PREFLIGHT" = "already_installed" ]; then
+    # organise_request_files.py found this revision on production: log it as shed-tools would have reported it
+    echo -e "\n$TOOL_NAME@$RESOLVED_REVISION is already installed on $PRODUCTION_URL"
+    STEP="Production Installation"
+    INSTALLATION_STATUS="Skipped"
+    INSTALLED_NAME=$TOOL_NAME
+    INSTALLED_REVISION=$RESOLVED_REVISION
+    if [ $MODE = "install" ]; then
+      log_row "Already Installed"
+      exit_installation 1 "Package is already installed"
+    fi
+    rm $TOOL_FILE;
+    return 1
+  fi
+
+  echo -e "\nInstalling $TOOL_NAME from file $TOOL_FILE"
+  cat $TOOL_FILE
+
+  # When tools are processed concurrently, installations are run one at a time on each server
+  # and production tests are run one at a time.  Staging tests may overlap other installations.
+  {
+    if [ $STAGING_URL ] && [ "$PREFLIGHT" != "staging_installed" ]; then
+      echo -e "\nStep (1): Installing $TOOL_NAME on staging server";
+      with_lock "STAGING" install_tool "STAGING"
+    fi
+  } && {
+    if [ $STAGING_URL ] && [ "$PREFLIGHT" != "staging_installed" ]; then
+      echo -e "\nStep (2): Testing $TOOL_NAME on staging server";
+      test_tool "STAGING"
+    fi
+  } && {
+    echo -e "\nStep (3): Installing $TOOL_NAME on production server";
+    with_lock "PRODUCTION" install_tool "PRODUCTION"
+  } && {
+    echo -e "\nStep (4): Testing $TOOL_NAME on production server";
+    with_lock "PRODUCTION" test_tool "PRODUCTION"
+  }
+}
+
+install_tool_file_in_background() {
+  # Positional argument: $1 = index of TOOL_FILE within TOOL_FILE_PATH
+  INDEX=$(printf "%06d" $1)
+  TOOL_TMP="$PIPELINE_DIR/$INDEX"
+  mkdir -p $TOOL_TMP
+  echo $QUEUE_ITEM > "$TOOL_TMP/queue_item"
+  WORKING_INSTALLATION_LOG="$TOOL_TMP/installation_log.tsv"
+  ERROR_LOG="$TOOL_TMP/error_log.txt"
+  INSTALLED_TOOL_COUNTER=0
+  install_queued_tool_file > "$TOOL_TMP/output.txt" 2>&1
+  echo $INSTALLED_TOOL_COUNTER > "$TOOL_TMP/installed_count"
+  with_lock "OUTPUT" cat "$TOOL_TMP/output.txt"
+}
+
+collect_pipeline_results() {
+  # Append results from background installations to the build's logs in the order of TOOL_FILE_PATH
+  for TOOL_TMP in $PIPELINE_DIR/*/; do
+    [ -f $TOOL_TMP/installation_log.tsv ] && cat $TOOL_TMP/installation_log.tsv >> $WORKING_INSTALLATION_LOG
+    [ -f $TOOL_TMP/error_log.txt ] && cat $TOOL_TMP/error_log.txt >> $ERROR_LOG
+    [ -f $TOOL_TMP/installed_count ] && INSTALLED_TOOL_COUNTER=$((INSTALLED_TOOL_COUNTER+$(cat $TOOL_TMP/installed_count)))
+  done
+  TOOL_TMP=$TMP
+}
+
+with_lock() {
+  # Run a command in the current shell while holding a lock shared by all background installations.
+  # Locks may be nested: the PRODUCTION lock is held while the STAGING lock is taken, never the reverse.
+  # Positional arguments: $1 = lock name, remaining arguments are the command
+  local LOCK_NAME="$1" LOCK_FD LOCK_STATUS
+  shift
+  if [ ${INSTALL_WORKERS:-1} -gt 1 ]; then
+    exec {LOCK_FD}>"$PIPELINE_DIR/$LOCK_NAME.lock"
+    timed "lock_wait_${LOCK_NAME,,}" flock $LOCK_FD
+  fi
+  "$@"
+  LOCK_STATUS=$?
+  [ $LOCK_FD ] && exec {LOCK_FD}>&-  # closing the file descriptor releases the lock
+  return $LOCK_STATUS
+}
+
 install_tool() {
   # Positional argument: $1 = STAGING|PRODUCTION
   SERVER="$1"
   set_url $SERVER
   STEP="$(title $SERVER) Installation"; # Production Installation or Staging Installation
 
-  INSTALL_LOG="$TMP/install_log.txt"
+  INSTALL_LOG="$TOOL_TMP/install_log.txt"
   rm -f $INSTALL_LOG ||:;  # delete if it already exists
 
   # Wait for galaxy and toolshed
   echo "Waiting for $URL";
-  galaxy-wait -g $URL
+  timed galaxy_wait galaxy-wait -g $URL
   echo "Waiting for https://${TOOL_SHED_URL}";
-  galaxy-wait -g "https://${TOOL_SHED_URL}"
+  timed toolshed_wait galaxy-wait -g "https://${TOOL_SHED_URL}"
 
   # Ephemeris install script
   command="shed-tools install -g $URL -a $API_KEY -t $TOOL_FILE -v --log_file $INSTALL_LOG --install_tool_dependencies"
   echo "${command/$API_KEY/<API_KEY>}"; # substitute API_KEY for printing
   {
-    $command
+    timed shed_tools_install $command
   } || {
+    invalidate_repository_snapshot
     log_row "Shed-tools error"; # well not really, more likely a connection error while running shed-tools
     log_error $LOG_FILE
     exit_installation 1
@@ -220,14 +374,15 @@ install_tool() {
   }
 
   # Capture the status (Installed/Skipped/Errored), name and revision hash from ephemeris output
-  SHED_TOOLS_VALUES=($(python scripts/first_match_regex.py -p "(\w+) repositories \(1\): \[\('([^']+)',\s*u?'(\w+)'\)\]" $INSTALL_LOG));
-  if [[ "${SHED_TOOLS_VALUES[*]}" ]]; then
-    INSTALLATION_STATUS="${SHED_TOOLS_VALUES[0]}";
-    INSTALLED_NAME="${SHED_TOOLS_VALUES[1]}";
-    INSTALLED_REVISION="${SHED_TOOLS_VALUES[2]}";
+  eval "$(python scripts/parse_shed_tools_log.py --type install --prefix SHED_TOOLS_ $INSTALL_LOG)"
+  if [ "$SHED_TOOLS_STATUS" ]; then
+    INSTALLATION_STATUS="$SHED_TOOLS_STATUS";
+    INSTALLED_NAME="$SHED_TOOLS_NAME";
+    INSTALLED_REVISION="$SHED_TOOLS_REVISION";
   fi
-  ALREADY_INSTALLED=$(python scripts/first_match_regex.py -p "Repository (\w+) is already installed" $INSTALL_LOG);
+  ALREADY_INSTALLED="$SHED_TOOLS_ALREADY_INSTALLED";
   [ $ALREADY_INSTALLED ] && INSTALLATION_STATUS="Skipped";
+  [ "$INSTALLATION_STATUS" != "Skipped" ] && invalidate_repository_snapshot
   # fi
 
   if [ ! "$INSTALLATION_STATUS" ] || [ ! "$INSTALLED_NAME" ] || [ ! "$INSTALLED_REVISION" ]; then
@@ -288,34 +443,53 @@ test_tool() {
     return 0
   fi
 
-  TEST_LOG="$TMP/test_log.txt"
+  TEST_LOG="$TOOL_TMP/test_log.txt"
   rm -f $TEST_LOG ||:;  # delete file if it exists
 
-  sleep 120s; # Allow time for handlers to catch up
-
-  # Wait for galaxy
+  # Wait for galaxy, then poll until the newly installed tools are loaded
   echo "Waiting for $URL";
-  galaxy-wait -g $URL
-
-  TOOL_PARAMS="--name $TOOL_NAME --owner $OWNER --revisions $INSTALLED_REVISION --toolshed $TOOL_SHED_URL"
-  command="shed-tools test -g $URL -a $API_KEY $TOOL_PARAMS --test_json $TEST_JSON -v --log_file $TEST_LOG"
-  echo "${command/$API_KEY/<API_KEY>}"
-  {
-    $command
-  } || {
-    log_row "Shed-tools test error";
-    log_error $LOG_FILE
-    exit_installation 1
-    return 1
+  timed galaxy_wait galaxy-wait -g $URL
+  echo "Waiting for tools from $TOOL_NAME revision $INSTALLED_REVISION to load on $URL";
+  timed wait_for_tools python scripts/wait_for_tools.py -g $URL -a $API_KEY -n $TOOL_NAME -o $OWNER -r $INSTALLED_REVISION -t $TOOL_SHED_URL --timeout ${TOOL_READY_TIMEOUT:-300} || {
+    echo "WARNING: Tools from $TOOL_NAME revision $INSTALLED_REVISION are not all loaded.  Running tests anyway."
   }
 
-  # use python regex helper to get test results from shed-tools log
-  TESTS_PASSED="$(python scripts/first_match_regex.py -p 'Passed tool tests \((\d+)\)' $TEST_LOG)"
-  TESTS_FAILED="$(python scripts/first_match_regex.py -p 'Failed tool tests \((\d+)\)' $TEST_LOG)"
+  # Results are stored by repository revision, server and dependency environment.  With REUSE_TEST_RESULTS=1
+  # a passing result that is still valid is used instead of running the tests again
+  unset TEST_RESULT_KEY REUSED_TESTS_PASSED REUSED_TESTS_FAILED REUSED_BUILD
+  if [ "$TEST_RESULT_DIR" ]; then
+    [ "$REUSE_TEST_RESULTS" = 1 ] && reuse_arg="--reuse" || reuse_arg=""
+    eval "$(python scripts/test_results.py --store_dir $TEST_RESULT_DIR lookup -g $URL -a $API_KEY -n $TOOL_NAME -o $OWNER \
+      -r $INSTALLED_REVISION -t $TOOL_SHED_URL $reuse_arg --test_json $TEST_JSON)"
+  fi
+
+  if [ "$REUSED_TESTS_PASSED" ]; then
+    echo "Reusing test results for $TOOL_NAME at revision $INSTALLED_REVISION on $URL from build $REUSED_BUILD"
+    TESTS_PASSED=$REUSED_TESTS_PASSED
+    TESTS_FAILED=$REUSED_TESTS_FAILED
+    REUSED=" (reused)"
+  else
+    TOOL_PARAMS="--name $TOOL_NAME --owner $OWNER --revisions $INSTALLED_REVISION --toolshed $TOOL_SHED_URL"
+    command="shed-tools test -g $URL -a $API_KEY $TOOL_PARAMS --test_json $TEST_JSON -v --log_file $TEST_LOG"
+    echo "${command/$API_KEY/<API_KEY>}"
+    {
+      timed shed_tools_test $command
+    } || {
+      log_row "Shed-tools test error";
+      log_error $LOG_FILE
+      exit_installation 1
+      return 1
+    }
+
+    # get test results from shed-tools log, sets TESTS_PASSED and TESTS_FAILED
+    eval "$(python scripts/parse_shed_tools_log.py --type test $TEST_LOG)"
+    [ "$TEST_RESULT_KEY" ] && python scripts/test_results.py --store_dir $TEST_RESULT_DIR record -k $TEST_RESULT_KEY -l $TEST_LOG -j $TEST_JSON -b $BUILD_NUMBER
+    REUSED=""
+  fi
 
-  # Proportion of tests passed for logs
-  [ $SERVER = "STAGING" ] && STAGING_TESTS_PASSED="$TESTS_PASSED/$(($TESTS_PASSED+$TESTS_FAILED))";
-  [ $SERVER = "PRODUCTION" ] && PRODUCTION_TESTS_PASSED="$TESTS_PASSED/$(($TESTS_PASSED+$TESTS_FAILED))";
+  # Proportion of tests passed for logs, marked (reused) if the tests were not run
+  [ $SERVER = "STAGING" ] && STAGING_TESTS_PASSED="$TESTS_PASSED/$(($TESTS_PASSED+$TESTS_FAILED))$REUSED";
+  [ $SERVER = "PRODUCTION" ] && PRODUCTION_TESTS_PASSED="$TESTS_PASSED/$(($TESTS_PASSED+$TESTS_FAILED))$REUSED";
 
   if [ $TESTS_FAILED = 0 ]; then
     if [ $TESTS_PASSED = 0 ]; then
@@ -347,15 +521,22 @@ uninstall_tool() {
     echo "This tool cannot be uninstalled as the version is already installed."
   else
     echo "Waiting for $URL"
-    galaxy-wait -g $URL
-    echo "Uninstalling on $URL"
-    python scripts/uninstall_tools.py -g $URL -a $API_KEY -n "$INSTALLED_NAME@$INSTALLED_REVISION";
+    timed galaxy_wait galaxy-wait -g $URL
+    UNINSTALL_SERVERS=()
     if [ $SERVER = "PRODUCTION" ]; then
       # also uninstall on staging
       echo "Waiting for $STAGING_URL"
-      galaxy-wait -g $STAGING_URL
-      echo "Uninstalling on $STAGING_URL";
-      python scripts/uninstall_tools.py -g $STAGING_URL -a $STAGING_API_KEY -n "$INSTALLED_NAME@$INSTALLED_REVISION";
+      timed galaxy_wait galaxy-wait -g $STAGING_URL
+      UNINSTALL_SERVERS=(--server $STAGING_URL $STAGING_API_KEY)
+    fi
+    echo "Uninstalling $INSTALLED_NAME@$INSTALLED_REVISION"
+    # the revision is looked up on the servers rather than in a snapshot that may predate its installation
+    uninstall_command="python scripts/uninstall_tools.py -g $URL -a $API_KEY ${UNINSTALL_SERVERS[*]} -n $INSTALLED_NAME@$INSTALLED_REVISION --refresh_snapshot"
+    if [ $SERVER = "PRODUCTION" ]; then
+      # the caller holds the PRODUCTION lock, staging also has to be locked
+      with_lock "STAGING" timed uninstall $uninstall_command
+    else
+      timed uninstall $uninstall_command
     fi
   fi
 }
@@ -390,17 +571,35 @@ update_tool_list() {
   SERVER="$1" # This argument is required.  This script will exit if it is not either "STAGING" or "PRODUCTION"
   set_url $SERVER
 
-  TMP_TOOL_FILE="$TMP/tool_list.yml"
-  rm -f $TMP_TOOL_FILE ||:; # remove temp file if it exists
   [ -d $TOOL_DIR ] || mkdir $TOOL_DIR;  # make directory if it does not exist
-  rm $TOOL_DIR/*; # Delete tool files to replace them with split_tool_yml output
   echo "Waiting for $URL";
   galaxy-wait -g $URL
+
+  # Apply only the repositories from this build's log to the tool files unless a full update is requested
+  if [ "$TOOL_LIST_UPDATE" != "full" ] && [ "$(ls $TOOL_DIR)" ]; then
+    if [ ! -f $WORKING_INSTALLATION_LOG ]; then
+      echo "No changes to $TOOL_DIR"
+      return 0
+    fi
+    python scripts/update_tool_dir.py -g $URL -a $API_KEY -d $TOOL_DIR -l $WORKING_INSTALLATION_LOG && return 0
+    echo "Could not update $TOOL_DIR from installation log.  Fetching full tool list."
+  fi
+
+  TMP_TOOL_FILE="$TOOL_TMP/tool_list_$SERVER.yml"
+  rm -f $TMP_TOOL_FILE ||:; # remove temp file if it exists
   get-tool-list -g $URL -a $API_KEY -o $TMP_TOOL_FILE --get_all_tools
-  python scripts/split_tool_yml.py -i $TMP_TOOL_FILE -o $TOOL_DIR; # Simon's script
+  python scripts/split_tool_yml.py -i $TMP_TOOL_FILE -o $TOOL_DIR --prune; # Simon's script
   rm $TMP_TOOL_FILE
 }
 
+invalidate_repository_snapshot() {
+  # Remove the snapshot of the repository list for $URL after tools have been installed.  The generation
+  # file is appended to while locked so that a snapshot fetched during the installation is not saved
+  # (see get_repository_snapshot in scripts/utils.py)
+  SNAPSHOT="$REPOSITORY_SNAPSHOT_DIR/$(basename $URL).json"
+  flock "$SNAPSHOT.generation" sh -c 'echo >> "$1.generation"; rm -f "$1"' sh "$SNAPSHOT"
+}
+
 set_url() {
   # Set URL, API_KEY, variables that differ between staging and production
   SERVER="$1"
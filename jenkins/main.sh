@@ -63,7 +63,9 @@ mkdir -p $LOG_DIR/staging;  # staging test json output
 mkdir -p $LOG_DIR/production;  # production test json output
 mkdir -p $LOG_DIR/planemo;  # planemo html output tools that fail tests
 WORKING_INSTALLATION_LOG="${LOG_DIR}/installation_log.tsv";
+[ ! $TEST_RESULT_DIR ] && TEST_RESULT_DIR=${BASE_LOG_DIR}/test_results;  # test results kept between builds
 LOG_FILE="${LOG_DIR}/install_log.txt"
+EVENTS_LOG="${LOG_DIR}/events.jsonl"; # timing of each step, see scripts/build_events.py
 
 activate_virtualenv
 echo "Saving output to $LOG_FILE"
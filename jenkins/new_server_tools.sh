@@ -10,19 +10,13 @@ if [ ! $URL ] || [ ! $API_KEY ] || [ ! $LOG_DIR ]; then
 fi
 
 . ~/jobs_common/.venv3/bin/activate
+source jenkins/events.sh
 
 # Log file of all installations
 INSTALLATION_LOG=${LOG_DIR}/installation_log.tsv
-LOG_HEADER="Build Num.\tDate (AEST)\tName\tStatus\tOwner\tInstalled Revision\tRequested Revision\tTests passed\Section Label\tTool Shed URL"
-
-TEST_PLACEHOLDER="tests_pending"
-
-log_row() {
-  STATUS="$1"
-  DATE=$(env TZ="Australia/Queensland" date "+%d/%m/%y %H:%M:%S")
-  LOG_ROW="$BUILD_NUMBER\t$DATE\t$TOOL_NAME\t$STATUS\t$OWNER\t$INSTALLED_REVISION\t$REQUESTED_REVISION\t$TEST_PLACEHOLDER\t$SECTION_LABEL\t$TOOL_SHED_URL"
-  echo -e $LOG_ROW >> $LOCAL_INSTALL_TSV
-}
+EVENTS_LOG=${LOG_DIR}/events.jsonl  # timing of each step, see scripts/build_events.py
+MODE=bootstrap
+LOG_HEADER="Build Num.\tDate (AEST)\tName\tStatus\tOwner\tInstalled Revision\tRequested Revision\tTests passed\tSection Label\tTool Shed URL"
 
 # Ensure log file exists, create it if not
 [ ! -d $LOG_DIR ] && mkdir -p $LOG_DIR;
@@ -41,102 +35,33 @@ ERROR_TOOL_PATH=${FILES_DIR}/error
 mkdir -p $TOOL_FILE_PATH
 mkdir -p $ERROR_TOOL_PATH
 
-# keep all install info in FILES_DIR then add test results in test loop
-LOCAL_INSTALL_TSV=${FILES_DIR}/install_log.tsv
-
 [ "$SKIP_LIST" ] && skip_list_arg="--skip_list $SKIP_LIST" || skip_list_arg=""
-python scripts/organise_request_files.py -f $INSTALL_FILE -o $TOOL_FILE_PATH $skip_list_arg
-
-for TOOL_FILE in $TOOL_FILE_PATH/*; do
-  FILE_NAME=$(basename $TOOL_FILE)
-
-  TOOL_REF=$(echo $FILE_NAME | cut -d'.' -f 1);
-  TOOL_NAME=$(echo $TOOL_REF | cut -d '@' -f 1);
-  REQUESTED_REVISION=$(echo $TOOL_REF | cut -d '@' -f 2);
-  OWNER=$(grep -oE "owner: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-  TOOL_SHED_URL=$(grep -oE "tool_shed_url: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-  [ ! $TOOL_SHED_URL ] && TOOL_SHED_URL="toolshed.g2.bx.psu.edu"; # default value
-  SECTION_LABEL=$(grep -oE "tool_panel_section_label: .*$" "$TOOL_FILE" | cut -d ':' -f 2 | xargs);
-
-  INSTALL_LOG=${FILES_DIR}/${TOOL_NAME}@${REQUESTED_REVISION}_install_log.txt
-
-  # Ping galaxy url and toolshed url
-  echo -e "\n[$(env TZ="Australia/Queensland" date "+%d/%m/%y %H:%M:%S")]"
-  echo "Waiting for $URL";
-  galaxy-wait -g $URL
-  echo "Waiting for https://${TOOL_SHED_URL}";
-  galaxy-wait -g "https://${TOOL_SHED_URL}"
-
-  # Ephemeris install script
-  command="shed-tools install -g $URL -a $API_KEY -t $TOOL_FILE --install_tool_dependencies -v --log_file $INSTALL_LOG"
-  echo "${command/$API_KEY/<API_KEY>}"; # substitute API_KEY for printing
-  $command
-
-  # Capture the status (Installed/Skipped/Errored), name and revision hash from ephemeris output
-  SHED_TOOLS_VALUES=($(python scripts/first_match_regex.py -p "(\w+) repositories \(1\): \[\('([^']+)',\s*u?'(\w+)'\)\]" $INSTALL_LOG));
-  if [[ "${SHED_TOOLS_VALUES[*]}" ]]; then
-    INSTALLATION_STATUS="${SHED_TOOLS_VALUES[0]}";
-    INSTALLED_NAME="${SHED_TOOLS_VALUES[1]}";
-    INSTALLED_REVISION="${SHED_TOOLS_VALUES[2]}";
-  fi
-  ALREADY_INSTALLED=$(python scripts/first_match_regex.py -p "Repository (\w+) is already installed" $INSTALL_LOG);
-  [ $ALREADY_INSTALLED ] || [ "$INSTALLATION_STATUS" = "Skipped" ] && INSTALLATION_STATUS="Already Installed";
-
-  # INSTALLATION_STATUS can have one of 3 values: Installed, Already Installed, Errored
-  if [ ! "$INSTALLATION_STATUS" ] || [ "$INSTALLATION_STATUS" = "Errored" ]; then
-    [ ! "$INSTALLATION_STATUS" ] && INSTALLATION_STATUS="Script Error"
-    # The tool may or may not be installed according to the API, so it needs to be
-    # uninstalled with bioblend
-    echo "Winding back installation due to API error."
-    python scripts/uninstall_tools.py -g $URL -a $API_KEY -n "$INSTALLED_NAME@$INSTALLED_REVISION";
-    # In the case of installation errors there may be conda create process running that do not terminate
-    # kill any conda create processes that are running. TODO: ensure that this file exists
-    ssh jenkins_bot@$(basename $URL) "sudo bash /home/jenkins_bot/kill_conda_create.sh"
-    log_row "$INSTALLATION_STATUS"
-    mv $TOOL_FILE $ERROR_TOOL_PATH
-  elif [ "$INSTALLATION_STATUS" = "Already Installed" ] || [ "$INSTALLATION_STATUS" = "Installed" ]; then
-    # exit_installation 0 ""
-    log_row "$INSTALLATION_STATUS"
-    rm $TOOL_FILE;
-  fi
-done
-
-sleep 20s
-# run tests
-cat $LOCAL_INSTALL_TSV | while read line || [[ -n $line ]]; do
-  IFS=$'\t' read -ra words <<< "$line";
-  TOOL_PARAMS="--name ${words[2]} --owner ${words[4]} --revisions ${words[6]} --toolshed ${words[9]}"
-
-  TEST_LOG=${FILES_DIR}/${words[2]}@${words[5]}_test_log.txt
-  TEST_JSON=${FILES_DIR}/${words[2]}@${words[5]}_test.json
-
-  unset TESTS_PASSED; # ensure these values do not carry over from previous iterations of the loop
-
-  # Ping galaxy url
-  echo -e "\n[$(env TZ="Australia/Queensland" date "+%d/%m/%y %H:%M:%S")]"
-  echo "Waiting for $URL";
-  galaxy-wait -g $URL
-
-  command="shed-tools test -g $URL -a $API_KEY $TOOL_PARAMS --parallel_tests 4 --test_json $TEST_JSON -v --log_file $TEST_LOG"
-  echo "${command/$API_KEY/<API_KEY>}"
-  {
-    $command
-
-    # use python regex helper to get test results from shed-tools log
-    TESTS_PASSED="$(python scripts/first_match_regex.py -p 'Passed tool tests \((\d+)\)' $TEST_LOG)"
-    TESTS_FAILED="$(python scripts/first_match_regex.py -p 'Failed tool tests \((\d+)\)' $TEST_LOG)"
-    TESTS_PASSED="$TESTS_PASSED/$(($TESTS_PASSED+$TESTS_FAILED))";
-    } || {
-      TESTS_PASSED="Shed-tools error"
-    }
-
-    echo "${line/$TEST_PLACEHOLDER/$TESTS_PASSED}" >> $INSTALLATION_LOG
-done
+MANIFEST=${FILES_DIR}/manifest.jsonl
+timed organise_request_files python scripts/organise_request_files.py -f $INSTALL_FILE -o $TOOL_FILE_PATH -m $MANIFEST $skip_list_arg
+
+# Install the conda packages the tools need before the tools, so that fewer installations wait on conda
+[ "${PREWARM_WORKERS:-0}" -gt 0 ] && timed prewarm_dependencies python scripts/prewarm_dependencies.py -g $URL -a $API_KEY -m $MANIFEST \
+  --workers $PREWARM_WORKERS --build_number $BUILD_NUMBER --events_log $EVENTS_LOG
+
+# Install tools with a pool of workers, in order of repository dependencies, and test each tool as soon as it is
+# installed.  Completed steps are recorded in a journal kept between builds so that a restarted build skips tools
+# that have already been installed and tested.  Test json files from earlier builds are used to start the longest
+# tests first and to choose how many tools to test at once within GALAXY_TEST_CAPACITY jobs
+JOURNAL=${LOG_DIR}/${INSTALL_FILE_REF}_journal.jsonl
+[ "$REUSE_TEST_RESULTS" = 1 ] && reuse_arg="--reuse_test_results" || reuse_arg=""
+[ "$BOOTSTRAP_TEST_WORKERS" ] && test_workers_arg="--test_workers $BOOTSTRAP_TEST_WORKERS" || test_workers_arg=""
+timed bootstrap python scripts/bootstrap_server.py -g $URL -a $API_KEY -d $TOOL_FILE_PATH -m $MANIFEST -l $INSTALLATION_LOG -j $JOURNAL \
+  -b $BUILD_NUMBER --files_dir $FILES_DIR --error_dir $ERROR_TOOL_PATH \
+  --install_workers ${BOOTSTRAP_INSTALL_WORKERS:-2} $test_workers_arg \
+  --history_dir $LOG_DIR --galaxy_capacity ${GALAXY_TEST_CAPACITY:-16} \
+  --test_result_dir ${TEST_RESULT_DIR:-$LOG_DIR/test_results} $reuse_arg \
+  --tool_ready_timeout ${TOOL_READY_TIMEOUT:-300} --events_log $EVENTS_LOG \
+  --kill_conda_command "ssh jenkins_bot@$(basename $URL) \"sudo bash /home/jenkins_bot/kill_conda_create.sh\""
 
 # consolidate all json and planemo test reports for this run
 # store these at ground level in the log directory
 AMALGAMATED_TOOL_TEST_JSON=${LOG_DIR}/build_${BUILD_NUMBER}_${INSTALL_FILE_REF}_tool_test.json
 AMALGAMATED_TOOL_TEST_HTML=${LOG_DIR}/build_${BUILD_NUMBER}_${INSTALL_FILE_REF}_tool_test.html
 
-planemo merge_test_reports $(find ${FILES_DIR} -name '*test.json') ${AMALGAMATED_TOOL_TEST_JSON}
-planemo test_reports ${AMALGAMATED_TOOL_TEST_JSON}  --test_output ${AMALGAMATED_TOOL_TEST_HTML}
+timed merge_test_reports planemo merge_test_reports $(find ${FILES_DIR} -name '*test.json') ${AMALGAMATED_TOOL_TEST_JSON}
+timed test_reports planemo test_reports ${AMALGAMATED_TOOL_TEST_JSON}  --test_output ${AMALGAMATED_TOOL_TEST_HTML}
@@ -10,6 +10,9 @@ if [ ! $URL ] || [ ! $API_KEY ] || [ ! $LOG_DIR ]; then
     exit 1;
 fi
 
+# run as many tests at once as the server can take, unless test json files from earlier builds show there are fewer tests
+PARALLEL_TESTS=$(python scripts/test_scheduler.py --history_dir $LOG_DIR -c ${GALAXY_TEST_CAPACITY:-16} parallel_tests -t $TOOL_FILE || echo 4)
+
 LOG_DIR=${LOG_DIR}/build_${BUILD_NUMBER}
 mkdir -p $LOG_DIR
 
@@ -20,5 +23,5 @@ TEST_HTML=${LOG_DIR}/${SECTION}_test.html
 cp $TOOL_FILE ${LOG_DIR}/$(basename $TOOL_FILE)
 
 shed-tools install -g ${URL} -a ${API_KEY} -t ${TOOL_FILE} -v --log_file ${INSTALL_LOG}
-shed-tools test -g ${URL} -a ${API_KEY} -t ${TOOL_FILE} --parallel_tests 4 --test_json ${TEST_JSON} -v --log_file ${TEST_LOG} --test_all_versions # is parallel_tests 4 appropriate?
+shed-tools test -g ${URL} -a ${API_KEY} -t ${TOOL_FILE} --parallel_tests ${PARALLEL_TESTS} --test_json ${TEST_JSON} -v --log_file ${TEST_LOG} --test_all_versions
 planemo test_reports ${TEST_JSON} --test_output ${TEST_HTML}
@@ -1,17 +1,132 @@
 #!/usr/bin/env python
+import os
 import glob
-import yaml
+import gzip
 import json
-import os
+import hashlib
+
+from tool_yaml import load_file
+
+"""
+Build the static JSON API published with GitHub Pages.
+
+api/labels.json              owner/name: section label on usegalaxy.org.au
+api/sections/<file>.json     repositories in one usegalaxy.org.au section file with their revisions
+api/repositories.json        owner/name: section label, section shard and revisions on usegalaxy.org.au
+api/revisions.json           revision: list of owner/name, for all servers
+api/servers.json             owner/name: {server: revisions} for all servers
+api/index.json               every file above with its sha256 and size, and the hash of each source file
+
+Every file is also written gzipped alongside (e.g. api/labels.json.gz).  Section shards are only rebuilt
+when the hash of their source .yml file has changed since the last build, and no file is rewritten unless
+its content has changed, so unchanged files keep their modification times for HTTP caching.
+"""
+
+production_dir = 'usegalaxy.org.au'
+servers = ['usegalaxy.org.au', 'staging.gvl.org.au', 'galaxy-aust-dev']
+api_dir = 'api'
+
+
+def get_repo_key(tool):
+    return '%s/%s' % (tool['owner'], tool['name'])
+
+
+def load_tools(path):
+    tools = load_file(path)['tools']
+    return tools if isinstance(tools, list) else [tools]
+
+
+def write_file(path, content, previous_index, index):
+    """ Write content and a gzipped copy if it has changed since the previous build, and record its hash in the index """
+    data = content.encode()
+    digest = hashlib.sha256(data).hexdigest()
+    relative_path = os.path.relpath(path, api_dir)
+    if previous_index['files'].get(relative_path, {}).get('sha256') != digest \
+            or not os.path.exists(path) or not os.path.exists(path + '.gz'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for file_path, file_data in [(path, data), (path + '.gz', gzip.compress(data, mtime=0))]:
+            tmp_path = '%s.tmp' % file_path
+            with open(tmp_path, 'wb') as handle:
+                handle.write(file_data)
+            os.replace(tmp_path, file_path)
+        print('Wrote %s' % path)
+    index['files'][relative_path] = {'sha256': digest, 'size': len(data)}
+
+
+def load_index():
+    try:
+        with open(os.path.join(api_dir, 'index.json')) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {'files': {}, 'sources': {}}
+
+
+def main():
+    previous_index = load_index()
+    index = {'files': {}, 'sources': {}}
+    labels = {}
+    repositories = {}
+    revisions = {}
+    presence = {}
+
+    for server in servers:
+        for path in sorted(glob.glob(os.path.join(server, '*.yml'))):
+            with open(path, 'rb') as handle:
+                source_hash = hashlib.sha1(handle.read()).hexdigest()
+            index['sources'][path] = source_hash
+            tools = load_tools(path)
+            for tool in tools:
+                key = get_repo_key(tool)
+                presence.setdefault(key, {}).setdefault(server, []).extend(tool.get('revisions') or [])
+                for revision in tool.get('revisions') or []:
+                    if key not in revisions.setdefault(revision, []):
+                        revisions[revision].append(key)
+            if server != production_dir:
+                continue
+
+            shard = 'sections/%s.json' % os.path.splitext(os.path.basename(path))[0]
+            for tool in tools:
+                if 'tool_panel_section_label' in tool:
+                    labels[get_repo_key(tool)] = tool['tool_panel_section_label']
+                repositories[get_repo_key(tool)] = {
+                    'section': tool.get('tool_panel_section_label'),
+                    'shard': shard,
+                    'revisions': tool.get('revisions') or [],
+                }
+            shard_path = os.path.join(api_dir, shard)
+            if previous_index['sources'].get(path) == source_hash and shard in previous_index['files'] and os.path.exists(shard_path):
+                index['files'][shard] = previous_index['files'][shard]  # source unchanged since the last build
+                continue
+            write_file(shard_path, json.dumps({
+                'source': path,
+                'sections': sorted(set(tool.get('tool_panel_section_label', '') for tool in tools)),
+                'repositories': {
+                    get_repo_key(tool): {
+                        'section': tool.get('tool_panel_section_label'),
+                        'tool_shed_url': tool.get('tool_shed_url'),
+                        'revisions': tool.get('revisions') or [],
+                    } for tool in tools
+                },
+            }, sort_keys=True), previous_index, index)
+
+    for name, content in [
+        ('labels.json', labels),
+        ('repositories.json', repositories),
+        ('revisions.json', revisions),
+        ('servers.json', presence),
+    ]:
+        write_file(os.path.join(api_dir, name), json.dumps(content), previous_index, index)
+
+    # remove shards for section files that no longer exist
+    for relative_path in set(previous_index['files']) - set(index['files']):
+        for path in [os.path.join(api_dir, relative_path), os.path.join(api_dir, relative_path) + '.gz']:
+            if os.path.exists(path):
+                os.remove(path)
+                print('Removed %s' % path)
+
+    with open(os.path.join(api_dir, 'index.json'), 'w') as handle:
+        json.dump(index, handle, indent=2, sort_keys=True)
+
 
-data = {}
-for fn in sorted(glob.glob("usegalaxy.org.au/*.yml")):
-    with open(fn, 'r') as handle:
-        tools = yaml.safe_load(handle)
-        for x in tools['tools']:
-            if 'tool_panel_section_label' in x:
-                data[f"{x['owner']}/{x['name']}"] = x['tool_panel_section_label']
-
-os.makedirs('api/', exist_ok=True)
-with open('api/labels.json', 'w') as handle:
-    json.dump(data, handle)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import os
+import sys
+import glob
+import json
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tool_yaml
+from parse_shed_tools_log import parse_log
+from uninstall_tools import uninstall_tools
+from wait_for_tools import wait_for_tools
+from toolshed_cache import ToolShedCache, default_cache_path
+from test_scheduler import TestHistory, plan, default_capacity
+from test_results import TestResultStore, get_result_key
+from build_events import EventLog, timed
+from install_queue import make_entry, read_manifest
+from dependency_graph import build_graph, get_install_durations
+
+"""
+Install and test every tool file in a directory written by organise_request_files.py on a new Galaxy server,
+or every entry of its --manifest (see install_queue.py) whose file has not been removed.
+Installations run in a pool of --install_workers and the tests for each tool are started in a pool of
+--test_workers as soon as that tool is installed.  A repository is not installed until the other repositories
+in the directory that it depends on have been installed, including repositories that provide a dependency
+it shares with them (see dependency_graph.py).
+
+Every completed installation and test is appended to a journal file.  When the script is run again with the
+same journal, finished tools are skipped and installed tools that were not tested are tested.
+
+With --history_dir, test durations from earlier test json files (see test_scheduler.py) are used to install
+and test the tools with the longest tests first, to set --parallel_tests for each tool and, unless
+--test_workers is given, to choose how many tools to test at once within --galaxy_capacity.
+
+With --test_result_dir, test results are stored by repository revision and dependency environment (see
+test_results.py), and with --reuse_test_results a tool that has already passed its tests is not tested again.
+
+Rows are written to the installation log in the same format as jenkins/new_server_tools.sh:
+Build Num., Date (AEST), Name, Status, Owner, Installed Revision, Requested Revision, Tests passed,
+Section Label, Tool Shed URL
+"""
+
+log_header = [
+    'Build Num.', 'Date (AEST)', 'Name', 'Status', 'Owner', 'Installed Revision', 'Requested Revision',
+    'Tests passed', 'Section Label', 'Tool Shed URL',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Install and test tools on a new Galaxy server')
+    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
+    parser.add_argument('-a', '--api_key', help='API key for galaxy server', required=True)
+    parser.add_argument('-d', '--tool_dir', help='Directory of tool files written by organise_request_files.py', required=True)
+    parser.add_argument('-m', '--manifest', help='Manifest written by organise_request_files.py, read instead of the tool files')
+    parser.add_argument('-l', '--installation_log', help='Installation log tsv to append rows to', required=True)
+    parser.add_argument('-j', '--journal', help='Journal of completed steps.  Default is journal.jsonl in the parent of tool_dir')
+    parser.add_argument('--files_dir', help='Directory for shed-tools logs and test json.  Default is the parent of tool_dir')
+    parser.add_argument('--error_dir', help='Directory to move tool files with installation errors to')
+    parser.add_argument('-b', '--build_number', help='Build number for the installation log', default='')
+    parser.add_argument('--install_workers', help='Number of installations to run at once', type=int, default=2)
+    parser.add_argument('--test_workers', help='Number of tools to test at once.  Default is 4 or from --history_dir', type=int)
+    parser.add_argument('--parallel_tests', help='Most tests to run at once for one tool', type=int, default=4)
+    parser.add_argument('--history_dir', help='Directories of past test json files used to plan tests', nargs='*', default=[])
+    parser.add_argument('--galaxy_capacity', help='Number of jobs the Galaxy server can run at once', type=int, default=default_capacity)
+    parser.add_argument('--test_result_dir', help='Directory of the test result store (see test_results.py)')
+    parser.add_argument('--reuse_test_results', help='Do not test tools that have passed with the same dependencies', action='store_true')
+    parser.add_argument('--events_log', help='File to append timing events for each step to (see build_events.py)')
+    parser.add_argument('--tool_ready_timeout', help='Seconds to wait for installed tools to load before testing', type=float, default=300)
+    parser.add_argument('--kill_conda_command', help='Shell command to stop conda processes after an installation error')
+    parser.add_argument('--no_dependency_order', help='Do not look up repository dependencies to order installations', action='store_true')
+    parser.add_argument('--cache_path', help='Path of the tool shed response cache', default=default_cache_path)
+    args = parser.parse_args()
+
+    files_dir = args.files_dir or os.path.dirname(os.path.abspath(args.tool_dir))
+    bootstrap = Bootstrap(
+        url=args.galaxy_url,
+        api_key=args.api_key,
+        files_dir=files_dir,
+        installation_log=args.installation_log,
+        journal=Journal(args.journal or os.path.join(files_dir, 'journal.jsonl')),
+        build_number=args.build_number,
+        error_dir=args.error_dir,
+        parallel_tests=args.parallel_tests,
+        tool_ready_timeout=args.tool_ready_timeout,
+        kill_conda_command=args.kill_conda_command,
+        result_store=TestResultStore(args.test_result_dir) if args.test_result_dir else None,
+        reuse_test_results=args.reuse_test_results,
+        events=EventLog(args.events_log, build=args.build_number, mode='bootstrap') if args.events_log else None,
+    )
+    items = load_items(args.tool_dir, manifest=args.manifest)
+    if not args.no_dependency_order:
+        set_dependencies(items, ToolShedCache(path=args.cache_path), history_dirs=args.history_dir)
+    test_workers = args.test_workers or 4
+    if args.history_dir:
+        workers, makespan, planned = plan(list(items.values()), TestHistory(args.history_dir), args.galaxy_capacity, args.parallel_tests)
+        for tool in planned:
+            items[tool['item']].update(predicted_seconds=tool['predicted_seconds'], parallel_tests=tool['parallel_tests'])
+        test_workers = args.test_workers or workers
+        print('Testing %d tools at once, predicted test time %.0fs' % (test_workers, makespan))
+    bootstrap.run(items, install_workers=args.install_workers, test_workers=test_workers)
+
+
+class Journal:
+    """ Append-only record of completed steps, one JSON object per line """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # item: {step: entry}
+        if os.path.exists(path):
+            with open(path) as handle:
+                content = handle.read()
+            for line in content.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # last line may be incomplete if the script was killed
+                    continue
+                self.entries.setdefault(entry['item'], {})[entry['step']] = entry
+            if content and not content.endswith('\n'):
+                with open(path, 'a') as handle:
+                    handle.write('\n')
+
+    def get(self, item, step):
+        return self.entries.get(item, {}).get(step)
+
+    def record(self, item, step, **values):
+        entry = dict(values, item=item, step=step)
+        with self.lock:
+            with open(self.path, 'a') as handle:
+                handle.write(json.dumps(entry) + '\n')
+                handle.flush()
+                os.fsync(handle.fileno())
+            self.entries.setdefault(item, {})[step] = entry
+
+
+def load_items(tool_dir, manifest=None):
+    """ Return a dict of item name (name@revision) to item for each tool file in tool_dir or entry of manifest """
+    if manifest:
+        entries = [entry for entry in read_manifest(manifest) if os.path.exists(entry['path'])]  # files are removed once installed
+    else:
+        entries = []
+        for path in sorted(glob.glob(os.path.join(tool_dir, '*.yml'))):
+            with open(path) as handle:
+                [tool] = tool_yaml.safe_load(handle)['tools']
+            entries.append(make_entry(tool, path))
+    items = {}
+    for entry in entries:
+        items[entry['item']] = {
+            'item': entry['item'],
+            'path': entry['path'],
+            'name': entry['name'],
+            'owner': entry['owner'],
+            'requested_revision': entry['revision'],
+            'section_label': entry['section_label'],
+            'tool_shed_url': entry['tool_shed_url'],
+            'depends_on': [],
+            'predicted_seconds': 0,  # predicted test time, for ordering
+        }
+    return items
+
+
+def set_dependencies(items, cache=None, history_dirs=(), workers=8):
+    """ Set depends_on for each item from the repository dependency graph and report the critical path """
+    graph = build_graph([dict(item, revision=item['requested_revision']) for item in items.values()], cache=cache, workers=workers)
+    for item in items.values():
+        item['depends_on'] = sorted(graph.depends_on[item['item']])
+    durations = get_install_durations([os.path.join(d, '**', 'events.jsonl') for d in history_dirs])
+    seconds, path = graph.critical_path(durations)
+    print('%d install levels, critical path %.0fs: %s' % (len(graph.levels()), seconds, ' -> '.join(path)))
+    if graph.cyclic:
+        print('Dependency cycle between %s' % ', '.join(graph.cyclic))
+
+
+class Bootstrap:
+    def __init__(self, url, api_key, files_dir, installation_log, journal, build_number='', error_dir=None,
+                 parallel_tests=4, tool_ready_timeout=300, kill_conda_command=None, result_store=None, reuse_test_results=False,
+                 events=None):
+        self.url = url
+        self.api_key = api_key
+        self.files_dir = files_dir
+        self.installation_log = installation_log
+        self.journal = journal
+        self.build_number = build_number
+        self.error_dir = error_dir
+        self.parallel_tests = parallel_tests
+        self.tool_ready_timeout = tool_ready_timeout
+        self.kill_conda_command = kill_conda_command
+        self.result_store = result_store
+        self.reuse_test_results = reuse_test_results
+        self.events = events
+        self.log_lock = threading.Lock()
+        # kill_conda_command stops every conda process on the server, so it waits for other installations to finish
+        self.install_condition = threading.Condition()
+        self.installs_running = 0
+        self.kill_pending = 0
+        if not os.path.exists(installation_log):
+            with open(installation_log, 'w') as handle:
+                handle.write('\t'.join(log_header) + '\n')
+
+    def run(self, items, install_workers=2, test_workers=4):
+        finished = set()  # items that no longer block their dependents
+        pending = []
+        install_pool = ThreadPoolExecutor(max_workers=max(install_workers, 1))
+        # tests wait in a priority queue so that the longest predicted tests start first
+        test_queue = queue.PriorityQueue()
+        test_errors = []
+
+        def queue_test(item, row):
+            test_queue.put((-item['predicted_seconds'], next(sequence), item, row))
+
+        def test_worker():
+            while True:
+                priority, number, item, row = test_queue.get()
+                if item is None:
+                    return
+                try:
+                    self.test(item, row)
+                except Exception as e:
+                    print('Error testing %s: %s' % (item['item'], e))
+                    test_errors.append(item['item'])
+
+        sequence = iter(range(sys.maxsize))
+        for item in sorted(items.values(), key=lambda item: item['predicted_seconds'], reverse=True):
+            install_entry = self.journal.get(item['item'], 'install')
+            if self.journal.get(item['item'], 'test') or (install_entry and not install_entry['testable']):
+                print('Skipping %s: already completed' % item['item'])
+                finished.add(item['item'])
+                os.remove(item['path'])
+            elif install_entry:
+                print('Resuming %s: installed, not tested' % item['item'])
+                finished.add(item['item'])
+                os.remove(item['path'])
+                queue_test(item, install_entry['row'])
+            else:
+                pending.append(item)
+
+        test_threads = [threading.Thread(target=test_worker) for i in range(max(test_workers, 1))]
+        for thread in test_threads:
+            thread.start()
+        running = {}  # future: item
+        install_errors = []
+        try:
+            while pending or running:
+                ready = [item for item in pending if all(d in finished or d not in items for d in item['depends_on'])]
+                if not ready and not running:  # dependency cycle, install the rest in order
+                    ready = pending[:1]
+                for item in ready[:max(install_workers - len(running), 0)]:
+                    pending.remove(item)
+                    running[install_pool.submit(self.install, item)] = item
+                done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = running.pop(future)
+                    finished.add(item['item'])
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        print('Error installing %s: %s' % (item['item'], e))
+                        install_errors.append(item['item'])
+                        self.record_install_error(item)
+                        continue
+                    if row:
+                        queue_test(item, row)
+        finally:
+            # test workers wait for their sentinels, so they are queued even if the install loop fails
+            install_pool.shutdown()
+            for thread in test_threads:
+                test_queue.put((float('inf'), next(sequence), None, None))
+            for thread in test_threads:
+                thread.join()
+        if install_errors:
+            raise Exception('Installation could not be completed for %s' % ', '.join(install_errors))
+        if test_errors:
+            raise Exception('Tests could not be run for %s' % ', '.join(test_errors))
+
+    def install(self, item):
+        """ Install a tool file and return the log row if the tool is ready to test, otherwise None """
+        install_log = os.path.join(self.files_dir, '%s_install_log.txt' % item['item'])
+        print('[%s] Installing %s' % (get_date(), item['item']))
+        event_fields = {'tool': item['name'], 'revision': item['requested_revision'], 'server': self.url}
+        with timed(self.events, 'galaxy_wait', **event_fields) as event:
+            event['exit_code'] = run_command(['galaxy-wait', '-g', self.url])
+        with timed(self.events, 'toolshed_wait', **event_fields) as event:
+            event['exit_code'] = run_command(['galaxy-wait', '-g', 'https://%s' % item['tool_shed_url']])
+        with self.install_condition:
+            self.install_condition.wait_for(lambda: not self.kill_pending)
+            self.installs_running += 1
+        try:
+            with timed(self.events, 'shed_tools_install', **event_fields) as event:
+                event['exit_code'] = run_command([
+                    'shed-tools', 'install', '-g', self.url, '-a', self.api_key, '-t', item['path'],
+                    '--install_tool_dependencies', '-v', '--log_file', install_log,
+                ], secret=self.api_key)
+        finally:
+            with self.install_condition:
+                self.installs_running -= 1
+                self.install_condition.notify_all()
+        values = parse_log(install_log, 'install') if os.path.exists(install_log) else {}
+        status = values.get('STATUS')
+        installed_name, installed_revision = values.get('NAME', ''), values.get('REVISION', '')
+        if values.get('ALREADY_INSTALLED') or status == 'Skipped':
+            status = 'Already Installed'
+
+        row = [
+            self.build_number, get_date(), item['name'], status or 'Script Error', item['owner'], installed_revision,
+            item['requested_revision'], '', item['section_label'], item['tool_shed_url'],
+        ]
+        if status in ['Installed', 'Already Installed']:
+            print('%s: %s' % (item['item'], status))
+            self.journal.record(item['item'], 'install', status=status, row=row, testable=True)
+            os.remove(item['path'])
+            return row
+
+        # The tool may or may not be installed according to the API, so it needs to be uninstalled
+        print('%s: %s.  Winding back installation due to API error.' % (item['item'], row[3]))
+        if installed_name:
+            with timed(self.events, 'uninstall', installed_revision=installed_revision, **event_fields):
+                uninstall_tools([(self.url, self.api_key)], ['%s@%s' % (installed_name, installed_revision)])
+        if self.kill_conda_command:
+            self.kill_conda(event_fields)
+        self.write_row(row)
+        self.journal.record(item['item'], 'install', status=row[3], row=row, testable=False)
+        if self.error_dir:
+            os.makedirs(self.error_dir, exist_ok=True)
+            shutil.move(item['path'], os.path.join(self.error_dir, os.path.basename(item['path'])))
+        return None
+
+    def kill_conda(self, event_fields):
+        """ Run kill_conda_command once no other installation is running, holding new installations back until then """
+        with self.install_condition:
+            self.kill_pending += 1
+            try:
+                self.install_condition.wait_for(lambda: not self.installs_running)
+                with timed(self.events, 'kill_conda', **event_fields) as event:
+                    event['exit_code'] = run_command(self.kill_conda_command, shell=True)
+            finally:
+                self.kill_pending -= 1
+                self.install_condition.notify_all()
+
+    def record_install_error(self, item):
+        """ Log and journal an installation that raised so that it is not installed again on resuming """
+        row = [
+            self.build_number, get_date(), item['name'], 'Script Error', item['owner'], '',
+            item['requested_revision'], '', item['section_label'], item['tool_shed_url'],
+        ]
+        try:
+            self.write_row(row)
+            self.journal.record(item['item'], 'install', status=row[3], row=row, testable=False)
+            if self.error_dir and os.path.exists(item['path']):
+                os.makedirs(self.error_dir, exist_ok=True)
+                shutil.move(item['path'], os.path.join(self.error_dir, os.path.basename(item['path'])))
+        except Exception as e:
+            print('Could not record error for %s: %s' % (item['item'], e))
+
+    def test(self, item, row):
+        name, owner, installed_revision = row[2], row[4], row[5]
+        test_log = os.path.join(self.files_dir, '%s@%s_test_log.txt' % (name, installed_revision))
+        test_json = os.path.join(self.files_dir, '%s@%s_test.json' % (name, installed_revision))
+        event_fields = {'tool': name, 'revision': item['requested_revision'], 'installed_revision': installed_revision, 'server': self.url}
+        with timed(self.events, 'wait_for_tools', **event_fields) as event:
+            ready = wait_for_tools(self.url, self.api_key, name, owner, installed_revision, item['tool_shed_url'], timeout=self.tool_ready_timeout)
+            event['exit_code'] = 0 if ready else 1
+        if not ready:
+            print('WARNING: Tools from %s revision %s are not all loaded.  Running tests anyway.' % (name, installed_revision))
+        key = None
+        if self.result_store:
+            key = get_result_key(self.url, self.api_key, name, owner, installed_revision, item['tool_shed_url'])
+        result = self.result_store.get(key) if key and self.reuse_test_results else None
+        if result:
+            print('[%s] Reusing test results for %s from build %s' % (get_date(), item['item'], result['build_number']))
+            self.result_store.copy_test_json(result, test_json)
+            passed, failed = result['tests_passed'], result['tests_failed']
+            tests_passed = '%d/%d (reused)' % (passed, passed + failed)
+        else:
+            print('[%s] Testing %s' % (get_date(), item['item']))
+            with timed(self.events, 'shed_tools_test', **event_fields) as event:
+                return_code = event['exit_code'] = run_command([
+                    'shed-tools', 'test', '-g', self.url, '-a', self.api_key, '--name', name, '--owner', owner,
+                    '--revisions', row[6], '--toolshed', item['tool_shed_url'], '--parallel_tests', str(item.get('parallel_tests', self.parallel_tests)),
+                    '--test_json', test_json, '-v', '--log_file', test_log,
+                ], secret=self.api_key)
+            values = parse_log(test_log, 'test') if os.path.exists(test_log) else {}
+            if return_code != 0 and not (values.get('TESTS_PASSED') or values.get('TESTS_FAILED')):
+                tests_passed = 'Shed-tools error'
+            else:
+                passed, failed = int(values.get('TESTS_PASSED') or 0), int(values.get('TESTS_FAILED') or 0)
+                tests_passed = '%d/%d' % (passed, passed + failed)
+                if key:
+                    self.result_store.put(key, passed, failed, test_json, self.build_number)
+        print('%s: tests passed %s' % (item['item'], tests_passed))
+        row = row[:7] + [tests_passed] + row[8:]
+        self.write_row(row)
+        self.journal.record(item['item'], 'test', tests_passed=tests_passed)
+
+    def write_row(self, row):
+        with self.log_lock:
+            with open(self.installation_log, 'a') as handle:
+                handle.write('\t'.join(row) + '\n')
+
+
+def run_command(command, secret=None, shell=False):
+    printed = command if shell else ' '.join(command)
+    if secret:
+        printed = printed.replace(secret, '<API_KEY>')
+    print(printed)
+    sys.stdout.flush()
+    return subprocess.call(command, shell=shell)
+
+
+def get_date():
+    return datetime.now(ZoneInfo('Australia/Queensland')).strftime('%d/%m/%y %H:%M:%S')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import threading
+import statistics
+from contextlib import contextmanager
+
+"""
+Timing events for the steps of installation builds.  Each event is one line of JSON appended to an events
+file, by default events.jsonl in the build's log directory, with the fields
+build, mode, step, tool, revision, installed_revision, server, start, end, duration, outcome, exit_code
+where start and end are seconds since the epoch and outcome is ok or error.  Events are written by
+jenkins/events.sh for bash steps and by EventLog for python scripts, i.e. bootstrap_server.py.
+
+Report where the time went in each build and across builds:
+python scripts/build_events.py summary $BASE_LOG_DIR/*/events.jsonl
+python scripts/build_events.py summary --by step server --per_build $LOG_DIR/events.jsonl
+"""
+
+event_fields = [
+    'build', 'mode', 'step', 'tool', 'revision', 'installed_revision', 'server', 'start', 'end', 'duration', 'outcome',
+    'exit_code',
+]
+
+
+class EventLog:
+    def __init__(self, path, **context):
+        """ Append events to path.  context sets fields shared by every event, i.e. build and mode """
+        self.path = path
+        self.context = context
+        self.lock = threading.Lock()
+
+    def record(self, step, start, end, exit_code=0, **fields):
+        event = {field: '' for field in event_fields}
+        event.update(self.context)
+        event.update(fields)
+        event.update({
+            'step': step,
+            'start': round(start, 6),
+            'end': round(end, 6),
+            'duration': round(end - start, 6),
+            'outcome': 'ok' if exit_code == 0 else 'error',
+            'exit_code': exit_code,
+        })
+        line = json.dumps(event) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as handle:
+                handle.write(line)
+
+    @contextmanager
+    def timed(self, step, **fields):
+        """
+        Record an event for the body of a with statement.  The yielded dict can be updated with more fields,
+        and exit_code is 1 if the body raises an exception or can be set in the dict
+        """
+        start = time.time()
+        result = {'exit_code': 0}
+        try:
+            yield result
+        except BaseException:
+            result['exit_code'] = 1
+            raise
+        finally:
+            exit_code = result.pop('exit_code')
+            self.record(step, start, time.time(), exit_code=exit_code, **dict(fields, **result))
+
+
+@contextmanager
+def timed(events, step, **fields):
+    """ EventLog.timed if events is an EventLog, otherwise nothing is recorded """
+    if events is None:
+        yield {}
+    else:
+        with events.timed(step, **fields) as result:
+            yield result
+
+
+def load_events(paths):
+    events = []
+    for path in paths:
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:  # i.e. a line that was being written when the build stopped
+                    continue
+    return events
+
+
+def summarise(events, by=('step',)):
+    """
+    Return a list of {<by fields>, count, errors, total, mean, median, max, share} dicts sorted by total
+    duration, where share is the proportion of the summed durations of all events
+    """
+    groups = {}
+    for event in events:
+        groups.setdefault(tuple(event.get(field, '') for field in by), []).append(event)
+    grand_total = sum(event['duration'] for event in events) or 1
+    rows = []
+    for key, group in groups.items():
+        durations = [event['duration'] for event in group]
+        row = dict(zip(by, key))
+        row.update({
+            'count': len(group),
+            'errors': sum(1 for event in group if event.get('outcome') != 'ok'),
+            'total': round(sum(durations), 1),
+            'mean': round(statistics.mean(durations), 1),
+            'median': round(statistics.median(durations), 1),
+            'max': round(max(durations), 1),
+            'share': round(sum(durations) / grand_total, 3),
+        })
+        rows.append(row)
+    rows.sort(key=lambda row: row['total'], reverse=True)
+    return rows
+
+
+def get_wall_seconds(events):
+    return max(event['end'] for event in events) - min(event['start'] for event in events) if events else 0
+
+
+def write_table(rows, columns, out=sys.stdout):
+    widths = [max([len(column)] + [len(str(row[column])) for row in rows]) for column in columns]
+    out.write('  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip() + '\n')
+    for row in rows:
+        out.write('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)).rstrip() + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise timing events from installation builds')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary_parser = subparsers.add_parser('summary', help='Report the time spent in each step')
+    summary_parser.add_argument('paths', help='Events files or glob patterns', nargs='+')
+    summary_parser.add_argument('--by', help='Fields to group events by', nargs='+', default=['step'], choices=event_fields)
+    summary_parser.add_argument('--per_build', help='Report each build separately as well as all builds together', action='store_true')
+    summary_parser.add_argument('-f', '--format', help='Output format', choices=['text', 'json'], default='text')
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.paths for path in (glob.glob(pattern) or [pattern]) if os.path.exists(path)))
+    events = load_events(paths)
+    builds = {}
+    for event in events:
+        builds.setdefault(event.get('build', ''), []).append(event)
+    sections = []  # (title, events)
+    if args.per_build:
+        sections.extend(('Build %s' % build, builds[build]) for build in sorted(builds))
+    sections.append(('All builds (%d)' % len(builds), events))
+
+    columns = list(args.by) + ['count', 'errors', 'total', 'mean', 'median', 'max', 'share']
+    if args.format == 'json':
+        output = [{
+            'title': title,
+            'wall_seconds': round(get_wall_seconds(section_events), 1),
+            'rows': summarise(section_events, args.by),
+        } for title, section_events in sections]
+        sys.stdout.write(json.dumps(output, indent=2) + '\n')
+        return
+    for title, section_events in sections:
+        sys.stdout.write('%s: %d events' % (title, len(section_events)))
+        if len(builds) == 1 or title.startswith('Build'):
+            sys.stdout.write(', %.0fs from first start to last end' % get_wall_seconds(section_events))
+        sys.stdout.write('\n')
+        write_table(summarise(section_events, args.by), columns)
+        sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_toolshed_instance
+from toolshed_cache import ToolShedCache, CachedToolShedClient, get_installable_revision, default_cache_path
+from install_queue import read_manifest, write_manifest, get_revision
+from build_events import load_events
+
+"""
+Repository dependency graph for the entries of a manifest written by organise_request_files.py (see
+install_queue.py).  The repo_deps of get_repository_revision_install_info give the dependency tree of each
+requested revision.  The edges of the tree are cached in the tool shed cache, permanently for revisions that
+are installable revisions and for the cache's ttl otherwise.
+
+An entry depends on every other requested repository that its tree reaches.  A repository that is not requested
+but is in the tree of several entries is installed by shed-tools along with the first of them, so the others
+depend on that entry rather than installing the shared repository at the same time.  Entries are grouped
+into levels: every entry in a level depends only on entries in earlier levels.  The depends_on of each entry
+is written to the manifest, where install_queue.py does not claim an entry until its depends_on entries are
+complete, and bootstrap_server.py does not install an item before the items it depends on, so the entries of
+a level are installed concurrently when there are several install workers.  The critical path is the chain of dependent entries that takes longest to install, using the
+median duration of the past shed_tools_install events (see build_events.py) of each repository.
+
+python scripts/dependency_graph.py -m $MANIFEST --events_log $BASE_LOG_DIR/*/events.jsonl
+python scripts/dependency_graph.py -m $MANIFEST --order  # rewrite the manifest in level order
+"""
+
+default_install_seconds = 120  # for repositories with no install events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the install levels and critical path of the repositories in a manifest')
+    parser.add_argument('-m', '--manifest', help='Manifest written by organise_request_files.py', required=True)
+    parser.add_argument('--events_log', help='Events files from earlier builds for install durations', nargs='*', default=[])
+    parser.add_argument('--order', help='Rewrite the manifest in level order with depends_on for each entry', action='store_true')
+    parser.add_argument('--cache_path', help='Path of the tool shed response cache', default=default_cache_path)
+    parser.add_argument('-w', '--workers', help='Number of tool shed queries to run concurrently', type=int, default=8)
+    parser.add_argument('-f', '--format', help='Output format', choices=['text', 'json'], default='text')
+    args = parser.parse_args()
+
+    entries = read_manifest(args.manifest)
+    graph = build_graph(entries, cache=ToolShedCache(path=args.cache_path), workers=args.workers)
+    durations = get_install_durations(args.events_log)
+    seconds, path = graph.critical_path(durations)
+    levels = graph.levels()
+    if graph.cyclic:
+        sys.stderr.write('Dependency cycle between %s\n' % ', '.join(graph.cyclic))
+    if args.order:
+        write_manifest(args.manifest, graph.ordered_entries())
+    if args.format == 'json':
+        sys.stdout.write(json.dumps({
+            'levels': levels,
+            'critical_path': path,
+            'critical_path_seconds': seconds,
+            'depends_on': {item: sorted(depends_on) for item, depends_on in graph.depends_on.items()},
+        }, indent=2) + '\n')
+    else:
+        for i, level in enumerate(levels):
+            print('Level %d (%d): %s' % (i, len(level), ', '.join(level)))
+        print('Critical path %.0fs: %s' % (seconds, ' -> '.join(path)))
+
+
+class DependencyGraph:
+    """
+    Dependencies between the entries of a manifest.  edges is {item: [(repository, dependency), ...]} where
+    repositories are (name, owner) pairs, from the dependency tree of each entry
+    """
+    def __init__(self, entries, edges):
+        self.entries = {entry['item']: entry for entry in entries}
+        self.order = [entry['item'] for entry in entries]
+        self.repository_dependencies = {}  # repository: set of repositories it depends on directly
+        for item in self.order:
+            for repository, dependency in edges.get(item, []):
+                if repository != dependency:
+                    self.repository_dependencies.setdefault(repository, set()).add(dependency)
+        self.items_by_repository = {}
+        for item in self.order:
+            entry = self.entries[item]
+            self.items_by_repository.setdefault((entry['name'], entry['owner']), []).append(item)
+        self.depends_on = {item: set() for item in self.order}
+        self.cyclic = []  # items that depend on each other, set by levels()
+        self._levels = None
+        shared = {}  # repository that is not requested: items whose trees include it
+        for item in self.order:
+            entry = self.entries[item]
+            for repository in self.get_reachable((entry['name'], entry['owner'])):
+                if repository in self.items_by_repository:
+                    self.depends_on[item].update(d for d in self.items_by_repository[repository] if d != item)
+                else:
+                    shared.setdefault(repository, []).append(item)
+        for repository, items in shared.items():
+            first = items[0]
+            before_first = self.get_all_dependencies(first)
+            for item in items[1:]:
+                if item not in before_first:  # otherwise a cycle
+                    self.depends_on[item].add(first)
+
+    def get_reachable(self, repository):
+        """ Repositories that repository depends on directly or indirectly """
+        reachable = set()
+        stack = [repository]
+        while stack:
+            for dependency in self.repository_dependencies.get(stack.pop(), []):
+                if dependency not in reachable and dependency != repository:
+                    reachable.add(dependency)
+                    stack.append(dependency)
+        return reachable
+
+    def get_all_dependencies(self, item):
+        """ Items that item depends on directly or indirectly """
+        dependencies = set()
+        stack = [item]
+        while stack:
+            for dependency in self.depends_on[stack.pop()]:
+                if dependency not in dependencies:
+                    dependencies.add(dependency)
+                    stack.append(dependency)
+        return dependencies
+
+    def levels(self):
+        """
+        Lists of items in which every item depends only on items in earlier lists, in manifest order.  Items in
+        a dependency cycle are put in the last list together and in cyclic
+        """
+        if self._levels is None:
+            remaining = list(self.order)
+            placed = set()
+            self._levels = []
+            while remaining:
+                level = [item for item in remaining if self.depends_on[item] <= placed]
+                if not level:  # a dependency cycle: install the rest together
+                    self.cyclic = level = remaining
+                self._levels.append(level)
+                placed.update(level)
+                remaining = [item for item in remaining if item not in placed]
+        return self._levels
+
+    def critical_path(self, durations=None, default_seconds=default_install_seconds):
+        """
+        Return the seconds and items of the longest chain of dependent items, where durations is
+        {repository name: seconds} and items without a duration take default_seconds
+        """
+        durations = durations or {}
+        finish = {}  # item: (seconds until the item is installed, chain)
+        for level in self.levels():
+            for item in level:
+                entry = self.entries[item]
+                seconds = durations.get(entry['name'], default_seconds)
+                before = [finish[d] for d in self.depends_on[item] if d in finish]
+                previous_seconds, previous_chain = max(before, key=lambda value: value[0]) if before else (0, [])
+                finish[item] = (previous_seconds + seconds, previous_chain + [item])
+        if not finish:
+            return 0, []
+        return max(finish.values(), key=lambda value: value[0])
+
+    def ordered_entries(self):
+        """ Manifest entries in level order with the items they depend on """
+        entries = []
+        for level in self.levels():
+            for item in level:
+                entries.append(dict(self.entries[item], depends_on=sorted(self.depends_on[item])))
+        return entries
+
+
+def build_graph(entries, cache=None, workers=8):
+    """ Return a DependencyGraph for manifest entries, looking up the dependency tree of each on its tool shed """
+    toolsheds = {}
+    for shed in set(entry['tool_shed_url'] for entry in entries):
+        toolsheds[shed] = CachedToolShedClient(get_toolshed_instance(shed, pool_size=workers), shed, cache=cache)
+
+    def get_edges(entry):
+        revision = get_revision(entry)
+        if revision == 'latest':
+            return []
+        toolshed = toolsheds[entry['tool_shed_url']]
+        key = (entry['tool_shed_url'], entry['owner'], entry['name'])
+        if cache:
+            edges = cache.get('repository_dependency_edges', *key, revision=revision, ttl=0)
+            if edges is not None:
+                return [tuple(map(tuple, edge)) for edge in edges]
+        try:
+            data = toolshed.get_repository_revision_install_info(entry['name'], entry['owner'], revision)
+        except Exception as e:
+            print('Could not get repository dependencies of %s: %s' % (entry['item'], e))
+            return []
+        edges = get_dependency_edges(entry['name'], entry['owner'], data)
+        if cache and get_installable_revision(entry['name'], data) == revision:  # immutable
+            cache.set('repository_dependency_edges', *key, edges, revision=revision)
+        return edges
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        edges = dict(zip([entry['item'] for entry in entries], executor.map(get_edges, entries)))
+    return DependencyGraph(entries, edges)
+
+
+def get_dependency_edges(name, owner, data):
+    """
+    Return the (repository, dependency) edges of the dependency tree in a get_repository_revision_install_info
+    response, where repositories are (name, owner).  Each key of repo_deps other than root_key and description
+    names a repository in the tree, as <tool shed>__ESEP__<name>__ESEP__<owner>__ESEP__<revision>..., and maps to
+    the [tool shed, name, owner, revision, ...] lists of its dependencies
+    """
+    try:
+        repository, metadata, install_info = data
+        repo_deps = install_info[name][5] or {}
+    except (KeyError, ValueError, TypeError, IndexError):
+        return []
+    root = (name, owner)
+    edges = []
+    for key, dependencies in repo_deps.items():
+        if key in ['root_key', 'description'] or not isinstance(dependencies, list):
+            continue
+        parts = key.split('__ESEP__')
+        source = (parts[1], parts[2]) if len(parts) >= 4 and key != repo_deps.get('root_key') else root
+        for dependency in dependencies:
+            if len(dependency) >= 4 and (source, (dependency[1], dependency[2])) not in edges:
+                edges.append((source, (dependency[1], dependency[2])))
+    return edges
+
+
+def get_install_durations(paths):
+    """ Return {repository name: median seconds} of successful shed_tools_install events in events files """
+    durations = {}
+    files = [path for pattern in paths for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)]
+    for event in load_events(files):
+        if event.get('step') == 'shed_tools_install' and event.get('outcome') == 'ok' and event.get('tool'):
+            durations.setdefault(event['tool'], []).append(event['duration'])
+    return {name: statistics.median(values) for name, values in durations.items()}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import argparse
+
+"""
+A queue of the tool files written by organise_request_files.py.  With --manifest, organise_request_files.py
+also writes one line of JSON per tool file with every field the installation scripts need:
+
+{"item": "fastqc@e7b2202befea", "path": "tmp/update/123/fastqc@e7b2202befea.yml", "name": "fastqc",
+ "owner": "devteam", "revision": "e7b2202befea", "resolved_revision": "", "tool_shed_url": "toolshed.g2.bx.psu.edu",
+ "section_label": "FASTQ Quality Control", "version_update": false, "preflight": ""}
+
+revision is the requested revision, 'latest' if the file has no revisions.  organise_request_files.py --preflight
+sets resolved_revision to the latest installable revision of these, and sets preflight.
+With --dependency_order, entries also have the items they depend on (see dependency_graph.py) and an entry is
+not claimed until those are complete, so that entries can be installed concurrently.
+Claims and completions are appended to a state file, <manifest>.state.jsonl by default, so that an interrupted
+build can be resumed: entries that were completed are not claimed again, and `release` makes entries claimed
+by a build that stopped available again.
+
+In jenkins/install_tools.sh:
+while QUEUE_ENTRY=$(python scripts/install_queue.py -m $MANIFEST claim); do
+  eval "$QUEUE_ENTRY"  # sets QUEUE_ITEM, TOOL_FILE, TOOL_NAME, OWNER, REQUESTED_REVISION, RESOLVED_REVISION,
+                       # TOOL_SHED_URL, SECTION_LABEL, VERSION_UPDATE and PREFLIGHT
+  ...
+  python scripts/install_queue.py -m $MANIFEST complete $QUEUE_ITEM --exit_code $?
+done
+
+claim exits with status 1 when there are no entries left and with status 2 when the entries that are left
+depend on claimed entries, in which case it can be run again once an entry has been completed.
+"""
+
+default_tool_shed = 'toolshed.g2.bx.psu.edu'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Claim and complete entries of an installation manifest')
+    parser.add_argument('-m', '--manifest', help='Manifest written by organise_request_files.py', required=True)
+    parser.add_argument('--state', help='State file.  Default is <manifest>.state.jsonl')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('claim', help='Claim the next entry and write its fields as shell assignments')
+    complete_parser = subparsers.add_parser('complete', help='Mark an entry as complete')
+    complete_parser.add_argument('item', help='Item (name@revision) of the entry')
+    complete_parser.add_argument('--exit_code', help='Exit status of the installation', type=int, default=0)
+    subparsers.add_parser('release', help='Make claimed entries that were not completed available again')
+    status_parser = subparsers.add_parser('status', help='Write the number of entries of each status')
+    status_parser.add_argument('--pending', help='Write the number of pending entries only', action='store_true')
+    status_parser.add_argument('--complete', help='Write the items of complete entries, one per line', action='store_true')
+    args = parser.parse_args()
+
+    install_queue = InstallQueue(args.manifest, state_path=args.state)
+    if args.command == 'claim':
+        entry = install_queue.claim()
+        if not entry:
+            sys.exit(2 if install_queue.count()['pending'] else 1)
+        for variable, value in get_shell_values(entry).items():
+            sys.stdout.write('%s=%s\n' % (variable, shlex.quote(value)))
+    elif args.command == 'complete':
+        if args.item not in [entry['item'] for entry in install_queue.entries]:
+            sys.exit('%s is not in %s' % (args.item, args.manifest))
+        install_queue.complete(args.item, exit_code=args.exit_code)
+    elif args.command == 'release':
+        released = install_queue.release()
+        print('Released %d claimed entries' % len(released))
+    elif args.pending:
+        print(install_queue.count()['pending'])
+    elif args.complete:
+        install_queue.load_state()
+        for entry in install_queue.entries:
+            if install_queue.get_status(entry['item']) == 'complete':
+                print(entry['item'])
+    else:
+        print(json.dumps(install_queue.count()))
+
+
+def make_entry(tool, path):
+    """ Manifest entry for a tool dict with at most one revision written to path """
+    [revision] = tool.get('revisions') or ['latest']
+    return {
+        'item': '%s@%s' % (tool['name'], revision),
+        'path': path,
+        'name': tool['name'],
+        'owner': tool['owner'],
+        'revision': revision,
+        'resolved_revision': tool.get('resolved_revision', ''),
+        'tool_shed_url': tool.get('tool_shed_url') or default_tool_shed,
+        'section_label': tool.get('tool_panel_section_label', ''),
+        'version_update': bool(tool.get('version_update', False)),
+        'preflight': '',
+    }
+
+
+def write_manifest(path, entries):
+    """ Write entries, keeping the last entry for each item in the position of the first """
+    by_item = {}
+    for entry in entries:
+        by_item[entry['item']] = entry
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as handle:
+        for entry in by_item.values():
+            handle.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, path)
+
+
+def get_revision(entry):
+    """ The revision of an entry, with 'latest' resolved if organise_request_files.py --preflight resolved it """
+    return entry.get('resolved_revision') or entry['revision']
+
+
+def read_manifest(path):
+    with open(path) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def get_shell_values(entry):
+    """ Shell variables used by jenkins/install_tools.sh.  TOOL_SHED_URL is the host of the tool shed """
+    return {
+        'QUEUE_ITEM': entry['item'],
+        'TOOL_FILE': entry['path'],
+        'TOOL_NAME': entry['name'],
+        'OWNER': entry['owner'],
+        'REQUESTED_REVISION': entry['revision'],
+        'RESOLVED_REVISION': get_revision(entry),
+        'TOOL_SHED_URL': entry['tool_shed_url'].split('://')[-1].rstrip('/'),
+        'SECTION_LABEL': entry['section_label'],
+        'VERSION_UPDATE': '1' if entry['version_update'] else '0',
+        'PREFLIGHT': entry.get('preflight', ''),
+    }
+
+
+class InstallQueue:
+    """
+    Entries of a manifest with their status: pending, claimed or complete.  The state file is locked while it
+    is read and appended to so that entries can be claimed and completed from several processes
+    """
+    def __init__(self, manifest_path, state_path=None):
+        self.entries = read_manifest(manifest_path)
+        self.state_path = state_path or '%s.state.jsonl' % os.path.splitext(manifest_path)[0]
+        self.states = {}  # item: last state entry
+
+    def __iter__(self):
+        """ Iterate over entries that have not been completed """
+        self.load_state()
+        return iter([entry for entry in self.entries if self.get_status(entry['item']) != 'complete'])
+
+    def get_status(self, item):
+        return self.states.get(item, {}).get('status', 'pending')
+
+    def count(self):
+        self.load_state()
+        counts = {'pending': 0, 'claimed': 0, 'complete': 0}
+        for entry in self.entries:
+            counts[self.get_status(entry['item'])] += 1
+        return counts
+
+    def claim(self):
+        """
+        Claim the first pending entry whose depends_on entries are complete and return it, or return None if
+        there are none.  If every pending entry is waiting for another pending entry, i.e. a dependency cycle,
+        and none are claimed, the first pending entry is claimed
+        """
+        items = set(entry['item'] for entry in self.entries)
+        with self.locked_state() as handle:
+            pending = [entry for entry in self.entries if self.get_status(entry['item']) == 'pending']
+            for entry in pending:
+                if all(d not in items or self.get_status(d) == 'complete' for d in entry.get('depends_on', [])):
+                    self.append(handle, entry['item'], 'claimed')
+                    return entry
+            if pending and 'claimed' not in [self.get_status(item) for item in items]:
+                self.append(handle, pending[0]['item'], 'claimed')
+                return pending[0]
+
+    def complete(self, item, exit_code=0):
+        with self.locked_state() as handle:
+            self.append(handle, item, 'complete', exit_code=exit_code)
+
+    def release(self):
+        """ Return claimed entries to pending, i.e. when resuming a build that was interrupted """
+        with self.locked_state() as handle:
+            released = [entry['item'] for entry in self.entries if self.get_status(entry['item']) == 'claimed']
+            for item in released:
+                self.append(handle, item, 'pending')
+        return released
+
+    def load_state(self, handle=None):
+        self.states = {}
+        if handle is None:
+            if not os.path.exists(self.state_path):
+                return
+            with open(self.state_path) as infile:
+                content = infile.read()
+        else:
+            handle.seek(0)
+            content = handle.read()
+            if content and not content.endswith('\n'):
+                handle.write('\n')
+        for line in content.splitlines():
+            try:
+                state = json.loads(line)
+            except ValueError:  # last line may be incomplete if the build was killed
+                continue
+            self.states[state['item']] = state
+
+    def locked_state(self):
+        return LockedFile(self.state_path, self.load_state)
+
+    def append(self, handle, item, status, **values):
+        state = dict(values, item=item, status=status, time=time.time(), pid=os.getpid())
+        handle.write(json.dumps(state) + '\n')
+        handle.flush()
+        os.fsync(handle.fileno())
+        self.states[item] = state
+
+
+class LockedFile:
+    """ Open path for reading and appending with an exclusive lock and call on_open with the handle """
+    def __init__(self, path, on_open):
+        self.path = path
+        self.on_open = on_open
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a+')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        self.on_open(self.handle)
+        return self.handle
+
+    def __exit__(self, *args):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+if __name__ == "__main__":
+    main()
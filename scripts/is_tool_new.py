@@ -1,7 +1,8 @@
+import os
 import sys
 import argparse
 
-from bioblend.galaxy import GalaxyInstance
+from utils import get_repository_snapshot
 
 
 def main():
@@ -10,6 +11,11 @@ def main():
     parser.add_argument('-a', '--api_key', help='API key for galaxy server')
     parser.add_argument('-n', '--name', help='Tool name')
     parser.add_argument('-o', '--owner', help='Tool owner')
+    parser.add_argument(
+        '--snapshot_dir',
+        help='Directory for repository list snapshots shared within a build',
+        default=os.environ.get('REPOSITORY_SNAPSHOT_DIR'),
+    )
 
     args = parser.parse_args()
     galaxy_url = args.galaxy_url
@@ -17,9 +23,8 @@ def main():
     name = args.name
     owner = args.owner
 
-    galaxy_instance = GalaxyInstance(galaxy_url, api_key)
-    repos = galaxy_instance.toolshed.get_repositories()
-    tools_with_name_and_owner = [t for t in repos if t['name'] == name and t['owner'] == owner and t['status'] == 'Installed']
+    snapshot = get_repository_snapshot(galaxy_url, api_key, snapshot_dir=args.snapshot_dir)
+    tools_with_name_and_owner = snapshot.find(name, owner, statuses=['Installed'])
     if not tools_with_name_and_owner:
         sys.stdout.write('True')  # we did not find the name/owner combination so we say that the tool is new
     else:
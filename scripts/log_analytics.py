@@ -0,0 +1,301 @@
+import os
+import sys
+import csv
+import json
+import pickle
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from log_store import LogStore, default_log_file, date_format
+
+"""
+Group-by and aggregation queries over automated_tool_installation_log.tsv.  The log is converted to
+columns of numpy arrays (dates as datetime64, text columns encoded as integer codes into a list of
+categories) and pickled next to the log.  Only rows added to the log store since the last run are
+converted, and the columns are rebuilt if the store is rebuilt.
+
+Examples:
+# failure rate per owner
+python scripts/log_analytics.py group --by owner --rate 'Tests failed' 'Shed-tools error' --sort rate
+# share of tests failed versus shed-tools errors by month
+python scripts/log_analytics.py group --by month status --where status='Tests failed,Shed-tools error'
+# median hours from the first attempt at a repository to its installation, per section
+python scripts/log_analytics.py latency --by section --format json
+"""
+
+# column name: log column for categorical columns
+categorical_columns = {
+    'category': 'Category',
+    'name': 'Name',
+    'owner': 'Owner',
+    'status': 'Status',
+    'section': 'Section Label',
+    'failing_step': 'Failing Step',
+    'tool_shed': 'Tool Shed URL',
+    'new_tool': 'New Tool',
+}
+date_columns = {  # columns derived from the row date
+    'year': 'datetime64[Y]',
+    'month': 'datetime64[M]',
+    'week': 'datetime64[W]',
+    'day': 'datetime64[D]',
+}
+failure_statuses = ['Tests failed', 'Shed-tools error', 'Errored', 'Script error', 'Shed-tools test error']
+cache_version = 1
+
+
+class LogColumns:
+    def __init__(self, log_file=default_log_file, cache_path=None):
+        self.log_file = log_file
+        self.cache_path = cache_path or os.path.splitext(log_file)[0] + '.columns.pickle'
+        self.reset()
+
+    def reset(self, generation=None):
+        self.generation = generation
+        self.size = 0
+        self.build = np.zeros(0, dtype=np.int32)
+        self.date = np.zeros(0, dtype='datetime64[s]')
+        self.codes = {column: np.zeros(0, dtype=np.int32) for column in categorical_columns}
+        self.categories = {column: [] for column in categorical_columns}
+
+    def load(self):
+        """ Load the cached columns and add any rows added to the log since they were cached """
+        try:
+            with open(self.cache_path, 'rb') as handle:
+                cached = pickle.load(handle)
+            if cached.get('version') == cache_version:
+                self.__dict__.update(cached['columns'])
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        store = LogStore(self.log_file)
+        store.sync()
+        if store.get_generation() != self.generation or store.count() < self.size:
+            self.reset(store.get_generation())
+        added = self.extend([row for row_num, row in store.iter_rows(row_from=self.size)])
+        store.close()
+        if added:
+            self.save()
+        return self
+
+    def extend(self, rows):
+        if not rows:
+            return 0
+        self.build = np.concatenate([self.build, np.array([parse_build_number(row['Build Num.']) for row in rows], dtype=np.int32)])
+        self.date = np.concatenate([self.date, np.array([parse_date(row['Date (AEST)']) for row in rows], dtype='datetime64[s]')])
+        for column, log_column in categorical_columns.items():
+            categories = self.categories[column]
+            lookup = {value: code for code, value in enumerate(categories)}
+            new_codes = []
+            for row in rows:
+                value = row[log_column]
+                if value not in lookup:
+                    lookup[value] = len(categories)
+                    categories.append(value)
+                new_codes.append(lookup[value])
+            self.codes[column] = np.concatenate([self.codes[column], np.array(new_codes, dtype=np.int32)])
+        self.size += len(rows)
+        return len(rows)
+
+    def save(self):
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump({'version': cache_version, 'columns': {
+                key: getattr(self, key) for key in ['generation', 'size', 'build', 'date', 'codes', 'categories']
+            }}, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+    def key(self, column):
+        """ Return (integer codes, labels) for a column that can be grouped by """
+        if column in categorical_columns:
+            return self.codes[column], self.categories[column]
+        if column in date_columns:
+            periods = self.date.astype(date_columns[column])
+            unique_periods, codes = np.unique(periods, return_inverse=True)
+            return codes.astype(np.int64), [str(period) for period in unique_periods]
+        if column == 'build':
+            unique_builds, codes = np.unique(self.build, return_inverse=True)
+            return codes.astype(np.int64), [str(build) for build in unique_builds]
+        raise Exception('Unknown column %s' % column)
+
+    def mask(self, column, values):
+        """ Boolean array of rows where column is one of values """
+        codes, labels = self.key(column)
+        wanted = [code for code, label in enumerate(labels) if label in values]
+        return np.isin(codes, wanted)
+
+    def select(self, where=None, date_from=None, date_to=None):
+        selected = np.ones(self.size, dtype=bool)
+        for column, values in (where or {}).items():
+            selected &= self.mask(column, values)
+        if date_from:
+            selected &= self.date >= np.datetime64(date_from)
+        if date_to:
+            selected &= self.date <= np.datetime64(date_to)
+        return selected
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, date_format)
+    except ValueError:
+        return None
+
+
+def parse_build_number(value):
+    # local and manual runs log refs such as local_<commit> as the build number
+    value = (value or '').strip()
+    return int(value) if value.isdigit() and int(value) < 2 ** 31 else -1
+
+
+def group_keys(columns, by, selected):
+    """ Return (group index of each selected row, list of label tuples for each group) """
+    if not by:
+        return np.zeros(np.count_nonzero(selected), dtype=np.int64), [()]
+    keys = [columns.key(column) for column in by]
+    combined = np.zeros(np.count_nonzero(selected), dtype=np.int64)
+    for codes, labels in keys:
+        combined = combined * max(len(labels), 1) + codes[selected]
+    unique_keys, groups = np.unique(combined, return_inverse=True)
+    labels = []
+    for value in unique_keys:
+        label = []
+        for codes, key_labels in reversed(keys):
+            value, code = divmod(int(value), max(len(key_labels), 1))
+            label.insert(0, key_labels[code])
+        labels.append(tuple(label))
+    return groups.reshape(-1), labels
+
+
+def group(columns, by, selected, rate_statuses=None):
+    groups, labels = group_keys(columns, by, selected)
+    counts = np.bincount(groups, minlength=len(labels))
+    results = []
+    # share of each group within the groups that have the same values for all but the last column
+    parents = {}
+    for label, count in zip(labels, counts):
+        parents[label[:-1]] = parents.get(label[:-1], 0) + count
+    if rate_statuses:
+        matches = columns.mask('status', rate_statuses)[selected]
+        rate_counts = np.bincount(groups, weights=matches, minlength=len(labels))
+    for index, (label, count) in enumerate(zip(labels, counts)):
+        if not count:
+            continue
+        result = dict(zip(by, label))
+        result['count'] = int(count)
+        if by:
+            result['share'] = round(float(count) / parents[label[:-1]], 4)
+        if rate_statuses:
+            result['matching'] = int(rate_counts[index])
+            result['rate'] = round(float(rate_counts[index]) / count, 4)
+        results.append(result)
+    return results
+
+
+def latency(columns, by, selected):
+    """
+    Hours from the first log row for a repository (name, owner) to the row where it is installed.  Rows
+    after an installation start a new request for the repository.  The dates in the log are when each
+    attempt finished, so an installation that succeeded at the first attempt has a latency of 0.
+    Groups are taken from the Installed rows.
+    """
+    order = np.lexsort((np.arange(columns.size), columns.date, columns.codes['owner'], columns.codes['name']))
+    repository = (columns.codes['name'].astype(np.int64) * (len(columns.categories['owner']) + 1) + columns.codes['owner'])[order]
+    installed = columns.mask('status', ['Installed'])[order]
+    starts = np.ones(columns.size, dtype=bool)
+    starts[1:] = (repository[1:] != repository[:-1]) | installed[:-1]
+    start_positions = np.maximum.accumulate(np.where(starts, np.arange(columns.size), 0))
+    dates = columns.date[order]
+    hours = (dates - dates[start_positions]).astype('timedelta64[s]').astype(np.float64) / 3600
+
+    rows = np.zeros(columns.size, dtype=bool)
+    rows[order[installed]] = True
+    rows &= selected & ~np.isnat(columns.date)
+    row_hours = np.empty(columns.size)
+    row_hours[order] = hours
+    row_hours = row_hours[rows]
+
+    groups, labels = group_keys(columns, by, rows)
+    sort_order = np.lexsort((row_hours, groups))
+    sorted_hours = row_hours[sort_order]
+    counts = np.bincount(groups, minlength=len(labels))
+    group_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    results = []
+    for label, start, count in zip(labels, group_starts, counts):
+        if not count:
+            continue
+        values = sorted_hours[start:start + count]
+        result = dict(zip(by, label))
+        result.update({
+            'count': int(count),
+            'median_hours': round(float(np.median(values)), 2),
+            'mean_hours': round(float(values.mean()), 2),
+            'max_hours': round(float(values.max()), 2),
+        })
+        results.append(result)
+    return results
+
+
+def write_results(results, output_format, outfile=None):
+    handle = open(outfile, 'w') if outfile else sys.stdout
+    if output_format == 'json':
+        handle.write(json.dumps(results, indent=2) + '\n')
+    elif results:
+        writer = csv.DictWriter(handle, fieldnames=list(results[0].keys()), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+    if outfile:
+        handle.close()
+
+
+def parse_where(values):
+    where = {}
+    for value in values:
+        column, _, column_values = value.partition('=')
+        where.setdefault(column, []).extend(column_values.split(','))
+    return where
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate queries over the installation log')
+    parser.add_argument('-l', '--log_file', help='Installation log tsv', default=default_log_file)
+    parser.add_argument('--refresh', help='Rebuild the cached columns', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    group_parser = subparsers.add_parser('group', help='Count rows by one or more columns')
+    group_parser.add_argument('--rate', nargs='*', metavar='STATUS', help=(
+        'Add the number and rate of rows in each group with these statuses.  Default statuses are %s' % ', '.join(failure_statuses)
+    ))
+    latency_parser = subparsers.add_parser('latency', help='Time from the first attempt at a repository to its installation')
+    key_columns = list(categorical_columns) + list(date_columns) + ['build']
+    for subparser in [group_parser, latency_parser]:
+        subparser.add_argument('-b', '--by', nargs='*', default=[], choices=key_columns, help='Columns to group by')
+        subparser.add_argument('-w', '--where', action='append', default=[], help=(
+            'Select rows where COLUMN has one of comma separated values, i.e. category=Install or status=Installed,Already Installed'
+        ))
+        subparser.add_argument('--date_from', help='Earliest date (YYYY-MM-DD)')
+        subparser.add_argument('--date_to', help='Latest date (YYYY-MM-DD)')
+        subparser.add_argument('-s', '--sort', help='Sort results by this field, largest first')
+        subparser.add_argument('-n', '--limit', help='Number of results to write', type=int)
+        subparser.add_argument('-f', '--format', help='Output format', choices=['csv', 'json'], default='csv')
+        subparser.add_argument('-o', '--outfile', help='File to write results to.  Default is stdout')
+    args = parser.parse_args()
+
+    columns = LogColumns(args.log_file)
+    if args.refresh and os.path.exists(columns.cache_path):
+        os.remove(columns.cache_path)
+    columns.load()
+    date_to = args.date_to + 'T23:59:59' if args.date_to else None
+    selected = columns.select(parse_where(args.where), date_from=args.date_from, date_to=date_to)
+    if args.command == 'group':
+        rate_statuses = (args.rate or failure_statuses) if args.rate is not None else None
+        results = group(columns, args.by, selected, rate_statuses=rate_statuses)
+    else:
+        results = latency(columns, args.by, selected)
+    if args.sort:
+        results.sort(key=lambda result: result[args.sort], reverse=True)
+    write_results(results[:args.limit] if args.limit else results, args.format, args.outfile)
+
+
+if __name__ == "__main__":
+    main()
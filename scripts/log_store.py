@@ -0,0 +1,207 @@
+import os
+import csv
+import sqlite3
+import uuid
+import hashlib
+import argparse
+from datetime import datetime
+
+"""
+Indexed sqlite copy of automated_tool_installation_log.tsv.  The tsv file remains the record of tool
+installations and is only ever appended to, so the store keeps track of how many bytes of the tsv it has
+read and ingests new rows from there.  If the part of the file that has already been read changes, the
+store is rebuilt from scratch.
+
+Rows are returned as dicts with the same keys as the tsv header, in the order they appear in the tsv.
+"""
+
+default_log_file = 'automated_tool_installation_log.tsv'
+
+# columns of automated_tool_installation_log.tsv, also used for rows written during a build without a header
+log_columns = [
+    'Category', 'Build Num.', 'Date (AEST)', 'Name', 'New Tool', 'Status', 'Owner', 'Installed Revision',
+    'Requested Revision', 'Failing Step', 'Staging tests passed', 'Production tests passed', 'Section Label',
+    'Tool Shed URL', 'Log Path',
+]
+date_format = '%d/%m/%y %H:%M:%S'
+
+# sqlite column for each log column
+db_columns = [
+    'category', 'build_num', 'date', 'name', 'new_tool', 'status', 'owner', 'installed_revision',
+    'requested_revision', 'failing_step', 'staging_tests_passed', 'production_tests_passed', 'section_label',
+    'tool_shed_url', 'log_path',
+]
+
+
+class LogStore:
+    def __init__(self, log_file=default_log_file, db_path=None):
+        self.log_file = log_file
+        self.db_path = db_path or os.path.splitext(log_file)[0] + '.sqlite'
+        self.connection = sqlite3.connect(self.db_path, timeout=60)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rows (row_num INTEGER PRIMARY KEY, %s, date_iso TEXT)' % ', '.join(db_columns)
+        )
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        for index_columns in [('category', 'build_num'), ('name', 'owner'), ('owner',), ('status',), ('date_iso',)]:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS rows_%s ON rows (%s)' % ('_'.join(index_columns), ', '.join(index_columns)))
+        self.connection.commit()
+
+    def sync(self):
+        """ Ingest rows appended to the tsv since the last sync.  Returns the number of new rows """
+        offset = int(self.get_meta('offset') or 0)
+        with open(self.log_file, 'rb') as handle:
+            checksum = get_checksum(handle, offset)
+            if offset and self.get_meta('checksum') != checksum.hexdigest():
+                self.clear()
+                offset = 0
+                checksum = hashlib.sha1()
+            handle.seek(offset)
+            data = handle.read()
+        if offset == 0:
+            header, _, data = data.partition(b'\n')
+            offset = len(header) + 1
+            checksum.update(header + b'\n')
+            if header.decode().rstrip('\r').split('\t') != log_columns:
+                raise Exception('Unexpected header in %s' % self.log_file)
+            self.set_meta('generation', uuid.uuid4().hex)
+        # ingest complete lines only, a partly written row will be read on the next sync
+        complete_length = data.rfind(b'\n') + 1
+        lines = data[:complete_length].decode().splitlines()
+        row_count = self.count()
+        new_rows = []
+        for values in csv.reader(lines, dialect='excel-tab'):
+            values = (values + [''] * len(db_columns))[:len(db_columns)]
+            new_rows.append([row_count + len(new_rows)] + values + [parse_date(values[2])])
+        self.connection.executemany('INSERT INTO rows VALUES (%s)' % ', '.join(['?'] * (len(db_columns) + 2)), new_rows)
+        offset += complete_length
+        checksum.update(data[:complete_length])
+        self.set_meta('checksum', checksum.hexdigest())
+        self.set_meta('offset', offset)
+        self.connection.commit()
+        return len(new_rows)
+
+    def get_generation(self):
+        """ Identifier that changes whenever the store is rebuilt, for caches derived from the store """
+        return self.get_meta('generation')
+
+    def count(self):
+        [row_count] = self.connection.execute('SELECT COUNT(*) FROM rows').fetchone()
+        return row_count
+
+    def clear(self):
+        self.connection.execute('DELETE FROM rows')
+        self.connection.execute('DELETE FROM meta')
+
+    def get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def query(self, **kwargs):
+        """
+        Return rows matching all of the given values.  date_from and date_to are datetime objects
+        and row_from and row_to are 0-based row numbers, all inclusive.
+        """
+        return [row for row_num, row in self.iter_rows(**kwargs)]
+
+    def iter_rows(self, category=None, build_number=None, name=None, owner=None, status=None,
+                  date_from=None, date_to=None, row_from=None, row_to=None):
+        """ Yield (row number, row) for rows matching the arguments to query, without loading them all """
+        conditions = []
+        params = []
+        for column, value in [('category', category), ('build_num', build_number), ('name', name), ('owner', owner), ('status', status)]:
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                params.append(str(value))
+        for column, operator, value in [
+            ('date_iso', '>=', date_from and date_from.isoformat(sep=' ')),
+            ('date_iso', '<=', date_to and date_to.isoformat(sep=' ')),
+            ('row_num', '>=', row_from),
+            ('row_num', '<=', row_to),
+        ]:
+            if value is not None:
+                conditions.append('%s %s ?' % (column, operator))
+                params.append(value)
+        sql = 'SELECT row_num, %s FROM rows' % ', '.join(db_columns)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY row_num'
+        for values in self.connection.execute(sql, params):
+            yield values[0], dict(zip(log_columns, values[1:]))
+
+    def get_build_range(self, category, build_number):
+        """ Return the first and last row numbers of a build, or None if the build is not in the log """
+        first, last = self.connection.execute(
+            'SELECT MIN(row_num), MAX(row_num) FROM rows WHERE category = ? AND build_num = ?', (category.title(), str(build_number))
+        ).fetchone()
+        return (first, last) if first is not None else None
+
+    def get_previous_build_number(self, category, build_number):
+        """ Return the highest build number of a category that is lower than build_number """
+        [previous] = self.connection.execute(
+            'SELECT MAX(CAST(build_num AS INTEGER)) FROM rows WHERE category = ? AND CAST(build_num AS INTEGER) < ?',
+            (category.title(), int(build_number)),
+        ).fetchone()
+        return previous
+
+    def close(self):
+        self.connection.close()
+
+
+def get_checksum(handle, offset):
+    # sha1 of everything before offset so that any change to rows that have already been read is detected
+    handle.seek(0)
+    checksum = hashlib.sha1()
+    remaining = offset
+    while remaining > 0:
+        block = handle.read(min(remaining, 1 << 20))
+        if not block:
+            break
+        checksum.update(block)
+        remaining -= len(block)
+    return checksum
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, date_format).isoformat(sep=' ')
+    except ValueError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync and query the indexed copy of the installation log')
+    parser.add_argument('-l', '--log_file', help='Installation log tsv', default=default_log_file)
+    parser.add_argument('--rebuild', help='Rebuild the store from the start of the log', action='store_true')
+    parser.add_argument('-c', '--category', help='Install or Update')
+    parser.add_argument('-b', '--build_number', help='Build number')
+    parser.add_argument('-n', '--name', help='Tool name')
+    parser.add_argument('-o', '--owner', help='Tool owner')
+    parser.add_argument('-s', '--status', help='Installation status, e.g. Installed')
+    parser.add_argument('--date_from', help='Earliest date (YYYY-MM-DD)')
+    parser.add_argument('--date_to', help='Latest date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    store = LogStore(args.log_file)
+    if args.rebuild:
+        store.clear()
+    store.sync()
+    rows = store.query(
+        category=args.category.title() if args.category else None,
+        build_number=args.build_number,
+        name=args.name,
+        owner=args.owner,
+        status=args.status,
+        date_from=datetime.strptime(args.date_from, '%Y-%m-%d') if args.date_from else None,
+        date_to=datetime.strptime(args.date_to + ' 23:59:59', '%Y-%m-%d %H:%M:%S') if args.date_to else None,
+    )
+    store.close()
+    print('\t'.join(log_columns))
+    for row in rows:
+        print('\t'.join(row[column] for column in log_columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,31 @@
 import yaml
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from bioblend.galaxy import GalaxyInstance
-from bioblend.toolshed import ToolShedInstance
+import tool_yaml
+from utils import get_toolshed_instance, get_repository_snapshot
+from toolshed_cache import ToolShedCache, CachedToolShedClient, get_installable_revision, default_cache_path, default_ttl
+from install_queue import make_entry, write_manifest, get_revision, default_tool_shed
+from dependency_graph import build_graph
 
 trusted_owners_file = 'trusted_owners.yml'
 
 """
 Preprocess files in shed-tools format, outputting one file per tool shed repository to install.  If the flag
 --update_existing is used, look for new repositories based on the current lists of installed repositories
-in --source_directory.
+in --source_directory.  With --manifest, the fields of every file written are also listed in a single
+JSON lines file for install_queue.py.
+
+With --preflight, requests for the latest revision are resolved to the latest installable revision, which is
+recorded as resolved_revision in the manifest while the tool file and the log keep 'latest', and every
+revision is looked up in the repository lists of production and staging (see get_repository_snapshot) so that
+the installation scripts can skip revisions that are already installed without running shed-tools.  The
+preflight field of the manifest entry is 'already_installed' if the revision is installed on production,
+'staging_installed' if it is installed on staging only, and empty otherwise.
+
+With --dependency_order, manifest entries are written in the install levels of dependency_graph.py with the
+entries each one depends on, which install_queue.py waits for before claiming it.
 """
 
 def main():
@@ -19,6 +34,10 @@ def main():
     parser.add_argument('-f', '--files', help='Tool input files', nargs='+')  # mandatory unless --update_existing is true
     parser.add_argument('-g', '--production_url', help='Galaxy server URL')
     parser.add_argument('-a', '--production_api_key', help='API key for galaxy server')
+    parser.add_argument('--staging_url', help='Staging Galaxy server URL, for --preflight')
+    parser.add_argument('--staging_api_key', help='API key for the staging server')
+    parser.add_argument('--preflight', help='Resolve latest revisions and look for revisions that are already installed', action='store_true')
+    parser.add_argument('--dependency_order', help='Write the manifest in order of repository dependencies', action='store_true')
     parser.add_argument('--skip_list', help='List of tools to skip (one line per tool, <name>@<revision>)')
     parser.add_argument(
         '--update_existing',
@@ -26,6 +45,18 @@ def main():
         action='store_true',
     )
     parser.add_argument('-s', '--source_directory', help='Directory containing tool yml files')
+    parser.add_argument('-m', '--manifest', help='Path of a JSON lines manifest of the files written (see install_queue.py)')
+    parser.add_argument('--cache_path', help='Path of the tool shed response cache', default=default_cache_path)
+    parser.add_argument('--cache_ttl', help='Seconds before cached installable revisions are refetched', type=int, default=default_ttl)
+    parser.add_argument('--no_cache', '--no-cache', help='Query the tool shed without using the response cache', action='store_true')
+    parser.add_argument('--refresh', help='Ignore cached tool shed responses but store new ones', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of tool shed queries to run concurrently', type=int, default=1)
+    parser.add_argument('--rate_limit', help='Maximum requests per second to each tool shed', type=float, default=10)
+    parser.add_argument(
+        '--snapshot_dir',
+        help='Directory for repository list snapshots shared within a build',
+        default=os.environ.get('REPOSITORY_SNAPSHOT_DIR'),
+    )
 
     args = parser.parse_args()
 
@@ -46,12 +77,11 @@ def main():
 
     tools = []
     for file in files:
-        with open(file) as input:
-            content = yaml.safe_load(input.read())['tools']
-            if isinstance(content, list):
-                tools += content
-            else:
-                tools.append(content)  # TODO: is it ever not a list?
+        content = tool_yaml.load_file(file)['tools']
+        if isinstance(content, list):
+            tools += content
+        else:
+            tools.append(content)  # TODO: is it ever not a list?
 
     if update:  # update tools with trusted owners where updates are available
         if not production_url and production_api_key:
@@ -61,18 +91,39 @@ def main():
             trusted_owners = yaml.safe_load(infile.read())['trusted_owners']
 
         # load repository data to check which tools have updates available
-        galaxy_instance = GalaxyInstance(production_url, production_api_key)
-        repos = galaxy_instance.toolshed.get_repositories()
-        installed_repos = [r for r in repos if r['status'] == 'Installed']  # Skip deactivated repos
+        repos = get_repository_snapshot(production_url, production_api_key, snapshot_dir=args.snapshot_dir)
+
+        cache = None
+        if not args.no_cache:
+            cache = ToolShedCache(path=args.cache_path, ttl=args.cache_ttl, refresh=args.refresh)
+
+        # one client per tool shed, shared by all worker threads
+        toolsheds = {}
+        for shed in set(t['tool_shed_url'] for t in tools):
+            toolshed = get_toolshed_instance(shed, pool_size=args.workers, rate_limit=args.rate_limit)
+            toolsheds[shed] = CachedToolShedClient(toolshed, shed, cache=cache)
 
         trusted_tools = [t for t in tools if t['owner'] in [entry['owner'] for entry in trusted_owners]]
+        # The repository lists of the trusted owners are compared in memory: repositories that are missing or
+        # deleted are skipped without querying them, and with a cache, installable revisions are only refetched
+        # for repositories whose update time has changed.  The lists carry no revisions, so the revisions of
+        # other repositories are still queried one at a time
+        catalogues = get_owner_catalogues(trusted_tools, toolsheds, workers=args.workers)
         print('Checking for updates from %d tools' % len(trusted_tools))
+        with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+            futures = [
+                executor.submit(
+                    get_new_revision, tool, repos, trusted_owners, toolsheds[tool['tool_shed_url']],
+                    catalogues.get((tool['tool_shed_url'], tool['owner'])),
+                )
+                for tool in trusted_tools
+            ]
+            for i, future in enumerate(as_completed(futures)):
+                if i > 0 and i % 100 == 0:
+                    print('%d/%d' % (i, len(trusted_tools)))
         tools = []
-        for i, tool in enumerate(trusted_tools):
-            if i > 0 and i % 100 == 0:
-                print('%d/%d' % (i, len(trusted_tools)))
-            new_revision_info = get_new_revision(tool, installed_repos, trusted_owners)
-
+        for tool, future in zip(trusted_tools, futures):  # keep the order of the input files
+            new_revision_info = future.result()
             if new_revision_info:
                 extraneous_keys = [key for key in tool.keys() if key not in ['name', 'owner', 'tool_panel_section_label', 'tool_shed_url']]
                 for key in extraneous_keys:
@@ -80,6 +131,8 @@ def main():
                 tool.update(new_revision_info)
                 tools.append(tool)
         print('%d tools with updates available' % len(tools))
+        if cache:
+            cache.close()
 
     if args.skip_list:
         with open(args.skip_list) as handle:
@@ -87,18 +140,109 @@ def main():
     else:
         skip_list = None
 
+    if args.preflight:
+        if not (production_url and production_api_key):
+            raise Exception('--production_url and --production_api_key arguments are required when --preflight flag is used')
+        resolve_latest_revisions(tools, workers=args.workers, rate_limit=args.rate_limit)
+
+    entries = []
     for tool in tools:
         if 'revisions' in tool.keys():
             for rev in tool['revisions']:
                 new_tool = tool
                 new_tool['revisions'] = [rev]
                 if not skip_list or '%s@%s' % (new_tool['name'], rev) not in skip_list:
-                    write_output_file(path=path, tool=new_tool)
+                    entries.append(write_output_file(path=path, tool=new_tool))
         else:
-            write_output_file(path=path, tool=tool)
+            entries.append(write_output_file(path=path, tool=tool))
+
+    if args.preflight:
+        snapshots = {'production': get_repository_snapshot(production_url, production_api_key, snapshot_dir=args.snapshot_dir)}
+        if args.staging_url and args.staging_api_key:
+            snapshots['staging'] = get_repository_snapshot(args.staging_url, args.staging_api_key, snapshot_dir=args.snapshot_dir)
+        for entry in entries:
+            entry['preflight'] = get_preflight_status(entry, snapshots)
+        print('%d of %d revisions already installed on production, %d on staging only' % (
+            len([e for e in entries if e['preflight'] == 'already_installed']),
+            len(entries),
+            len([e for e in entries if e['preflight'] == 'staging_installed']),
+        ))
+
+    if args.dependency_order:
+        graph_cache = None if args.no_cache else ToolShedCache(path=args.cache_path, ttl=args.cache_ttl, refresh=args.refresh)
+        graph = build_graph(entries, cache=graph_cache, workers=args.workers)
+        entries = graph.ordered_entries()
+        if graph.cyclic:
+            print('Dependency cycle between %s' % ', '.join(graph.cyclic))
 
+    if args.manifest:
+        write_manifest(args.manifest, entries)
 
-def get_new_revision(tool, repos, trusted_owners):
+
+def resolve_latest_revisions(tools, workers=1, rate_limit=None):
+    """
+    Set resolved_revision of tools without revisions to the latest installable revision, as shed-tools would
+    install.  The tool files and the log keep 'latest' as the requested revision.  Tools whose revisions cannot
+    be fetched are left for shed-tools to resolve
+    """
+    latest_tools = [tool for tool in tools if not tool.get('revisions')]
+    if not latest_tools:
+        return
+    toolsheds = {}
+    for shed in set(tool.get('tool_shed_url') or default_tool_shed for tool in latest_tools):
+        toolsheds[shed] = get_toolshed_instance(shed, pool_size=workers, rate_limit=rate_limit)
+
+    def get_latest_revision(tool):
+        toolshed = toolsheds[tool.get('tool_shed_url') or default_tool_shed]
+        try:
+            return toolshed.repositories.get_ordered_installable_revisions(tool['name'], tool['owner'])[-1]
+        except Exception as e:
+            print('Could not resolve latest revision of %s: %s' % (tool['name'], str(e)))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for tool, revision in zip(latest_tools, executor.map(get_latest_revision, latest_tools)):
+            if revision:
+                print('Latest installable revision of %s is %s' % (tool['name'], revision))
+                tool['resolved_revision'] = revision
+
+
+def get_preflight_status(entry, snapshots):
+    """ Whether the revision of a manifest entry is installed on production or staging, matching shed-tools """
+    def is_installed(server):
+        if server not in snapshots:
+            return False
+        repos = snapshots[server].find(entry['name'], entry['owner'], statuses=['Installed'])
+        return any(get_revision(entry) in [r['changeset_revision'], r['installed_changeset_revision']] for r in repos)
+
+    if is_installed('production'):
+        return 'already_installed'
+    elif is_installed('staging'):
+        return 'staging_installed'
+    return ''
+
+
+def get_owner_catalogues(tools, toolsheds, workers=1):
+    """
+    Return {(tool shed, owner): {name: repository}} for the owners of tools.  Owners whose repositories
+    cannot be listed are left out and their repositories are looked up one at a time
+    """
+    keys = sorted(set((tool['tool_shed_url'], tool['owner']) for tool in tools))
+
+    def get_catalogue(key):
+        shed, owner = key
+        try:
+            return toolsheds[shed].get_owner_repositories(owner)
+        except Exception as e:
+            print('Could not list repositories of %s on %s: %s' % (owner, shed, str(e)))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        catalogues = {key: catalogue for key, catalogue in zip(keys, executor.map(get_catalogue, keys)) if catalogue is not None}
+    print('Listed %d repositories of %d owners' % (sum(len(catalogue) for catalogue in catalogues.values()), len(catalogues)))
+    return catalogues
+
+
+def get_new_revision(tool, repos, trusted_owners, toolshed, catalogue=None):
     matching_owners = [o for o in trusted_owners if tool['owner'] == o['owner']]
     if not matching_owners:
         return
@@ -108,13 +252,21 @@ def get_new_revision(tool, repos, trusted_owners):
     if 'all' in skipped_revisions:
         return
 
-    matching_repos = [r for r in repos if r['name'] == tool['name'] and r['owner'] == tool['owner']]
+    matching_repos = repos.find(tool['name'], tool['owner'], statuses=['Installed'])  # Skip deactivated repos
     if not matching_repos:
         return
 
-    toolshed = ToolShedInstance(url='https://' + tool['tool_shed_url'])
+    repository = None
+    if catalogue is not None:
+        repository = catalogue.get(tool['name'])
+        if not repository or repository.get('deleted'):
+            print('Skipping %s.  Repository is not listed for %s on %s' % (tool['name'], tool['owner'], tool['tool_shed_url']))
+            return
     try:
-        latest_revision = toolshed.repositories.get_ordered_installable_revisions(tool['name'], tool['owner'])[-1]
+        installable_revisions = toolshed.get_ordered_installable_revisions(
+            tool['name'], tool['owner'], update_time=repository.get('update_time') if repository else None
+        )
+        latest_revision = installable_revisions[-1]
     except Exception as e:
         print('Skipping %s.  Error querying tool revisions: %s' % (tool['name'], str(e)))
         return
@@ -129,15 +281,17 @@ def get_new_revision(tool, repos, trusted_owners):
     # it will not be autoremoved in the instance of failing tests
 
     def get_installable_revision_for_revision(revision):
-        # make a call to the toolshed to get a large blob of information about the repository
+        # make a call to the toolshed (or the cache) to get a large blob of information about the repository
         # that includes the hash of the corresponding installable revision.
         try:
-            data = toolshed.repositories.get_repository_revision_install_info(tool['name'], tool['owner'], revision)
-            repository, metadata, install_info = data
-            desc, clone_url, installable_revision, ctx_rev, owner, repo_deps, tool_deps = install_info[tool['name']]
-        except Exception as e:  # KeyError, ValueError, bioblend.ConnectionError, return None
+            data = toolshed.get_repository_revision_install_info(
+                tool['name'], tool['owner'], revision, installable_revisions=installable_revisions
+            )
+        except Exception as e:  # bioblend.ConnectionError, return None
+            data = None
+        installable_revision = get_installable_revision(tool['name'], data)
+        if not installable_revision:
             print('Unexpected result querying install info for %s, %s, %s, returning None' % (tool['name'], tool['owner'], revision))
-            return None
         return installable_revision
 
     latest_installed_revision = sorted(matching_repos, key=lambda x: int(x['ctx_rev']), reverse=True)[0]['changeset_revision']
@@ -153,14 +307,18 @@ def get_new_revision(tool, repos, trusted_owners):
 
 
 def write_output_file(path, tool):
+    """ Write a file for a tool with at most one revision and return its manifest entry """
     [revision] = tool['revisions'] if 'revisions' in tool.keys() else ['latest']
-    version_update = tool.pop('version_update', False)
     file_path = os.path.join(path, '%s@%s.yml' % (tool['name'], revision))
+    entry = make_entry(tool, file_path)
+    tool.pop('resolved_revision', None)  # in the manifest only
+    version_update = tool.pop('version_update', False)
     print('writing file %s' % file_path)
     with open(file_path, 'w') as outfile:
         if version_update:
             outfile.write('# [VERSION_UPDATE]\n')
         outfile.write(yaml.dump({'tools': [tool]}))
+    return entry
 
 
 if __name__ == "__main__":
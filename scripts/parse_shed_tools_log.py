@@ -0,0 +1,64 @@
+import re
+import sys
+import json
+import shlex
+import argparse
+
+"""
+Extract all values of interest from a shed-tools install or test log in a single pass.  The log
+is read line by line and reading stops as soon as every field for the log type has been found.
+Values are written to stdout as shell assignments to be used with eval, or as JSON, e.g.
+
+eval "$(python scripts/parse_shed_tools_log.py --type install --prefix SHED_TOOLS_ $INSTALL_LOG)"
+
+sets SHED_TOOLS_STATUS, SHED_TOOLS_NAME, SHED_TOOLS_REVISION and SHED_TOOLS_ALREADY_INSTALLED.
+Fields that are not found in the log are empty strings.
+"""
+
+# (field names, pattern) pairs.  Each field is set from the first line that matches its pattern.
+patterns = {
+    'install': [
+        (['STATUS', 'NAME', 'REVISION'], re.compile(r"(\w+) repositories \(1\): \[\('([^']+)',\s*u?'(\w+)'\)\]")),
+        (['ALREADY_INSTALLED'], re.compile(r"Repository (\w+) is already installed")),
+    ],
+    'test': [
+        (['TESTS_PASSED'], re.compile(r"Passed tool tests \((\d+)\)")),
+        (['TESTS_FAILED'], re.compile(r"Failed tool tests \((\d+)\)")),
+    ],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract installation status or test results from a shed-tools log')
+    parser.add_argument('-t', '--type', help='Type of log', choices=patterns.keys(), required=True)
+    parser.add_argument('-f', '--format', help='Output format', choices=['shell', 'json'], default='shell')
+    parser.add_argument('-p', '--prefix', help='Prefix for shell variable names', default='')
+    parser.add_argument('file_path', help='shed-tools log file')
+    args = parser.parse_args()
+
+    values = parse_log(args.file_path, args.type)
+    if args.format == 'json':
+        sys.stdout.write(json.dumps(values))
+    else:
+        for key, value in values.items():
+            sys.stdout.write('%s%s=%s\n' % (args.prefix, key, shlex.quote(value)))
+
+
+def parse_log(path, log_type):
+    remaining = list(patterns[log_type])
+    values = {field: '' for fields, pattern in remaining for field in fields}
+    with open(path, errors='replace') as logfile:
+        for line in logfile:
+            for entry in list(remaining):
+                fields, pattern = entry
+                match = pattern.search(line)
+                if match:
+                    values.update(zip(fields, match.groups()))
+                    remaining.remove(entry)
+            if not remaining:
+                break
+    return values
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_galaxy_instance, get_valid_tools_for_repo
+from install_queue import read_manifest, get_revision
+from build_events import EventLog, timed
+
+"""
+Install the conda environments of the tools in a manifest written by organise_request_files.py on a Galaxy
+server before the repositories themselves are installed, so that the dependency step of each
+`shed-tools install --install_tool_dependencies` finds the environments already built.
+
+The requirements of each tool are read from the tool shed metadata of the repository revision (valid_tools).
+Galaxy installs a single requirement through its API, as a __name@version environment, which is only the
+environment Galaxy resolves for tools with exactly one requirement: tools with several requirements resolve
+to a combined (mulled) environment.  Only the requirements of tools with one package requirement are
+installed.  Requirements shared by several tools are installed once, requirements that Galaxy can already
+resolve are skipped, and at most --workers installations are sent to Galaxy at once.
+
+Failures are reported but do not change the exit status: the installation step will try again.
+
+python scripts/prewarm_dependencies.py -g $URL -a $API_KEY -m $MANIFEST --workers 4
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Install the requirements of the tools in a manifest on Galaxy ahead of the tools')
+    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
+    parser.add_argument('-a', '--api_key', help='Admin API key for galaxy server', required=True)
+    parser.add_argument('-m', '--manifest', help='Manifest written by organise_request_files.py', required=True)
+    parser.add_argument('--staging', help='Skip revisions that are already installed on staging', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of requirements to install at once', type=int, default=4)
+    parser.add_argument('--timeout', help='Seconds to wait for Galaxy to install one requirement', type=float, default=1800)
+    parser.add_argument('--events_log', help='File to append timing events for each installation to (see build_events.py)')
+    parser.add_argument('--build_number', help='Build number for events', default='')
+    args = parser.parse_args()
+
+    # Revisions found on the servers by organise_request_files.py --preflight are not installed again
+    skipped = ['already_installed', 'staging_installed'] if args.staging else ['already_installed']
+    entries = [entry for entry in read_manifest(args.manifest) if entry.get('preflight') not in skipped]
+    requirements = get_requirements(entries, workers=args.workers)
+    print('%d requirements of %d repositories' % (len(requirements), len(entries)))
+    events = EventLog(args.events_log, build=args.build_number, mode='prewarm', server=args.galaxy_url) if args.events_log else None
+    results = prewarm(args.galaxy_url, args.api_key, requirements, workers=args.workers, timeout=args.timeout, events=events)
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    print(', '.join('%d %s' % (count, status) for status, count in sorted(counts.items())) or 'Nothing to install')
+
+
+def get_requirements(entries, workers=4):
+    """ Return {(name, version): [tool ids]} for the tools of each entry that have one package requirement """
+    def get_valid_tools(entry):
+        try:
+            return get_valid_tools_for_repo(entry['name'], entry['owner'], get_revision(entry), entry['tool_shed_url']) or []
+        except Exception as e:
+            print('Could not get tools for %s %s from %s: %s' % (entry['name'], get_revision(entry), entry['tool_shed_url'], e))
+            return []
+
+    requirements = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for valid_tools in executor.map(get_valid_tools, entries):
+            for tool in valid_tools:
+                packages = [r for r in tool.get('requirements') or [] if r.get('type', 'package') == 'package']
+                if len(packages) != 1:  # built as a mulled environment when the tool is installed
+                    continue
+                key = (packages[0]['name'], packages[0].get('version') or '')
+                requirements.setdefault(key, []).append(tool.get('id'))
+    return requirements
+
+
+def prewarm(url, api_key, requirements, workers=4, timeout=1800, events=None):
+    """ Install each requirement that Galaxy cannot resolve.  Returns {(name, version): status} """
+    galaxy = get_galaxy_instance(url, api_key)
+    endpoint = '%s/dependency_resolvers/dependency' % galaxy.url
+
+    def install(requirement):
+        name, version = requirement
+        params = {'name': name, 'type': 'package', 'exact': bool(version)}
+        if version:
+            params['version'] = version
+        try:
+            resolved = galaxy.make_get_request(endpoint, params=params).json()
+            if resolved.get('dependency_type'):
+                return 'already resolved'
+            with timed(events, 'prewarm_dependency', tool=name, revision=version):
+                response = galaxy.send('POST', endpoint, params=params, headers=galaxy.json_headers, timeout=(10, timeout))
+                result = galaxy.decode(response)
+        except Exception as e:
+            sys.stderr.write('Could not install %s %s on %s: %s\n' % (name, version, url, e))
+            return 'failed'
+        if result and result.get('dependency_type'):
+            print('Installed %s %s (%s)' % (name, version, result['dependency_type']))
+            return 'installed'
+        print('Galaxy could not install %s %s' % (name, version))
+        return 'failed'
+
+    keys = sorted(requirements)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return dict(zip(keys, executor.map(install, keys)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import yaml
+import tool_yaml
 from collections import defaultdict
 import re
 import os
@@ -24,6 +24,7 @@ def main():
     parser = argparse.ArgumentParser(description="Splits up a Ephemeris `get_tool_list` yml file for a Galaxy server into individual files for each Section Label.")
     parser.add_argument("-i", "--infile", help="The returned `get_tool_list` yml file to split.")
     parser.add_argument("-o", "--outdir", help="The output directory to put the split files into. Defaults to infile without the .yml.")
+    parser.add_argument("--prune", action='store_true', help="Delete .yml files in the output directory for sections that no longer have tools")
     parser.add_argument("--version", action='store_true')
     parser.add_argument("--verbose", action='store_true')
 
@@ -35,7 +36,7 @@ def main():
 
     filename = args.infile
 
-    a = yaml.safe_load(open(filename, 'r'), )
+    a = tool_yaml.safe_load(open(filename, 'r'), )
     outdir = re.sub('\.yml', '', filename)
     if args.outdir:
         outdir = args.outdir
@@ -51,17 +52,43 @@ def main():
     for tool in tools:
         categories[tool['tool_panel_section_label']].append(tool)
 
+    written_files = []
     for cat in categories:
         fname = str(cat)
         good_fname = outdir + "/" + slugify(fname) + ".yml"
-        tool_yaml = {'tools': sorted(categories[cat], key=lambda x: x['name'] + x['owner'])}
         if args.verbose:
             print("Working on: %s" % good_fname)
-        with open(good_fname, 'w') as outfile:
-            yaml.dump(tool_yaml, outfile, default_flow_style=False)
+        write_tool_file(good_fname, categories[cat])
+        written_files.append(good_fname)
+
+    if args.prune:
+        for fname in os.listdir(outdir):
+            path = outdir + "/" + fname
+            if fname.endswith('.yml') and path not in written_files:
+                if args.verbose:
+                    print("Removing: %s" % path)
+                os.remove(path)
 
     return
 
 
+def write_tool_file(path, tools):
+    """
+    Write a section file with tools sorted by name and owner.  The file is only rewritten if its
+    contents change, and is replaced atomically.  Returns True if the file was written.
+    """
+    section = {'tools': sorted(tools, key=lambda x: x['name'] + x['owner'])}
+    content = tool_yaml.dump(section, default_flow_style=False)
+    if os.path.exists(path):
+        with open(path) as infile:
+            if infile.read() == content:
+                return False
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import threading
+
+from utils import get_galaxy_instance, get_valid_tools_for_repo
+from parse_shed_tools_log import parse_log
+
+"""
+Store the results of shed-tools tests so that a repository revision that has already passed its tests
+need not be tested again.  A result is keyed by the repository name, owner, installed revision and tool shed,
+the Galaxy server and a fingerprint of the dependency environment: the resolved requirements of each tool in
+the revision and the Galaxy version.  If any of these change, i.e. a conda environment is rebuilt with
+different packages, the key changes and the tests are run again.
+
+The store is a directory of result files named by key and test json files named by the sha256 of their content:
+<store_dir>/results/<key>.json
+<store_dir>/objects/<sha256>
+
+In jenkins/install_tools.sh, after the tools have been installed and loaded:
+eval "$(python scripts/test_results.py --store_dir $TEST_RESULT_DIR lookup -g $URL -a $API_KEY -n $TOOL_NAME -o $OWNER \
+    -r $INSTALLED_REVISION -t $TOOL_SHED_URL --reuse --test_json $TEST_JSON)"
+sets TEST_RESULT_KEY and, if there is a passing result that is still valid, REUSED_TESTS_PASSED,
+REUSED_TESTS_FAILED and REUSED_BUILD and copies the stored test json to --test_json.  After the tests are run:
+python scripts/test_results.py --store_dir $TEST_RESULT_DIR record -k $TEST_RESULT_KEY -l $TEST_LOG -j $TEST_JSON -b $BUILD_NUMBER
+
+Only results without failed tests are reused: failing tests are run again in case the failure was transient.
+"""
+
+default_max_age_days = 30
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Look up and record shed-tools test results')
+    parser.add_argument('--store_dir', help='Directory of the test result store', required=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    lookup_parser = subparsers.add_parser('lookup', help='Write the key for a repository revision and any reusable result as shell assignments')
+    lookup_parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
+    lookup_parser.add_argument('-a', '--api_key', help='API key for galaxy server', required=True)
+    lookup_parser.add_argument('-n', '--name', help='Repository name', required=True)
+    lookup_parser.add_argument('-o', '--owner', help='Repository owner', required=True)
+    lookup_parser.add_argument('-r', '--revision', help='Installed revision', required=True)
+    lookup_parser.add_argument('-t', '--tool_shed_url', help='Tool shed URL', default='toolshed.g2.bx.psu.edu')
+    lookup_parser.add_argument('--reuse', help='Look for a passing result for the key', action='store_true')
+    lookup_parser.add_argument('--max_age_days', help='Age after which results are not reused', type=float, default=default_max_age_days)
+    lookup_parser.add_argument('-j', '--test_json', help='Path to copy the test json of a reused result to')
+    record_parser = subparsers.add_parser('record', help='Store the result of a test run')
+    record_parser.add_argument('-k', '--key', help='Key written by lookup', required=True)
+    record_parser.add_argument('-l', '--test_log', help='shed-tools test log', required=True)
+    record_parser.add_argument('-j', '--test_json', help='shed-tools test json')
+    record_parser.add_argument('-b', '--build_number', help='Build number', default='')
+    args = parser.parse_args()
+
+    store = TestResultStore(args.store_dir)
+    if args.command == 'lookup':
+        key = get_result_key(args.galaxy_url, args.api_key, args.name, args.owner, args.revision, args.tool_shed_url)
+        values = {'TEST_RESULT_KEY': key or '', 'REUSED_TESTS_PASSED': '', 'REUSED_TESTS_FAILED': '', 'REUSED_BUILD': ''}
+        result = store.get(key, args.max_age_days) if key and args.reuse else None
+        if result:
+            if args.test_json:
+                store.copy_test_json(result, args.test_json)
+            values.update({
+                'REUSED_TESTS_PASSED': str(result['tests_passed']),
+                'REUSED_TESTS_FAILED': str(result['tests_failed']),
+                'REUSED_BUILD': result['build_number'],
+            })
+        for variable, value in values.items():
+            sys.stdout.write('%s=%s\n' % (variable, shlex.quote(value)))
+    else:
+        values = parse_log(args.test_log, 'test')
+        if not values['TESTS_PASSED'] and not values['TESTS_FAILED']:
+            sys.exit('No test results in %s' % args.test_log)
+        store.put(args.key, int(values['TESTS_PASSED'] or 0), int(values['TESTS_FAILED'] or 0), args.test_json, args.build_number)
+
+
+class TestResultStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def result_path(self, key):
+        return os.path.join(self.store_dir, 'results', '%s.json' % key)
+
+    def object_path(self, digest):
+        return os.path.join(self.store_dir, 'objects', digest)
+
+    def get(self, key, max_age_days=default_max_age_days):
+        """ Return the stored result for key if it has no failed tests and is recent enough, otherwise None """
+        try:
+            with open(self.result_path(key)) as handle:
+                result = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if result['tests_failed'] or time.time() - result['time'] > max_age_days * 86400:
+            return None
+        if result['test_json'] and not os.path.exists(self.object_path(result['test_json'])):
+            return None
+        return result
+
+    def put(self, key, tests_passed, tests_failed, test_json=None, build_number=''):
+        digest = None
+        if test_json and os.path.exists(test_json):
+            with open(test_json, 'rb') as handle:
+                content = handle.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if not os.path.exists(self.object_path(digest)):
+                write_atomic(self.object_path(digest), content)
+        result = {
+            'key': key,
+            'tests_passed': tests_passed,
+            'tests_failed': tests_failed,
+            'test_json': digest,
+            'build_number': build_number,
+            'time': time.time(),
+        }
+        write_atomic(self.result_path(key), json.dumps(result, indent=2).encode())
+        return result
+
+    def copy_test_json(self, result, path):
+        if result['test_json']:
+            with open(self.object_path(result['test_json']), 'rb') as handle:
+                write_atomic(path, handle.read())
+
+
+def write_atomic(path, content):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as handle:
+        handle.write(content)
+    os.replace(tmp_path, path)
+
+
+def get_environment_fingerprint(url, api_key, name, owner, revision, tool_shed_url):
+    """
+    Return a hash of the resolved requirements of each tool in the repository revision on the Galaxy server
+    and the Galaxy version, or None if these cannot be found
+    """
+    galaxy = get_galaxy_instance(url, api_key)
+    try:
+        tool_ids = sorted(tool['guid'] for tool in get_valid_tools_for_repo(name, owner, revision, tool_shed_url) or [])
+        environment = {'galaxy_version': galaxy.config.get_version().get('version_major'), 'tools': {}}
+        for tool_id in tool_ids:
+            environment['tools'][tool_id] = sorted([
+                [
+                    requirement.get('name'),
+                    requirement.get('version'),
+                    requirement.get('dependency_type'),
+                    requirement.get('exact'),
+                    requirement.get('environment_path') or requirement.get('path'),
+                    (requirement.get('dependency_resolver') or {}).get('model_class'),
+                ]
+                for requirement in galaxy.tools.requirements(tool_id)
+            ], key=json.dumps)
+    except Exception as e:
+        sys.stderr.write('Could not find the dependency environment of %s %s on %s: %s\n' % (name, revision, url, e))
+        return None
+    return hashlib.sha256(json.dumps(environment, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_result_key(url, api_key, name, owner, revision, tool_shed_url):
+    fingerprint = get_environment_fingerprint(url, api_key, name, owner, revision, tool_shed_url)
+    if not fingerprint:
+        return None
+    server = url.split('://')[-1].strip('/')
+    tool_shed = tool_shed_url.split('://')[-1].strip('/')
+    return hashlib.sha256(json.dumps([name, owner, revision, tool_shed, server, fingerprint]).encode()).hexdigest()
+
+
+if __name__ == "__main__":
+    main()
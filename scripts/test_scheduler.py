@@ -0,0 +1,195 @@
+import os
+import sys
+import glob
+import json
+import heapq
+import argparse
+import statistics
+
+import tool_yaml
+
+"""
+Plan tool tests from the durations recorded in earlier shed-tools test json files, i.e. the
+$LOG_DIR/staging/*.json and $LOG_DIR/production/*.json files written by jenkins/install_tools.sh.
+
+Each test json is summarised once as the total time_seconds of the tests of each repository, the number
+of tests and the time of the longest test.  Summaries are cached by file path, size and modification time
+so that only new test json files are read on later runs.  Repositories are predicted to take the median of their past totals, and
+repositories with no history take the median of all repositories.
+
+Each tool runs up to --max_parallel_tests tests at once (no more than it has tests), so it is predicted
+to take its total time divided by that number, or the time of its longest test if that is longer.  Tools
+are tested longest first and the number of tools tested at once is chosen so that the jobs running at once
+fit within --capacity, the number of jobs the Galaxy server can run together.
+
+python scripts/test_scheduler.py plan --history_dir $LOG_DIR/staging $LOG_DIR/production -d $TOOL_FILE_PATH
+python scripts/test_scheduler.py parallel_tests --history_dir $LOG_DIR -t requests/section.yml
+"""
+
+default_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'usegalaxy-au-tools', 'test_durations.json')
+default_capacity = 16
+default_max_parallel_tests = 4
+cache_version = 1
+
+
+class TestHistory:
+    def __init__(self, history_dirs, cache_path=default_cache_path):
+        self.runs = {}  # (owner, name): list of total seconds of each test run
+        self.test_counts = {}  # (owner, name): largest number of tests in one run
+        self.longest_tests = {}  # (owner, name): list of seconds of the longest test of each run
+        summaries = self.load_summaries(history_dirs, cache_path)
+        for summary in summaries:
+            for repo, values in summary['repositories'].items():
+                owner, name = repo.split('/')
+                self.runs.setdefault((owner, name), []).append(values['seconds'])
+                self.test_counts[(owner, name)] = max(self.test_counts.get((owner, name), 0), values['tests'])
+                self.longest_tests.setdefault((owner, name), []).append(values['longest'])
+        medians = [statistics.median(runs) for runs in self.runs.values()]
+        self.default_seconds = statistics.median(medians) if medians else 60.0
+
+    def load_summaries(self, history_dirs, cache_path):
+        try:
+            with open(cache_path) as handle:
+                cache = json.load(handle)
+            if cache.get('version') != cache_version:
+                raise ValueError
+        except (OSError, ValueError):
+            cache = {'version': cache_version, 'files': {}}
+        paths = []
+        for history_dir in history_dirs:
+            paths.extend(glob.glob(os.path.join(history_dir, '**', '*.json'), recursive=True))
+        summaries = []
+        files = {}
+        for path in sorted(set(os.path.abspath(path) for path in paths)):
+            stat = os.stat(path)
+            cached = cache['files'].get(path)
+            if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                summary = cached['summary']
+            else:
+                summary = summarise_test_json(path)
+            if summary is not None:
+                files[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'summary': summary}
+                summaries.append(summary)
+        if files != cache['files']:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+                with open(tmp_path, 'w') as handle:
+                    json.dump({'version': cache_version, 'files': files}, handle)
+                os.replace(tmp_path, cache_path)
+            except OSError:  # the cache is an optimisation only
+                pass
+        return summaries
+
+    def predict_seconds(self, name, owner):
+        runs = self.runs.get((owner, name))
+        return statistics.median(runs) if runs else self.default_seconds
+
+    def parallel_tests(self, name, owner, max_parallel_tests=default_max_parallel_tests):
+        test_count = self.test_counts.get((owner, name))
+        return max(1, min(test_count, max_parallel_tests)) if test_count else max_parallel_tests
+
+    def predict_wall_seconds(self, name, owner, parallel_tests):
+        """ Predicted time to test a repository running parallel_tests tests at once """
+        longest = statistics.median(self.longest_tests.get((owner, name)) or [0])
+        return max(self.predict_seconds(name, owner) / parallel_tests, longest)
+
+
+def summarise_test_json(path):
+    """
+    Return {'repositories': {owner/name: {'seconds': total, 'tests': count, 'longest': seconds}}} for a
+    shed-tools test json file, or None if it is not one
+    """
+    try:
+        with open(path) as handle:
+            data = json.load(handle)
+        tests = data['tests']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    summary = {'repositories': {}}
+    for test in tests:
+        test_data = test.get('data') or {}
+        seconds = test_data.get('time_seconds')
+        tool_id = test_data.get('tool_id') or ''
+        parts = tool_id.split('/')
+        if seconds is None or 'repos' not in parts or len(parts) < parts.index('repos') + 4:
+            continue
+        owner, name = parts[parts.index('repos') + 1:parts.index('repos') + 3]
+        repo = summary['repositories'].setdefault('%s/%s' % (owner, name), {'seconds': 0.0, 'tests': 0, 'longest': 0.0})
+        repo['seconds'] += seconds
+        repo['tests'] += 1
+        repo['longest'] = max(repo['longest'], seconds)
+    return summary
+
+
+def plan(tools, history, capacity=default_capacity, max_parallel_tests=default_max_parallel_tests):
+    """
+    Return (number of tools to test at once, predicted makespan in seconds, list of tools) where the list
+    is sorted longest first and each tool has predicted_seconds and parallel_tests set
+    """
+    planned = []
+    for tool in tools:
+        parallel_tests = history.parallel_tests(tool['name'], tool['owner'], max_parallel_tests)
+        planned.append(dict(
+            tool,
+            predicted_seconds=round(history.predict_wall_seconds(tool['name'], tool['owner'], parallel_tests), 1),
+            parallel_tests=parallel_tests,
+        ))
+    planned.sort(key=lambda tool: tool['predicted_seconds'], reverse=True)
+    if not planned:
+        return 1, 0, planned
+    # each tool being tested runs parallel_tests jobs at once
+    jobs = [tool['parallel_tests'] for tool in planned]
+    workers = max(1, min(len(planned), capacity // max(1, round(statistics.median(jobs)))))
+    return workers, round(estimate_makespan(planned, workers), 1), planned
+
+
+def estimate_makespan(planned, workers):
+    """ Simulate testing the planned tools in order on workers, returning the time until the last finishes """
+    finish_times = [0.0] * workers
+    for tool in planned:
+        start = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, start + tool['predicted_seconds'])
+    return max(finish_times)
+
+
+def load_tool_files(paths):
+    tools = []
+    for path in paths:
+        content = tool_yaml.load_file(path, cache_dir=None)['tools']
+        for tool in content if isinstance(content, list) else [content]:
+            tools.append({'name': tool['name'], 'owner': tool['owner'], 'file': path})
+    return tools
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan tool tests from past test durations')
+    parser.add_argument('--history_dir', help='Directories containing past test json files', nargs='+', default=[])
+    parser.add_argument('--cache_path', help='Path of the test duration cache', default=default_cache_path)
+    parser.add_argument('-c', '--capacity', help='Number of jobs the Galaxy server can run at once', type=int, default=default_capacity)
+    parser.add_argument('-m', '--max_parallel_tests', help='Most tests to run at once for one tool', type=int, default=default_max_parallel_tests)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    plan_parser = subparsers.add_parser('plan', help='Write the test order and parallelism for tool files as JSON')
+    plan_parser.add_argument('-d', '--tool_dir', help='Directory of tool files, i.e. written by organise_request_files.py')
+    plan_parser.add_argument('-t', '--tool_files', help='Tool files', nargs='*', default=[])
+    parallel_parser = subparsers.add_parser('parallel_tests', help='Print a --parallel_tests value for testing all tools in tool files at once')
+    parallel_parser.add_argument('-t', '--tool_files', help='Tool files', nargs='+', required=True)
+    args = parser.parse_args()
+
+    history = TestHistory(args.history_dir, cache_path=args.cache_path)
+    if args.command == 'plan':
+        paths = list(args.tool_files)
+        if args.tool_dir:
+            paths += sorted(glob.glob(os.path.join(args.tool_dir, '*.yml')))
+        workers, makespan, planned = plan(load_tool_files(paths), history, args.capacity, args.max_parallel_tests)
+        sys.stdout.write(json.dumps({'workers': workers, 'predicted_makespan_seconds': makespan, 'tools': planned}, indent=2) + '\n')
+    else:
+        # shed-tools tests all tools in the files as one queue, so use as many parallel tests as the server can run
+        # unless there are fewer tests than that
+        tools = load_tool_files(args.tool_files)
+        test_count = sum(history.test_counts.get((tool['owner'], tool['name']), args.max_parallel_tests) for tool in tools)
+        print(max(1, min(args.capacity, test_count)))
+
+
+if __name__ == "__main__":
+    main()
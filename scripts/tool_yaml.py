@@ -0,0 +1,76 @@
+import os
+import glob
+import pickle
+import hashlib
+import time
+
+import yaml
+
+try:  # use libyaml when it is available, it is several times faster than the pure python implementation
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+"""
+Shared loading and dumping of tool .yml files.  Parsed files are cached as pickles keyed by a hash of
+the file content so that section files that have not changed since the last run are not parsed again.
+"""
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'usegalaxy-au-tools', 'yaml')
+pruned_cache_dirs = set()  # prune each cache directory at most once per process
+
+
+def safe_load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None, **kwargs):
+    kwargs.setdefault('default_flow_style', False)
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kwargs)
+
+
+def load_file(path, cache_dir=default_cache_dir):
+    """ Load a yaml file, using the parse cache in cache_dir unless cache_dir is None """
+    with open(path, 'rb') as handle:
+        content = handle.read()
+    if not cache_dir:
+        return safe_load(content)
+    cache_path = os.path.join(cache_dir, '%s.pickle' % hashlib.sha1(content).hexdigest())
+    try:
+        with open(cache_path, 'rb') as handle:
+            data = pickle.load(handle)
+        os.utime(cache_path)  # mark as recently used
+        return data
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    data = safe_load(content)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if cache_dir not in pruned_cache_dirs:
+            prune_cache(cache_dir)
+            pruned_cache_dirs.add(cache_dir)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:  # the cache is an optimisation only
+        pass
+    return data
+
+
+def prune_cache(cache_dir, max_age=30 * 24 * 60 * 60):
+    """ Remove cached files that have not been used for max_age seconds """
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(cache_dir, '*.pickle')):
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+
+def iter_tools(directory, cache_dir=default_cache_dir):
+    """ Yield (file path, tool) for every tool in the .yml files of a tool directory """
+    for path in sorted(glob.glob(os.path.join(directory, '*.yml'))):
+        tools = load_file(path, cache_dir=cache_dir)['tools']
+        if not isinstance(tools, list):
+            tools = [tools]
+        for tool in tools:
+            yield path, tool
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import bioblend
+
+"""
+Persistent on-disk cache for tool shed API responses, keyed by (query, tool shed, owner, name, revision).
+The cache is a sqlite database so that one file can be shared by several Jenkins jobs at once.  Entries expire
+after a time-to-live and the least recently used entries are evicted once the cache holds more than max_entries.
+
+Ordered installable revisions change whenever a repository is updated so they are only trusted for ttl seconds.
+Install info for a changeset is effectively immutable: the installable revision that a changeset maps to can only
+move forward while it is the tip of the repository, so a cached value is trusted for as long as the installable
+revision it names is still listed as installable.
+
+The repository list of an owner is fetched in a few requests and gives the update time of every repository.
+Installable revisions are stored with the update time they were fetched at, and are trusted however old they are
+while the repository's update time has not changed.
+"""
+
+default_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'usegalaxy-au-tools', 'toolshed_cache.sqlite')
+default_ttl = 6 * 60 * 60  # six hours
+default_max_entries = 50000
+
+
+class ToolShedCache:
+    def __init__(self, path=default_cache_path, ttl=default_ttl, max_entries=default_max_entries, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh  # if True, ignore cached values but store new responses
+        self.lock = threading.Lock()  # the connection is shared between worker threads
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # autocommit mode: every statement is its own transaction so concurrent jobs never wait long for the lock
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'query TEXT, shed TEXT, owner TEXT, name TEXT, revision TEXT, '
+            'value TEXT, created REAL, accessed REAL, '
+            'PRIMARY KEY (query, shed, owner, name, revision))'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    def get(self, query, shed, owner, name, revision='', ttl=None):
+        """
+        Return the cached value or None if there is no entry younger than ttl.  ttl defaults
+        to self.ttl; use ttl=0 for entries that never expire.
+        """
+        if self.refresh:
+            return None
+        key = (query, shed, owner, name, revision or '')
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, created FROM responses WHERE query=? AND shed=? AND owner=? AND name=? AND revision=?', key
+            ).fetchone()
+            if not row:
+                return None
+            value, created = row
+            ttl = self.ttl if ttl is None else ttl
+            now = time.time()
+            if ttl and now - created > ttl:
+                return None
+            self.connection.execute(
+                'UPDATE responses SET accessed=? WHERE query=? AND shed=? AND owner=? AND name=? AND revision=?', (now,) + key
+            )
+        return json.loads(value)
+
+    def set(self, query, shed, owner, name, value, revision=''):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (query, shed, owner, name, revision or '', json.dumps(value), now, now),
+            )
+
+    def evict(self):
+        """ Remove entries older than any reasonable ttl and trim the cache to max_entries """
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        self.connection.execute('DELETE FROM responses WHERE accessed < ?', (time.time() - 90 * 24 * 60 * 60,))
+        [count] = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,),
+            )
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+class CachedToolShedClient:
+    """
+    Wrap the bioblend tool shed repository client for a single tool shed so that responses are read from
+    and written to a ToolShedCache.  If cache is None every call goes to the tool shed.
+    """
+    def __init__(self, toolshed, tool_shed_url, cache=None):
+        self.toolshed = toolshed
+        self.tool_shed_url = tool_shed_url
+        self.cache = cache
+
+    def get_ordered_installable_revisions(self, name, owner, update_time=None):
+        """
+        Return the installable revisions of a repository, oldest first.  If update_time is the update time of the
+        repository from get_owner_repositories, cached revisions are used if they were fetched at the same update time
+        """
+        query = 'ordered_installable_revisions'
+        if self.cache:
+            if update_time:
+                unchanged = self.cache.get('repository_update_time', self.tool_shed_url, owner, name, ttl=0) == update_time
+                revisions = self.cache.get(query, self.tool_shed_url, owner, name, ttl=0) if unchanged else None
+            else:
+                revisions = self.cache.get(query, self.tool_shed_url, owner, name)
+            if revisions is not None:
+                return revisions
+        revisions = self.toolshed.repositories.get_ordered_installable_revisions(name, owner)
+        if self.cache:
+            self.cache.set(query, self.tool_shed_url, owner, name, revisions)
+            if update_time:
+                self.cache.set('repository_update_time', self.tool_shed_url, owner, name, update_time)
+        return revisions
+
+    def get_owner_repositories(self, owner, page_size=1000):
+        """
+        Return {name: repository} for all repositories of an owner.  Tool sheds that paginate the repository list
+        return {'hits': [...], 'total_results': n} for each page, older tool sheds return every repository at once
+        """
+        url = '%s/repositories' % self.toolshed.url
+        repositories = []
+        page = 1
+        while True:
+            params = {'owner': owner, 'page': page, 'page_size': page_size}
+            response = self.toolshed.make_get_request(url, params=params)
+            if response.status_code != 200:
+                raise bioblend.ConnectionError(
+                    'GET %s failed with status %s' % (url, response.status_code),
+                    body=response.text, status_code=response.status_code,
+                )
+            response = response.json()
+            if isinstance(response, list):
+                repositories = response
+                break
+            hits = response.get('hits') or []
+            repositories.extend(hits)
+            if not hits or len(repositories) >= response.get('total_results', 0):
+                break
+            page += 1
+        return {repository['name']: repository for repository in repositories if repository.get('owner') == owner}
+
+    def get_repository_revision_install_info(self, name, owner, revision, installable_revisions=None):
+        """
+        Return [repository, metadata, install_info] for a changeset.  If installable_revisions
+        is provided, a cached response is only used if the installable revision it points to is
+        one of these, otherwise the cached value is used until it expires.
+        """
+        query = 'repository_revision_install_info'
+        if self.cache:
+            data = self.cache.get(query, self.tool_shed_url, owner, name, revision=revision, ttl=0 if installable_revisions else None)
+            if data is not None:
+                cached_revision = get_installable_revision(name, data)
+                if not installable_revisions or cached_revision in installable_revisions:
+                    return data
+        data = self.toolshed.repositories.get_repository_revision_install_info(name, owner, revision)
+        if self.cache and get_installable_revision(name, data):
+            self.cache.set(query, self.tool_shed_url, owner, name, data, revision=revision)
+        return data
+
+
+def get_installable_revision(name, data):
+    """ Extract the installable revision hash from a get_repository_revision_install_info response """
+    try:
+        repository, metadata, install_info = data
+        desc, clone_url, installable_revision, ctx_rev, owner, repo_deps, tool_deps = install_info[name]
+    except (KeyError, ValueError, TypeError):
+        return None
+    return installable_revision
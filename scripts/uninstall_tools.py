@@ -1,71 +1,150 @@
+import os
+import sys
+import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-from bioblend.galaxy import GalaxyInstance
+
+from utils import get_galaxy_instance, get_repository_snapshot, invalidate_repository_snapshot
 
 """
 Uninstall tools from a galaxy instance via the API using the bioblend package.
 Can be used to uninstall any galaxy toolshed tool with the exception of
 data managers.
+
+Several servers can be given with --server and many name@revision entries can be read from a file
+with --names_file.  The repository list of each server is fetched once, and uninstallations run
+concurrently up to --workers at a time.  With --json a result for every tool and server is written
+to stdout, e.g.
+[{"server": "https://staging.gvl.org.au", "spec": "abricate@4efdca267d51", "name": "abricate",
+  "owner": "iuc", "revision": "4efdca267d51", "status": "Uninstalled", "message": ""}, ...]
+where status is one of Uninstalled, Not found, Ambiguous or Error.
 """
 
 
 def main():
     parser = argparse.ArgumentParser(description='Uninstall tool from a galaxy instance')
-    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
-    parser.add_argument('-a', '--api_key', help='API key for galaxy server', required=True)
+    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL')
+    parser.add_argument('-a', '--api_key', help='API key for galaxy server')
+    parser.add_argument(
+        '-s',
+        '--server',
+        help='Additional Galaxy server URL and API key to uninstall from, may be given more than once',
+        nargs=2,
+        metavar=('URL', 'API_KEY'),
+        action='append',
+        default=[],
+    )
     parser.add_argument(
         '-n',
         '--names',
         help='Names of tools to uninstall.  These can include revision hashes e.g. --names name1@revision1 name1@revision2 name2 ',
         nargs='+',
-        required=True,
+        default=[],
     )
+    parser.add_argument('--names_file', help='File with one name or name@revision entry per line')
     parser.add_argument(
         '-f',
         '--force',
         help='If there are several toolshed entries for one name or name/revision entry uninstall all of them',
         action='store_true',
     )
+    parser.add_argument('-w', '--workers', help='Number of uninstallations to run at once', type=int, default=4)
+    parser.add_argument('-j', '--json', help='Write the result for each tool and server to stdout as JSON', action='store_true')
+    parser.add_argument(
+        '--snapshot_dir',
+        help='Directory for repository list snapshots shared within a build',
+        default=os.environ.get('REPOSITORY_SNAPSHOT_DIR'),
+    )
+    parser.add_argument(
+        '--refresh_snapshot',
+        help='Fetch the repository lists from the servers rather than reading snapshots, e.g. to roll back a new installation',
+        action='store_true',
+    )
 
     args = parser.parse_args()
-    uninstall_tools(args.galaxy_url, args.api_key, args.names, args.force)
-
-
-def uninstall_tools(galaxy_server, api_key, names, force):
-    tools_to_uninstall = []
-    galaxy_instance = GalaxyInstance(url=galaxy_server, key=api_key)
-    installed_tools = [t for t in galaxy_instance.toolshed.get_repositories() if t['status'] != 'Uninstalled']
-
-    for name in names:
-        revision = None
-        if '@' in name:
-            (name, revision) = name.split('@')
-        matching_tools = [t for t in installed_tools if (
-            t['name'] == name and (not revision or revision == t['changeset_revision'])
-        )]
-        id_string = 'name %s revision %s' % (name, revision) if revision else 'name %s' % name
-        if len(matching_tools) == 0:
-            print('*** Warning: No tool with %s' % id_string)
-        elif len(matching_tools) > 1 and not force:
-            print(
-                '*** Warning: More than one toolshed tool found for %s.  ' % id_string
-                + 'Not uninstalling any of these tools.  Run script with --force (-f) flag to uninstall anyway'
-            )
-        else:  # Either there is only one matching tool for the name and revision, or there are many and force=True
-            tools_to_uninstall.extend(matching_tools)
+    servers = ([(args.galaxy_url, args.api_key)] if args.galaxy_url else []) + [tuple(server) for server in args.server]
+    names = list(args.names)
+    if args.names_file:
+        with open(args.names_file) as handle:
+            names.extend(line.strip() for line in handle if line.strip() and not line.startswith('#'))
+    if not servers or not names:
+        parser.error('At least one server (--galaxy_url or --server) and one name (--names or --names_file) are required')
+
+    results = uninstall_tools(
+        servers, names, args.force, snapshot_dir=args.snapshot_dir, refresh_snapshot=args.refresh_snapshot,
+        workers=args.workers,
+        log=sys.stderr if args.json else sys.stdout,
+    )
+    if args.json:
+        sys.stdout.write(json.dumps(results, indent=2) + '\n')
+
+
+def uninstall_tools(servers, names, force=False, snapshot_dir=None, refresh_snapshot=False, workers=4, log=sys.stdout):
+    """
+    Uninstall names (name or name@revision) from each of servers, a list of (url, api_key) tuples.
+    Returns a list of result dicts, one for each repository uninstalled or name that was not.
+    """
+    def write(message):
+        log.write(message + '\n')
+        log.flush()
 
-    for tool in tools_to_uninstall:
+    results = []
+    tools_to_uninstall = []  # (server, api_key, spec, repository)
+    queued = set()
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(servers)), 1)) as executor:
+        snapshots = list(executor.map(
+            lambda server: get_repository_snapshot(server[0], server[1], snapshot_dir=snapshot_dir, refresh=refresh_snapshot), servers
+        ))
+
+    for (galaxy_server, api_key), snapshot in zip(servers, snapshots):
+        for spec in names:
+            name, revision = spec.split('@') if '@' in spec else (spec, None)
+            matching_tools = [t for t in snapshot.find(name, changeset_revision=revision) if t['status'] != 'Uninstalled']
+            id_string = 'name %s revision %s' % (name, revision) if revision else 'name %s' % name
+            result = {'server': galaxy_server, 'spec': spec, 'name': name, 'owner': None, 'revision': revision}
+            if len(matching_tools) == 0:
+                write('*** Warning: No tool with %s on %s' % (id_string, galaxy_server))
+                results.append(dict(result, status='Not found', message=''))
+            elif len(matching_tools) > 1 and not force:
+                write(
+                    '*** Warning: More than one toolshed tool found for %s on %s.  ' % (id_string, galaxy_server)
+                    + 'Not uninstalling any of these tools.  Run script with --force (-f) flag to uninstall anyway'
+                )
+                results.append(dict(result, status='Ambiguous', message='%d matching repositories' % len(matching_tools)))
+            else:  # Either there is only one matching tool for the name and revision, or there are many and force=True
+                for tool in matching_tools:
+                    key = (galaxy_server, tool['name'], tool['owner'], tool['changeset_revision'])
+                    if key not in queued:  # the same repository may match more than one name
+                        queued.add(key)
+                        tools_to_uninstall.append((galaxy_server, api_key, spec, tool))
+
+    galaxy_instances = {server: get_galaxy_instance(server, api_key) for server, api_key in servers}
+
+    def uninstall(item):
+        galaxy_server, api_key, spec, tool = item
+        result = {
+            'server': galaxy_server, 'spec': spec, 'name': tool['name'], 'owner': tool['owner'], 'revision': tool['changeset_revision'],
+        }
+        write('Uninstalling %s at revision %s on %s' % (tool['name'], tool['changeset_revision'], galaxy_server))
         try:
-            print('Uninstalling %s at revision %s' % (tool['name'], tool['changeset_revision']))
-            return_value = galaxy_instance.toolshed.uninstall_repository_revision(
+            return_value = galaxy_instances[galaxy_server].toolshed.uninstall_repository_revision(
                 name=tool['name'],
                 owner=tool['owner'],
                 changeset_revision=tool['changeset_revision'],
                 tool_shed_url=tool['tool_shed'],
             )
-            print(return_value)
+            write(str(return_value))
+            return dict(result, status='Uninstalled', message=str(return_value))
         except Exception as e:
-            print(e)
+            write(str(e))
+            return dict(result, status='Error', message=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results.extend(executor.map(uninstall, tools_to_uninstall))
+    for galaxy_server in set(item[0] for item in tools_to_uninstall):
+        invalidate_repository_snapshot(galaxy_server, snapshot_dir=snapshot_dir)
+    return results
 
 
 if __name__ == "__main__":
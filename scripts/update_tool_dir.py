@@ -0,0 +1,97 @@
+import os
+import csv
+import sys
+import argparse
+
+import tool_yaml
+from split_tool_yml import slugify, write_tool_file
+from utils import get_repository_snapshot
+from log_store import log_columns
+
+"""
+Apply the repositories changed during a build to the section files in a tool directory, instead of
+refetching the full tool list with get-tool-list and rewriting every file with split_tool_yml.py.
+Changed repositories are read from the build's installation log rows.  For each one, the list of revisions
+is set to the revisions currently installed on the Galaxy server.  Only section files whose content
+changes are rewritten.  Exits with status 1 if the change cannot be applied, in which case the caller
+should fall back to a full update.
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update tool .yml files with repositories changed in a build')
+    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
+    parser.add_argument('-a', '--api_key', help='API key for galaxy server')
+    parser.add_argument('-d', '--tool_dir', help='Directory of per-section tool .yml files', required=True)
+    parser.add_argument('-l', '--log_file', help='Installation log rows (no header) written during the build', required=True)
+    parser.add_argument(
+        '--snapshot_dir',
+        help='Directory for repository list snapshots shared within a build',
+        default=os.environ.get('REPOSITORY_SNAPSHOT_DIR'),
+    )
+
+    args = parser.parse_args()
+    with open(args.log_file) as handle:
+        rows = list(csv.DictReader(handle, fieldnames=log_columns, dialect='excel-tab'))
+    snapshot = get_repository_snapshot(args.galaxy_url, args.api_key, snapshot_dir=args.snapshot_dir)
+    try:
+        changed_files = update_tool_dir(args.tool_dir, rows, snapshot)
+    except ValueError as e:
+        sys.stderr.write('Could not update %s: %s\n' % (args.tool_dir, e))
+        sys.exit(1)
+    print('%d files updated in %s' % (len(changed_files), args.tool_dir))
+
+
+def update_tool_dir(tool_dir, rows, snapshot):
+    sections = {}  # file name: list of tools
+    locations = {}  # (name, owner): file name
+    for fname in sorted(os.listdir(tool_dir)):
+        if not fname.endswith('.yml'):
+            continue
+        sections[fname] = tool_yaml.load_file(os.path.join(tool_dir, fname))['tools']
+        for tool in sections[fname]:
+            locations[(tool['name'], tool['owner'])] = fname
+
+    modified = set()
+    changed_repos = {(row['Name'], row['Owner']): row for row in rows}
+    for (name, owner), row in changed_repos.items():
+        installed_revisions = [r['changeset_revision'] for r in snapshot.find(name, owner, statuses=['Installed'])]
+        fname = locations.get((name, owner))
+        if fname:
+            [tool] = [t for t in sections[fname] if t['name'] == name and t['owner'] == owner]
+            revisions = [r for r in tool['revisions'] if r in installed_revisions]
+            revisions += [r for r in installed_revisions if r not in revisions]
+            if revisions == tool['revisions']:
+                continue
+            if revisions:
+                tool['revisions'] = revisions
+            else:
+                sections[fname].remove(tool)
+            modified.add(fname)
+        elif installed_revisions:
+            label = row['Section Label']
+            if not label:
+                raise ValueError('No section label for new repository %s owner %s' % (name, owner))
+            fname = slugify(label) + '.yml'
+            sections.setdefault(fname, []).append({
+                'name': name,
+                'owner': owner,
+                'revisions': installed_revisions,
+                'tool_panel_section_label': label,
+                'tool_shed_url': row['Tool Shed URL'],
+            })
+            modified.add(fname)
+
+    changed_files = []
+    for fname in sorted(modified):
+        path = os.path.join(tool_dir, fname)
+        if not sections[fname]:
+            os.remove(path)
+            changed_files.append(path)
+        elif write_tool_file(path, sections[fname]):
+            changed_files.append(path)
+    return changed_files
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,379 @@
-import csv
+import fcntl
+import json
+import os
+import random
 import subprocess
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
 
+import bioblend
+import requests
 from bioblend.galaxy import GalaxyInstance
 from bioblend.toolshed import ToolShedInstance
 
+from log_store import LogStore
+
+"""
+Galaxy and tool shed instances are created through get_galaxy_instance and get_toolshed_instance, which return
+the same instance for the same arguments.  Tool shed instances with a rate limit share a rate limiter with the
+other instances for the same host and rate limit only.  All instances for one host send their requests through
+a shared keep-alive session (HostClient) that sets a default timeout, retries failed idempotent requests with jittered
+exponential backoff within a retry budget, and stops sending requests to a host for reset_seconds once
+failure_threshold requests in a row have failed, raising HostUnavailableError instead of waiting for each
+request to time out.
+"""
+
+default_timeout = (10, 300)  # seconds to connect, seconds between bytes of the response
+default_pool_size = 10
+max_retries = 3
+retry_budget_ratio = 0.2  # retries allowed per request sent, on top of min_retry_budget
+min_retry_budget = 10
+backoff_seconds = 1.0
+max_backoff_seconds = 30.0
+failure_threshold = 5
+reset_seconds = 60.0
+retry_statuses = {429, 502, 503, 504}
+idempotent_methods = {'GET', 'PUT', 'DELETE', 'HEAD'}
+
+_instances = {}
+_host_clients = {}
+_instances_lock = threading.Lock()
+
 
 def get_galaxy_instance(url, api_key=None):
-    if not url.startswith('https://'):
-        url = 'https://' + url
-    return GalaxyInstance(url, api_key)
+    url = add_scheme(url)
+    with _instances_lock:
+        if ('galaxy', url, api_key) not in _instances:
+            _instances[('galaxy', url, api_key)] = ResilientGalaxyInstance(url, api_key)
+        return _instances[('galaxy', url, api_key)]
+
 
-def get_toolshed_instance(url):
-    if not url.startswith('https://'):
+def get_toolshed_instance(url, pool_size=None, rate_limit=None):
+    """
+    Return a ToolShedInstance.  Instances share one keep-alive session per host with at least pool_size
+    connections, so one instance can be used from several threads.  rate_limit is the maximum number of
+    requests per second sent to the host by the instances with that rate_limit, so callers with different
+    limits do not change each other's.
+    """
+    url = add_scheme(url)
+    host_client = get_host_client(url, pool_size=pool_size)
+    with _instances_lock:
+        key = ('toolshed', url, rate_limit or None)
+        if key not in _instances:
+            instance = ResilientToolShedInstance(url=url)
+            instance.host_client = host_client
+            instance.rate_limiter = RateLimiter(rate_limit)
+            _instances[key] = instance
+        return _instances[key]
+
+
+def add_scheme(url):
+    if not url.startswith(('https://', 'http://')):
         url = 'https://' + url
-    return ToolShedInstance(url=url)
+    return url.rstrip('/')
+
+
+def get_host_client(url, pool_size=None):
+    """ Return the HostClient for the host of url, widening its connection pool to pool_size if it is smaller """
+    host = urlparse(url).netloc
+    with _instances_lock:
+        if host not in _host_clients:
+            _host_clients[host] = HostClient(host)
+        host_client = _host_clients[host]
+    host_client.configure(pool_size=pool_size)
+    return host_client
+
+
+class HostUnavailableError(requests.exceptions.ConnectionError):
+    """ Raised without sending a request while the circuit breaker for a host is open """
+
+
+class RateLimiter:
+    """ Space out calls to wait() so that no more than rate calls are made per second, across all threads """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class CircuitBreaker:
+    """
+    Closed while requests succeed.  Opens after failure_threshold consecutive failures and rejects requests
+    for reset_seconds, then lets one request through: the circuit closes if it succeeds and opens again if not
+    """
+    def __init__(self, failure_threshold=failure_threshold, reset_seconds=reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.trial = True  # half open: one request decides
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures, self.opened_at, self.trial = 0, None, False
+            else:
+                self.failures += 1
+                if self.trial or self.failures >= self.failure_threshold:
+                    self.opened_at, self.trial = time.monotonic(), False
+
+
+class HostClient:
+    """ Keep-alive session, retry budget and circuit breaker for one host, shared between threads """
+    def __init__(self, host):
+        self.host = host
+        self.session = requests.Session()
+        self.pool_size = 0
+        self.circuit_breaker = CircuitBreaker()
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+        self.configure(pool_size=default_pool_size)
+
+    def configure(self, pool_size=None):
+        """ Widen the connection pool to pool_size.  The pool is never narrowed as other threads may be using it """
+        with self.lock:
+            if pool_size and pool_size > self.pool_size:
+                self.pool_size = pool_size
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                self.session.mount('https://', adapter)
+                self.session.mount('http://', adapter)
+
+    def take_retry(self):
+        """ Whether the retry budget for this host allows another retry """
+        with self.lock:
+            if self.retries >= min_retry_budget + retry_budget_ratio * self.requests_sent:
+                return False
+            self.retries += 1
+            return True
+
+    def request(self, method, url, rate_limiter=None, **kwargs):
+        """
+        Send a request, retrying idempotent requests after connection errors and retry_statuses.  Each attempt
+        waits for rate_limiter if one is given
+        """
+        kwargs.setdefault('timeout', default_timeout)
+        attempts = max_retries + 1 if method in idempotent_methods else 1
+        for attempt in range(attempts):
+            if not self.circuit_breaker.allow():
+                raise HostUnavailableError('%s has failed %d requests in a row, not retrying for %ds' % (
+                    self.host, self.circuit_breaker.failure_threshold, self.circuit_breaker.reset_seconds
+                ))
+            if rate_limiter:
+                rate_limiter.wait()
+            with self.lock:
+                self.requests_sent += 1
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.circuit_breaker.record(False)
+                if attempt + 1 == attempts or not self.take_retry():
+                    raise
+            except requests.exceptions.RequestException:
+                # not retried, but recorded so that a failed trial request does not leave the circuit open
+                self.circuit_breaker.record(False)
+                raise
+            else:
+                self.circuit_breaker.record(response.status_code < 500)
+                if response.status_code not in retry_statuses or attempt + 1 == attempts or not self.take_retry():
+                    return response
+            delay = min(max_backoff_seconds, backoff_seconds * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+class ResilientClientMixin:
+    """ Send the requests of a bioblend instance through the HostClient for its host """
+    host_client = None
+    rate_limiter = None
+
+    def send(self, method, url, **kwargs):
+        if self.host_client is None:
+            self.host_client = get_host_client(url)
+        kwargs.setdefault('verify', self.verify)
+        if self.timeout:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.host_client.request(method, url, rate_limiter=self.rate_limiter, **kwargs)
+
+    def make_get_request(self, url, **kwargs):
+        return self.send('GET', url, headers=self.json_headers, **kwargs)
+
+    def make_delete_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        return self.send('DELETE', url, params=params, data=data, headers=self.json_headers, allow_redirects=False)
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        if files_attached:  # multipart uploads are left to bioblend
+            return super().make_post_request(url, payload=payload, params=params, files_attached=files_attached)
+        data = json.dumps(payload) if payload is not None else None
+        response = self.send('POST', url, params=params, data=data, headers=self.json_headers, allow_redirects=False)
+        return self.decode(response)
+
+    def make_put_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        response = self.send('PUT', url, params=params, data=data, headers=self.json_headers, allow_redirects=False)
+        return self.decode(response)
+
+    def make_patch_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        response = self.send('PATCH', url, params=params, data=data, headers=self.json_headers, allow_redirects=False)
+        return self.decode(response)
+
+    @staticmethod
+    def decode(response):
+        """ Return the JSON content of a response or raise bioblend's ConnectionError, as bioblend does """
+        if response.status_code == 200:
+            try:
+                return response.json()
+            except ValueError as e:
+                raise bioblend.ConnectionError(
+                    'Request was successful, but cannot decode the response content: %s' % e,
+                    body=response.content, status_code=response.status_code,
+                )
+        raise bioblend.ConnectionError(
+            'Unexpected HTTP status code: %s' % response.status_code, body=response.text, status_code=response.status_code
+        )
+
+
+class ResilientGalaxyInstance(ResilientClientMixin, GalaxyInstance):
+    pass
+
+
+class ResilientToolShedInstance(ResilientClientMixin, ToolShedInstance):
+    pass
+
 
 def get_repositories(url, api_key):
     galaxy = get_galaxy_instance(url, api_key)
     return galaxy.toolshed.get_repositories()
 
 
+snapshot_keys = ['name', 'owner', 'changeset_revision', 'installed_changeset_revision', 'ctx_rev', 'status', 'tool_shed']
+
+
+class RepositorySnapshot:
+    """
+    The tool shed repositories on a Galaxy server, indexed by name, by (name, owner) and by
+    (name, owner, changeset_revision).  Each index maps to a list of repository dicts.
+    """
+    def __init__(self, repositories):
+        self.repositories = repositories
+        self.by_name = defaultdict(list)
+        self.by_name_owner = defaultdict(list)
+        self.by_revision = defaultdict(list)
+        for repo in repositories:
+            self.by_name[repo['name']].append(repo)
+            self.by_name_owner[(repo['name'], repo['owner'])].append(repo)
+            self.by_revision[(repo['name'], repo['owner'], repo['changeset_revision'])].append(repo)
+
+    def find(self, name, owner=None, changeset_revision=None, statuses=None):
+        """
+        Return repositories matching name and optionally owner, changeset_revision and a list of statuses
+        """
+        if owner and changeset_revision:
+            matches = self.by_revision.get((name, owner, changeset_revision), [])
+        elif owner:
+            matches = self.by_name_owner.get((name, owner), [])
+        else:
+            matches = self.by_name.get(name, [])
+            if changeset_revision:
+                matches = [r for r in matches if r['changeset_revision'] == changeset_revision]
+        if statuses:
+            matches = [r for r in matches if r['status'] in statuses]
+        return matches
+
+
+def get_repository_snapshot(url, api_key, snapshot_dir=None, refresh=False):
+    """
+    Return a RepositorySnapshot for a Galaxy server.  If snapshot_dir is set, the repository list is read from
+    a snapshot file written by an earlier call in the same build, or fetched once and saved there.  The
+    snapshot must be invalidated with invalidate_repository_snapshot whenever repositories are installed or
+    uninstalled.  A fetched list is not saved if the snapshot was invalidated while it was being fetched, as
+    it may not include the repositories that were changed.  With refresh, the list is always fetched.
+    """
+    path = get_snapshot_path(url, snapshot_dir) if snapshot_dir else None
+    if path and os.path.exists(path) and not refresh:
+        with open(path) as handle:
+            rows = json.load(handle)['repositories']
+        return RepositorySnapshot([dict(zip(snapshot_keys, row)) for row in rows])
+    generation = get_snapshot_generation(path) if path else None
+    repositories = [{key: repo.get(key) for key in snapshot_keys} for repo in get_repositories(url, api_key)]
+    if path:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as handle:
+            json.dump({'repositories': [[repo[key] for key in snapshot_keys] for repo in repositories]}, handle, separators=(',', ':'))
+        with open('%s.generation' % path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if get_snapshot_generation(path) == generation:
+                os.replace(tmp_path, path)  # atomic so that concurrent readers never see a partial file
+            else:
+                os.remove(tmp_path)
+    return RepositorySnapshot(repositories)
+
+
+def invalidate_repository_snapshot(url, snapshot_dir=None):
+    if not snapshot_dir:
+        return
+    path = get_snapshot_path(url, snapshot_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open('%s.generation' % path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        lock.write('\n')
+        lock.flush()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_snapshot_generation(path):
+    # <snapshot>.generation grows by one line each time the snapshot is invalidated
+    generation_path = '%s.generation' % path
+    return os.path.getsize(generation_path) if os.path.exists(generation_path) else 0
+
+
+def get_snapshot_path(url, snapshot_dir):
+    # the file name is the host name of the server, i.e. $(basename $URL).json in bash
+    host = url.split('://')[-1].strip('/').replace('/', '_')
+    return os.path.join(snapshot_dir, '%s.json' % host)
+
+
 def get_toolshed_tools(url, api_key=None):
     galaxy = get_galaxy_instance(url, api_key)
     return [tool for tool in galaxy.tools.get_tools() if tool.get('tool_shed_repository')]
 
 
-def load_log(filter=None):
+def load_log(filter=None, **query):
     """
     Load the installation log tsv file and return it as a list row objects, i.e.
     [{'Build Num.': '156', 'Name': 'abricate', ...}, {'Build Num.': '156', 'Name': 'bedtools', ...},...]
-    The filter argument is a function that takes a row as input and returns True or False
-    """
-    log_file = 'automated_tool_installation_log.tsv'
-    table = []
-    with open(log_file) as tsvfile:
-        reader = csv.DictReader(tsvfile, dialect='excel-tab')
-        for row in reader:
-            if not filter or filter(row):
-                table.append(row)
+    The filter argument is a function that takes a row as input and returns True or False.
+    Any other keyword arguments are passed to LogStore.query to select rows using the store's indexes.
+    """
+    store = LogStore('automated_tool_installation_log.tsv')
+    store.sync()
+    table = [row for row in store.query(**query) if not filter or filter(row)]
+    store.close()
     return table
 
 
@@ -0,0 +1,72 @@
+import sys
+import time
+import argparse
+
+from utils import get_valid_tools_for_repo, get_toolshed_tools
+
+"""
+Wait until the tools from a newly installed tool shed repository revision are loaded on a Galaxy server.
+Galaxy's web workers each hold their own toolbox and reload it in their own time after an installation, so
+the server is only considered ready once the tools have been seen in several consecutive API responses.
+Exits with status 1 if the tools are not all visible within the timeout.
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wait for the tools of a repository revision to be loaded on Galaxy')
+    parser.add_argument('-g', '--galaxy_url', help='Galaxy server URL', required=True)
+    parser.add_argument('-a', '--api_key', help='API key for galaxy server')
+    parser.add_argument('-n', '--name', help='Repository name', required=True)
+    parser.add_argument('-o', '--owner', help='Repository owner', required=True)
+    parser.add_argument('-r', '--revision', help='Installed revision', required=True)
+    parser.add_argument('-t', '--tool_shed_url', help='Tool shed URL', default='toolshed.g2.bx.psu.edu')
+    parser.add_argument('--timeout', help='Seconds to wait before giving up', type=float, default=300)
+    parser.add_argument('--consecutive', help='Number of consecutive responses that must list every tool', type=int, default=3)
+
+    args = parser.parse_args()
+    ready = wait_for_tools(
+        args.galaxy_url, args.api_key, args.name, args.owner, args.revision, args.tool_shed_url,
+        timeout=args.timeout, consecutive=args.consecutive,
+    )
+    if not ready:
+        sys.exit(1)
+
+
+def wait_for_tools(url, api_key, name, owner, revision, tool_shed_url, timeout=300, consecutive=3, interval=1, max_interval=20):
+    try:
+        valid_tools = get_valid_tools_for_repo(name, owner, revision, tool_shed_url) or []
+    except Exception as e:
+        print('Could not get tools for %s %s from %s: %s' % (name, revision, tool_shed_url, e))
+        return False
+    expected_ids = set(tool['guid'] for tool in valid_tools)
+    if not expected_ids:
+        print('%s revision %s has no tools to wait for' % (name, revision))
+        return True
+
+    start = time.time()
+    seen_count = 0
+    while True:
+        try:
+            loaded_ids = set(tool['id'] for tool in get_toolshed_tools(url, api_key))
+            missing_ids = expected_ids - loaded_ids
+        except Exception as e:  # Galaxy may be restarting
+            missing_ids = expected_ids
+            print('Error querying tools on %s: %s' % (url, e))
+        if missing_ids:
+            seen_count = 0
+        else:
+            seen_count += 1
+            if seen_count >= consecutive:
+                print('%d tools from %s revision %s loaded on %s after %.0fs' % (len(expected_ids), name, revision, url, time.time() - start))
+                return True
+            interval = 1  # check again promptly
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            print('Timed out after %.0fs waiting for tools on %s: %s' % (elapsed, url, ', '.join(sorted(missing_ids))))
+            return False
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, max_interval)
+
+
+if __name__ == "__main__":
+    main()
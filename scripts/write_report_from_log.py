@@ -1,6 +1,9 @@
-import csv
+import os
 import sys
 import argparse
+from datetime import datetime, timedelta
+
+from log_store import LogStore, date_format
 
 default_tool_shed = 'toolshed.g2.bx.psu.edu'
 log_file = 'automated_tool_installation_log.tsv'
@@ -10,6 +13,10 @@ Generate a report of weekly installations and updates on Galaxy Australia
 Because this script runs at the end of the update cron job and the length
 of the job may vary, we need to include only installations completed between
 now and the time that this script was run last week
+
+Reports for several build ranges or calendar weeks can be written in one run, e.g. to backfill a year
+of weekly reports:
+python scripts/write_report_from_log.py --weeks 2021-01-04 2021-12-31 --outdir _posts
 """
 
 parser = argparse.ArgumentParser(description='Generate report from installation log')
@@ -18,6 +25,14 @@ parser.add_argument('-o', '--outfile', help='Name of report file to write')
 parser.add_argument('-d', '--date', help='Date for report header')
 parser.add_argument('-b', '--begin_build', help='Jenkins build in log to use as first in report, i.e. install-7 or update-3')
 parser.add_argument('-e', '--end_build', help='Jenkins build in log to use as last in report, i.e. install-10 or update-6.  Default is end of file')
+parser.add_argument('-r', '--range', action='append', default=[], help=(
+    'Build range for a report as BEGIN:END, i.e. update-3:update-6.  May be given more than once, '
+    'reports are written to OUTDIR and named by the date of the last build in the range'
+))
+parser.add_argument('-w', '--weeks', nargs=2, metavar=('FROM', 'TO'), help=(
+    'Write a report for each calendar week (Monday to Sunday) between two dates (YYYY-MM-DD) to OUTDIR'
+))
+parser.add_argument('--outdir', help='Directory for reports from --range and --weeks', default='.')
 
 style = """\n<style>
   table {
@@ -51,11 +66,11 @@ def get_report_header(date):
     )
 
 
-def get_build_range(table, build_category, build_number):
-    rows = [
-        row_num for (row_num, row) in enumerate(table) if row['Category'] == build_category.title() and row['Build Num.'] == str(build_number)
-    ]
-    return (rows[0], rows[-1])
+def get_build_range(store, build_category, build_number):
+    build_range = store.get_build_range(build_category, build_number)
+    if not build_range:
+        raise Exception('Build %s-%s not found in %s' % (build_category, build_number, log_file))
+    return build_range
 
 
 def tool_table(tool_dict):
@@ -75,74 +90,151 @@ def get_tool_link(name, owner, revision, tool_shed_url):
 
 
 def main(current_build_number, begin_build, end_build, report_file='report.md', date=''):
-    table = []
-    tools = []
-    with open(log_file) as tsvfile:
-        reader = csv.DictReader(tsvfile, dialect='excel-tab')
-        for row in reader:
-            table.append(row)
+    store = LogStore(log_file)
+    store.sync()
 
     if current_build_number:
-        previous_jenkins_update_build_num = max(
-            [int(y) for y in [row['Build Num.'] for row in table if row['Category'] == 'Update'] if int(y) < int(current_build_number)]
-        )
-        start_row = get_build_range(table, 'update', previous_jenkins_update_build_num)[1] + 1
-        finish_row = get_build_range(table, 'update', current_build_number)[1]
+        previous_jenkins_update_build_num = store.get_previous_build_number('update', current_build_number)
+        start_row = get_build_range(store, 'update', previous_jenkins_update_build_num)[1] + 1
+        finish_row = get_build_range(store, 'update', current_build_number)[1]
     elif begin_build and end_build:
         begin_category, begin_build_number = begin_build.split('-')
-        start_row = get_build_range(table, begin_category, begin_build_number)[0]
+        start_row = get_build_range(store, begin_category, begin_build_number)[0]
+        end_category, end_build_number = end_build.split('-')
+        finish_row = get_build_range(store, end_category, end_build_number)[1]
+
+    report = {'file': report_file, 'date': date, 'rows': (start_row, finish_row)}
+    collect_tools(store, [report], {})
+    store.close()
+    if not report['tools']:  # nothing to report
+        sys.stderr.write('No tools installed this week.\n')
+        return
+    write_report(report)
+
+
+def write_reports(build_ranges, weeks, outdir):
+    """
+    Write a report for each build range (BEGIN:END) and for each calendar week between the two
+    dates in weeks, reading the log once for all of them
+    """
+    store = LogStore(log_file)
+    store.sync()
+    range_reports = []
+    for build_range in build_ranges:
+        begin_build, end_build = build_range.split(':')
+        begin_category, begin_build_number = begin_build.split('-')
         end_category, end_build_number = end_build.split('-')
-        finish_row = get_build_range(table, end_category, end_build_number)[1]
-
-    for row in table[start_row:finish_row+1]:
-        if row['Status'] == 'Installed' and row['Section Label'] != 'None':
-            link = get_tool_link(row['Name'], row['Owner'], row['Installed Revision'], row['Tool Shed URL'])
-            matching_tools = [tool for tool in tools if tool['owner'] == row['Owner'] and tool['name'] == row['Name']]
-            if matching_tools:
-                matching_tools[0]['links'].append(link)
+        start_row = get_build_range(store, begin_category, begin_build_number)[0]
+        finish_row = get_build_range(store, end_category, end_build_number)[1]
+        [last_row] = store.query(row_from=finish_row, row_to=finish_row)
+        date = datetime.strptime(last_row['Date (AEST)'], date_format).strftime('%Y-%m-%d')
+        range_reports.append({'date': date, 'rows': (start_row, finish_row)})
+
+    week_reports = {}  # keyed by the date of the Monday of the week
+    if weeks:
+        date_from, date_to = [datetime.strptime(date, '%Y-%m-%d').date() for date in weeks]
+        monday = date_from - timedelta(days=date_from.weekday())
+        while monday <= date_to:
+            sunday = monday + timedelta(days=6)
+            week_reports[monday] = {'date': sunday.strftime('%Y-%m-%d')}
+            monday += timedelta(weeks=1)
+
+    reports = range_reports + [week_reports[monday] for monday in sorted(week_reports)]
+    for report in reports:
+        report['file'] = os.path.join(outdir, '%s-tool-updates.md' % report['date'])
+    report_files = [report['file'] for report in reports]
+    duplicates = sorted(set(path for path in report_files if report_files.count(path) > 1))
+    if duplicates:
+        raise Exception('More than one report would be written to %s' % ', '.join(duplicates))
+
+    collect_tools(store, range_reports, week_reports)
+    store.close()
+    os.makedirs(outdir, exist_ok=True)
+    for report in reports:
+        if report['tools']:
+            write_report(report)
+            print('Wrote %s' % report['file'])
+        else:
+            sys.stderr.write('No tools installed for %s\n' % report['file'])
+
+
+def collect_tools(store, range_reports, week_reports):
+    """
+    Add the tools installed in each report's build range or calendar week to report['tools'] with a single
+    pass over the installed rows of the log.  Tools are keyed by (owner, name) and each revision installed
+    is added to the tool's links.
+    """
+    for report in range_reports + list(week_reports.values()):
+        report['tools'] = {}
+    if not range_reports and not week_reports:
+        return
+    query = {'status': 'Installed'}
+    if not week_reports:
+        query['row_from'] = min(report['rows'][0] for report in range_reports)
+        query['row_to'] = max(report['rows'][1] for report in range_reports)
+    elif not range_reports:  # rows are not strictly in date order, so weeks are selected by date
+        query['date_from'] = datetime.combine(min(week_reports), datetime.min.time())
+        query['date_to'] = datetime.combine(max(week_reports) + timedelta(days=6), datetime.max.time())
+
+    pending = sorted(range_reports, key=lambda report: report['rows'][0])
+    active = []
+    for row_num, row in store.iter_rows(**query):
+        while pending and pending[0]['rows'][0] <= row_num:
+            active.append(pending.pop(0))
+        active = [report for report in active if report['rows'][1] >= row_num]
+        matching_reports = [report for report in active if report['rows'][0] <= row_num]
+        if week_reports:
+            date = datetime.strptime(row['Date (AEST)'], date_format).date()
+            week_report = week_reports.get(date - timedelta(days=date.weekday()))
+            if week_report:
+                matching_reports.append(week_report)
+        if not matching_reports or row['Section Label'] == 'None':
+            continue
+        link = get_tool_link(row['Name'], row['Owner'], row['Installed Revision'], row['Tool Shed URL'])
+        for report in matching_reports:
+            tool = report['tools'].get((row['Owner'], row['Name']))
+            if tool:
+                tool['links'].append(link)
             else:
-                tools.append({
+                report['tools'][(row['Owner'], row['Name'])] = {
                     'name': row['Name'],
                     'owner': row['Owner'],
                     'links': [link],
                     'new': row['New Tool'] == 'True',
                     'label': row['Section Label']
-                })
+                }
 
-    if not tools:  # nothing to report
-        sys.stderr.write('No tools installed this week.\n')
-        return
 
+def write_report(report):
     installed_tools = {}
     updated_tools = {}
-    for tool in tools:
+    for tool in report['tools'].values():
         label = tool.pop('label')
         if tool['new']:
-            if label not in installed_tools.keys():
-                installed_tools[label] = []
-            installed_tools[label].append(tool)
+            installed_tools.setdefault(label, []).append(tool)
         else:
-            if label not in updated_tools.keys():
-                updated_tools[label] = []
-            updated_tools[label].append(tool)
+            updated_tools.setdefault(label, []).append(tool)
 
-    with open(report_file, 'w') as report:
-        report.write(get_report_header(date))
-        report.write(style)
+    with open(report['file'], 'w') as report_file:
+        report_file.write(get_report_header(report['date']))
+        report_file.write(style)
         if installed_tools:
-            report.write('\n### Tools installed\n\n')
-            report.write(tool_table(installed_tools))
+            report_file.write('\n### Tools installed\n\n')
+            report_file.write(tool_table(installed_tools))
         if updated_tools:
-            report.write('\n### Tools updated\n\n')
-            report.write(tool_table(updated_tools))
+            report_file.write('\n### Tools updated\n\n')
+            report_file.write(tool_table(updated_tools))
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(
-        current_build_number=args.jenkins_build_number,
-        begin_build=args.begin_build,
-        end_build=args.end_build,
-        report_file=args.outfile,
-        date=args.date,
-    )
+    if args.range or args.weeks:
+        write_reports(args.range, args.weeks, args.outdir)
+    else:
+        main(
+            current_build_number=args.jenkins_build_number,
+            begin_build=args.begin_build,
+            end_build=args.end_build,
+            report_file=args.outfile,
+            date=args.date,
+        )